@@ -0,0 +1,113 @@
+# One HTTP client for all the API calls made by this process, set up once by utils.py: a
+# requests.Session whose keep-alive connection pool is shared by all threads, with explicit
+# connect and read timeouts.  Without it, the openai library gives each thread its own session
+# (and replaces it every few minutes), so hedged requests and other short-lived threads keep
+# opening new connections, and a stalled connection waits out the library's 10-minute timeout.
+#
+# Settings, all from the environment:
+#   GPT3_API_KEY         the API key, read once rather than on every call
+#   GPT_MAX_CONNECTIONS  connections kept open (default 16); set it to the number of concurrent calls
+#   GPT_CONNECT_TIMEOUT  seconds to wait for a connection (default 10)
+#   GPT_READ_TIMEOUT     seconds to wait for a response (default 300, as long completions are slow)
+
+import os, threading, json
+
+MAX_RETRIES = 2 # for failed connections, as in the openai library
+
+# Imported only when a session is made, like openai itself, so importing utils does not need requests
+def make_session(max_connections:int):
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    # The openai library closes sessions it considers old; this one lives as long as the process
+    class pooled_session(requests.Session):
+        def close(self):
+            pass
+
+    session = pooled_session()
+    # pool_block: when all connections are busy, wait for one rather than open one that is then thrown away
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_connections, pool_block=True, max_retries=MAX_RETRIES)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def get_timeout() -> tuple:
+    return (float(os.getenv("GPT_CONNECT_TIMEOUT", "10")), float(os.getenv("GPT_READ_TIMEOUT", "300")))
+
+lock = threading.Lock()
+session = None
+
+# Sets up the openai module to use the shared session; safe to call from any thread, any number of times
+def setup():
+    global session
+    with lock:
+        if session is None:
+            import openai
+            openai.api_key = os.getenv("GPT3_API_KEY")
+            session = make_session(int(os.getenv("GPT_MAX_CONNECTIONS", "16")))
+            openai.requestssession = session
+    return session
+
+# A local stub of the completions endpoint, for the benchmark below and tests/test_api_client.py.
+# It answers instantly, without TLS, and counts the connections it accepted (in server.connections).
+def start_stub_server():
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class stub_handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1" # keep-alive
+        disable_nagle_algorithm = True # else small responses on a kept-alive connection wait on delayed ACKs
+        def setup(self):
+            BaseHTTPRequestHandler.setup(self)
+            with self.server.connections_lock:
+                self.server.connections += 1
+        def do_POST(self):
+            self.rfile.read(int(self.headers["Content-Length"]))
+            body = json.dumps({"choices": [{"text": " No."}]}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), stub_handler)
+    server.daemon_threads = True
+    server.connections = 0
+    server.connections_lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    server.url = "http://127.0.0.1:" + str(server.server_address[1]) + "/v1/completions"
+    return server
+
+# Sends num_requests requests over num_threads threads with post (e.g. requests.post, or a session's
+# post); returns the average seconds per request
+def time_requests(post, url:str, num_requests:int, num_threads:int) -> float:
+    import time
+    from concurrent import futures
+    request_body = {"model": "text-davinci-003", "prompt": "Is Alice a Brenolat? " * 50, "max_tokens": 5}
+    start = time.perf_counter()
+    with futures.ThreadPoolExecutor(num_threads) as executor:
+        for response in executor.map(lambda i: post(url, json=request_body, timeout=get_timeout()),
+                                     range(num_requests)):
+            assert response.json()["choices"][0]["text"] == " No."
+    return (time.perf_counter() - start) / num_requests
+
+# Micro-benchmark against the stub server: the per-request cost of opening a new connection
+# each time (what happens whenever the openai library starts a new session) vs. the shared pool.
+# Real savings per new connection are larger, with TLS and a real network.
+if __name__ == "__main__":
+    import argparse
+    import requests
+
+    parser = argparse.ArgumentParser(description='Compare per-request overhead with and without the shared connection pool')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=8)
+    args = parser.parse_args()
+
+    server = start_stub_server()
+    new_connection = time_requests(requests.post, server.url, args.requests, args.threads)
+    pooled = time_requests(make_session(args.threads).post, server.url, args.requests, args.threads)
+    server.shutdown()
+    print("{:d} requests over {:d} threads".format(args.requests, args.threads))
+    print("  new connection per request: {:.3f} ms/request".format(new_connection * 1000))
+    print("  shared connection pool:     {:.3f} ms/request ({:.1f}x faster)".format(pooled * 1000, new_connection / pooled))
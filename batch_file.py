@@ -0,0 +1,147 @@
+# Offline batch mode, for large non-interactive sweeps (e.g. USC_knowledge.py over all 54 titles,
+# or thousands of synthetic queries): instead of sending requests one at a time, utils.py writes
+# them to a JSONL batch file in the provider's batch format, to be submitted as one batch job.
+# Running the script again with the job's results file answers those calls from it, and any new
+# calls (e.g. second-stage prompts built from first-stage responses) go into the next batch file.
+# So an experiment becomes: prepare (run the script), submit, ingest (run the script again),
+# repeating submit and ingest until nothing is pending.
+#
+# A call not answered by the results raises ResponsePending, which scripts catch to skip whatever
+# needed that response.  Requests are identified by a hash of their contents (custom_id), so the
+# same prompt is only requested once, and a request that failed in an earlier batch is requested
+# again in the next one.
+#
+# Off unless GPT_BATCH_FILE is set.  Settings, all from the environment:
+#   GPT_BATCH_FILE     the batch file that pending requests are appended to
+#   GPT_BATCH_RESULTS  results files of earlier batches, comma separated (later ones take precedence)
+#
+# "python batch_file.py fake BATCH RESULTS" stands in for the provider, to test an experiment end to end.
+
+import os, json, hashlib, threading, time
+
+URLS = {"completion": "/v1/completions", "chat": "/v1/chat/completions"}
+
+class ResponsePending(Exception):
+    pass
+
+lock = threading.Lock()
+loaded = {"results_files": None, "results": {}, "batch_file": None, "requested": set()}
+batch_metrics = {"answered": 0, "pending": 0, "written": 0}
+
+def is_enabled() -> bool:
+    return os.getenv("GPT_BATCH_FILE", "") != ""
+
+def get_results_filenames() -> list:
+    return [name for name in os.getenv("GPT_BATCH_RESULTS", "").split(",") if name != ""]
+
+def get_custom_id(key:str) -> str:
+    return "req-" + hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+
+def read_jsonl(filename:str) -> list:
+    rv = []
+    with open(filename, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip() != "":
+                rv.append(json.loads(line))
+    return rv
+
+# The response body for each custom_id that succeeded, or None for those that failed
+def load_results(filenames:list) -> dict:
+    rv = dict()
+    for filename in filenames:
+        for result in read_jsonl(filename):
+            response = result.get("response")
+            if result.get("error") is None and response is not None and response.get("status_code") == 200:
+                rv[result["custom_id"]] = response["body"]
+            elif rv.get(result["custom_id"]) is None: # an earlier success stands
+                rv[result["custom_id"]] = None
+    return rv
+
+# (Re)loads the results and the ids already in the batch file, if the settings changed; call holding lock
+def load_state():
+    results_files = get_results_filenames()
+    if loaded["results_files"] != results_files:
+        loaded["results"] = load_results(results_files)
+        loaded["results_files"] = results_files
+    batch_filename = os.getenv("GPT_BATCH_FILE")
+    if loaded["batch_file"] != batch_filename:
+        loaded["requested"] = set()
+        if os.path.exists(batch_filename):
+            loaded["requested"] = set([request["custom_id"] for request in read_jsonl(batch_filename)])
+        loaded["batch_file"] = batch_filename
+
+# Returns the response body for this request from the results, or else adds the request to the
+# batch file (unless already there) and raises ResponsePending.  key identifies the request, e.g.
+# utils.get_request_key(); body is the request body in the provider's format.
+def get_response(key:str, kind:str, body:dict) -> dict:
+    custom_id = get_custom_id(key)
+    with lock:
+        load_state()
+        response = loaded["results"].get(custom_id)
+        if response is not None:
+            batch_metrics["answered"] += 1
+            return response
+        batch_metrics["pending"] += 1
+        if not custom_id in loaded["requested"]:
+            request = {"custom_id": custom_id, "method": "POST", "url": URLS[kind], "body": body}
+            with open(loaded["batch_file"], "a", encoding="utf-8") as f:
+                f.write(json.dumps(request, ensure_ascii=False) + "\n")
+            loaded["requested"].add(custom_id)
+            batch_metrics["written"] += 1
+    raise ResponsePending(custom_id)
+
+def get_batch_report() -> str:
+    with lock:
+        return "batch: {:d} calls answered from results, {:d} pending; {:d} requests added to {:s}".format(
+            batch_metrics["answered"], batch_metrics["pending"], batch_metrics["written"], str(loaded["batch_file"]))
+
+# Stands in for the provider: writes a results file answering every request in the batch file.
+# answer(request) gives the response text; failed_ids are answered with errors instead.
+def fake_process(batch_filename:str, results_filename:str, answer=None, failed_ids=()):
+    if answer is None:
+        answer = lambda request: " No."
+    with open(results_filename, "w", encoding="utf-8") as f:
+        for num, request in enumerate(read_jsonl(batch_filename)):
+            result = {"id": "batch_req_" + str(num), "custom_id": request["custom_id"], "response": None, "error": None}
+            if request["custom_id"] in failed_ids:
+                result["response"] = {"status_code": 500, "request_id": "fake-" + str(num),
+                                      "body": {"error": {"message": "fake server error"}}}
+            else:
+                text = answer(request)
+                if request["url"] == URLS["chat"]:
+                    choice = {"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}
+                else:
+                    choice = {"index": 0, "text": text, "finish_reason": "stop"}
+                result["response"] = {"status_code": 200, "request_id": "fake-" + str(num),
+                                      "body": {"id": "fake-" + str(num), "created": int(time.time()),
+                                               "model": request["body"]["model"], "choices": [choice]}}
+            f.write(json.dumps(result, ensure_ascii=False) + "\n")
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Summarize a batch or results file, or answer a batch file locally')
+    parser.add_argument('command', choices=["summary", "fake"])
+    parser.add_argument('filename',
+                        help='the batch file (or, for summary, a results file)')
+    parser.add_argument('results_filename', nargs="?",
+                        help='for fake, the results file to write')
+    parser.add_argument('--answer', default=" No.",
+                        help='for fake, the response text given to every request')
+    args = parser.parse_args()
+
+    if args.command == "fake":
+        assert args.results_filename is not None, "fake needs a results filename"
+        fake_process(args.filename, args.results_filename, lambda request: args.answer)
+        print("wrote", args.results_filename)
+    else:
+        lines = read_jsonl(args.filename)
+        if len(lines) > 0 and "url" in lines[0]: # a batch file
+            counts = dict()
+            for request in lines:
+                name = request["url"] + " " + request["body"]["model"]
+                counts[name] = counts.get(name, 0) + 1
+            print(len(lines), "requests:", counts)
+        else:
+            results = load_results([args.filename])
+            num_ok = len([r for r in results.values() if not r is None])
+            print(len(lines), "results:", num_ok, "succeeded,", len(results) - num_ok, "failed")
@@ -0,0 +1,152 @@
+# Builds the compacted SARA statute artifacts probed by probe_statute_knowledge/SARA_knowledge.py,
+# and loads them back.  The statutes come either from sara_run/all_sara_statutes.txt or from the
+# U.S. Code XML for title 26.  Each statute is compacted and its title line ("§1. Tax imposed")
+# is stripped off.  The statutes are concatenated into one text file, and a manifest.json records
+# each statute's offset, length and hashes.  Probes mmap the text file and slice it, rather than
+# re-reading and re-slicing a file on every call.
+# Rebuilds are incremental: statutes whose source hash matches the manifest are reused as-is,
+# and nothing is rewritten if nothing changed.
+
+import argparse, hashlib, json, mmap, os, re
+from statute_text import usc_ns_str, get_IRC_text, compact_statute, parse_title
+
+SOURCE_FILE = "sara_run/all_sara_statutes.txt"
+ARTIFACT_DIRECTORY = "statutes_compacted"
+TEXT_FILENAME = "statutes.txt"
+MANIFEST_FILENAME = "manifest.json"
+SARA_SECTIONS = [1, 2, 63, 68, 151, 152, 3301, 3306, 7703]
+
+def hash_text(text:str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+# Splits all_sara_statutes.txt into a list of 3-tuples of (name, title line, source text)
+def split_sara_statutes(all_text:str) -> list:
+    rv = []
+    for chunk in re.split(r"\n(?=§)", all_text):
+        if len(chunk.strip()) == 0:
+            continue
+        assert chunk[0] == "§"
+        title_line = chunk[:chunk.find("\n")].strip()
+        section_num = title_line[1:title_line.find(".")]
+        rv.append(("section" + section_num, title_line, chunk))
+    return rv
+
+# Same 3-tuples, but taken from the U.S. Code XML of title 26 (one parse of the title)
+def get_usc_statutes(usc_directory:str, sections=SARA_SECTIONS) -> list:
+    root = parse_title(usc_directory + "/usc26.xml")
+    found = {}
+    for s in root.iter('{' + usc_ns_str + '}section'):
+        identifier = s.attrib.get("identifier", "")
+        if identifier.startswith("/us/usc/t26/s") and identifier[len("/us/usc/t26/s"):].isnumeric():
+            section_num = int(identifier[len("/us/usc/t26/s"):])
+            if section_num in sections and section_num not in found:
+                heading = s.find('{' + usc_ns_str + '}heading')
+                heading_text = "" if heading is None else "".join(heading.itertext()).strip()
+                title_line = "§" + str(section_num) + ". " + heading_text
+                found[section_num] = ("section" + str(section_num), title_line,
+                                      title_line + "\n" + get_IRC_text(s))
+    assert len(found) == len(sections), "Missing sections: " + str(set(sections) - set(found.keys()))
+    return [found[section_num] for section_num in sections]
+
+# The artifact text for one statute: compacted, with the title line cut off
+def compact_and_strip_title(source_text:str) -> str:
+    compacted = compact_statute(source_text)
+    assert compacted[0] == "§"
+    return compacted[compacted.find("\n") + 1:].strip()
+
+def load_manifest(directory=ARTIFACT_DIRECTORY) -> dict:
+    manifest_filename = os.path.join(directory, MANIFEST_FILENAME)
+    if not os.path.exists(manifest_filename):
+        return None
+    with open(manifest_filename, "r") as f:
+        return json.load(f)
+
+# Builds (or incrementally rebuilds) the artifacts from a list of (name, title line, source text).
+# Returns the manifest.
+def build_compacted_statutes(statutes:list, directory=ARTIFACT_DIRECTORY, verbose=True) -> dict:
+    old_manifest = load_manifest(directory)
+    old_text = b""
+    old_entries = {}
+    text_filename = os.path.join(directory, TEXT_FILENAME)
+    if old_manifest is not None and os.path.exists(text_filename):
+        with open(text_filename, "rb") as f:
+            old_text = f.read()
+        if hashlib.sha256(old_text).hexdigest() == old_manifest["text_sha256"]:
+            old_entries = {entry["name"]: entry for entry in old_manifest["statutes"]}
+
+    pieces = []
+    entries = []
+    offset = 0
+    num_reused = 0
+    for name, title_line, source_text in statutes:
+        source_sha256 = hash_text(source_text)
+        old_entry = old_entries.get(name)
+        if old_entry is not None and old_entry["source_sha256"] == source_sha256:
+            compacted = old_text[old_entry["offset"]:old_entry["offset"] + old_entry["length"]]
+            num_reused += 1
+        else:
+            compacted = compact_and_strip_title(source_text).encode("utf-8")
+            if verbose:
+                print("Compacted", name)
+        entries.append({"name": name, "title": title_line, "offset": offset, "length": len(compacted),
+                        "source_sha256": source_sha256, "sha256": hashlib.sha256(compacted).hexdigest()})
+        pieces.append(compacted)
+        pieces.append(b"\n\n") # keeps the text file readable; not part of any statute
+        offset += len(compacted) + 2
+
+    new_text = b"".join(pieces)
+    manifest = {"text_sha256": hashlib.sha256(new_text).hexdigest(), "statutes": entries}
+    if old_manifest == manifest:
+        if verbose:
+            print("Up to date;", num_reused, "statutes unchanged")
+        return manifest
+
+    os.makedirs(directory, exist_ok=True)
+    # write to temporary files and rename, so a probe with the old text mmap'ed is never disturbed
+    with open(text_filename + ".tmp", "wb") as f:
+        f.write(new_text)
+    os.replace(text_filename + ".tmp", text_filename)
+    manifest_filename = os.path.join(directory, MANIFEST_FILENAME)
+    with open(manifest_filename + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1, ensure_ascii=False)
+    os.replace(manifest_filename + ".tmp", manifest_filename)
+    if verbose:
+        print("Wrote", len(entries), "statutes to", directory + ";", num_reused, "unchanged")
+    return manifest
+
+# Read-only access to the artifacts through a single mmap of the text file
+class compacted_statutes:
+    def __init__(self, directory=ARTIFACT_DIRECTORY):
+        self.manifest = load_manifest(directory)
+        assert self.manifest is not None, "No artifacts in " + directory + "; run compacted_statutes.py first"
+        self.entries = {entry["name"]: entry for entry in self.manifest["statutes"]}
+        with open(os.path.join(directory, TEXT_FILENAME), "rb") as f:
+            self.text = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def names(self) -> list:
+        return [entry["name"] for entry in self.manifest["statutes"]]
+
+    def get_title(self, name:str) -> str:
+        return self.entries[name]["title"]
+
+    # The compacted statute, with the title line already stripped
+    def get_text(self, name:str) -> str:
+        entry = self.entries[name]
+        return self.text[entry["offset"]:entry["offset"] + entry["length"]].decode("utf-8")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build the compacted, title-stripped SARA statute artifacts')
+    parser.add_argument('--source', default=SOURCE_FILE,
+                        help='all_sara_statutes.txt-style file of statutes, each starting with its "§" title line')
+    parser.add_argument('--usc_directory', default=None,
+                        help='if given, take the SARA sections from this release of the U.S. Code XML instead')
+    parser.add_argument('--out', default=ARTIFACT_DIRECTORY,
+                        help='directory to write the artifacts to')
+    args = parser.parse_args()
+
+    if args.usc_directory is not None:
+        statutes = get_usc_statutes(args.usc_directory)
+    else:
+        with open(args.source, "r") as f:
+            statutes = split_sara_statutes(f.read())
+    build_compacted_statutes(statutes, args.out)
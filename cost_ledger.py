@@ -0,0 +1,244 @@
+# Ledger of the tokens and dollars spent on API calls, so a runaway configuration (say max_tokens=3000
+# recitations of 540 sections in probe_text_recitation.py) shows up before the invoice does.
+# With GPT_LEDGER set to a SQLite file (e.g. gpt_ledger.db), utils.py records there the usage the API
+# reports for every request it sends (including hedged duplicates, which are billed too), with the
+# engine, script and experiment.
+# "python cost_ledger.py report --by engine" (or script, experiment, day) totals it up.
+#
+# Budgets (these need the ledger): with GPT_BUDGET_DOLLARS and/or GPT_BUDGET_TOKENS set, a call
+# that could take the experiment (over all its runs in the ledger) past the budget, counting its
+# prompt and max_tokens, raises budget_exceeded instead of being sent.  If the run also declares GPT_PLANNED_CALLS, the
+# projected spend (spent so far, plus the remaining calls at this run's average cost) is printed
+# before the first call, and while the projection exceeds the budget, calls are spaced out by
+# GPT_BUDGET_SLOW_SECONDS, so there is time to stop the run before it reaches the budget.
+#
+# Dry runs: with GPT_DRY_RUN=1, utils.py sends nothing; each call adds its estimated cost (prompt
+# tokens counted from the prompt, completion tokens at most max_tokens) and raises ResponsePending,
+# which the scripts catch as in batch mode.  So the estimate covers the calls whose prompts do not
+# depend on earlier responses; calls depending on them are not made.  "python cost_ledger.py
+# estimate BATCHFILE" estimates a batch file (see batch_file.py) the same way.
+#
+# Settings, all from the environment:
+#   GPT_LEDGER               the ledger database (default none: the run's usage is only printed at exit)
+#   GPT_EXPERIMENT           the experiment to charge calls to (default the script's name)
+#   GPT_BUDGET_DOLLARS       budget for the experiment, in dollars
+#   GPT_BUDGET_TOKENS        budget for the experiment, in tokens (prompt plus completion)
+#   GPT_PLANNED_CALLS        how many calls this run expects to make, for the projection
+#   GPT_BUDGET_SLOW_SECONDS  seconds between calls while the projection exceeds the budget (default 5)
+#   GPT_DRY_RUN              set to 1 to estimate instead of sending
+
+import os, sys, time, sqlite3, threading
+import rate_limit
+try:
+    import tiktoken # exact token counts, if installed
+except ImportError:
+    tiktoken = None
+
+# Dollars per 1,000 tokens, as (prompt, completion), at list prices when these engines were in use
+PRICES = {"text-davinci-003": (0.02, 0.02),
+          "text-davinci-002": (0.02, 0.02),
+          "gpt-3.5-turbo": (0.0015, 0.002),
+          "gpt-4": (0.03, 0.06),
+          "gpt-4-0314": (0.03, 0.06),
+          "gpt-4-32k": (0.06, 0.12)}
+
+class budget_exceeded(Exception):
+    pass
+
+lock = threading.Lock()
+ledger = {"db": None, "filename": None}
+run_metrics = {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost": 0.0,
+               "estimated_calls": 0, "estimated_prompt_tokens": 0, "estimated_max_tokens": 0,
+               "estimated_cost": 0.0, "slowed": 0, "warned": False, "last_call": 0.0}
+
+def get_filename() -> str:
+    return os.getenv("GPT_LEDGER", "")
+
+def is_enabled() -> bool:
+    return get_filename().lower() not in ["", "none"]
+
+def is_dry_run() -> bool:
+    return os.getenv("GPT_DRY_RUN", "") not in ["", "0"]
+
+def get_script() -> str:
+    return os.path.basename(sys.argv[0]) if len(sys.argv) > 0 and sys.argv[0] != "" else "interactive"
+
+def get_experiment() -> str:
+    return os.getenv("GPT_EXPERIMENT", get_script())
+
+def get_budget(name:str):
+    return rate_limit.get_setting(name)
+
+# (Re)opens the ledger if the setting changed; call holding lock
+def get_db() -> sqlite3.Connection:
+    if ledger["filename"] != get_filename():
+        ledger["db"] = sqlite3.connect(get_filename(), timeout=60, check_same_thread=False)
+        ledger["db"].execute("CREATE TABLE IF NOT EXISTS calls (time REAL, experiment TEXT, script TEXT, engine TEXT, "
+                             "prompt_tokens INTEGER, completion_tokens INTEGER, cost REAL)")
+        ledger["db"].execute("CREATE INDEX IF NOT EXISTS calls_experiment ON calls (experiment)")
+        ledger["db"].commit()
+        ledger["filename"] = get_filename()
+    return ledger["db"]
+
+def count_tokens(text:str, engine:str) -> int:
+    if tiktoken is not None:
+        try:
+            return len(tiktoken.encoding_for_model(engine).encode(text))
+        except KeyError: # an engine tiktoken does not know
+            pass
+    return rate_limit.estimate_tokens(text, 0)
+
+# Prompt tokens for a completion (prompt) or chat (messages) request body
+def count_prompt_tokens(body:dict) -> int:
+    if "messages" in body:
+        return sum([count_tokens(message["content"], body["model"]) + 4 for message in body["messages"]]) # 4 for the role etc.
+    return count_tokens(body["prompt"], body["model"])
+
+# Dollars for this usage, or None if there is no price for the engine
+def get_cost(engine:str, prompt_tokens:int, completion_tokens:int):
+    if not engine in PRICES:
+        return None
+    prompt_price, completion_price = PRICES[engine]
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+
+# Returns (dollars, tokens) charged to the experiment so far, over all runs; call holding lock
+def get_spent(experiment:str) -> tuple:
+    dollars, tokens = get_db().execute("SELECT SUM(cost), SUM(prompt_tokens + completion_tokens) FROM calls "
+                                       "WHERE experiment = ?", (experiment,)).fetchone()
+    return (dollars or 0.0), (tokens or 0)
+
+# Projected (dollars, tokens) for the experiment once this run has made all GPT_PLANNED_CALLS calls,
+# or None if the run did not declare them.  worst is (dollars, tokens) for a call not yet made.
+def get_projection(spent:tuple, worst:tuple):
+    planned = rate_limit.get_setting("GPT_PLANNED_CALLS")
+    if planned is None:
+        return None
+    remaining = max(0, planned - run_metrics["calls"])
+    if run_metrics["calls"] > 0:
+        per_call = (run_metrics["cost"] / run_metrics["calls"],
+                    (run_metrics["prompt_tokens"] + run_metrics["completion_tokens"]) / run_metrics["calls"])
+    else:
+        per_call = worst
+    return spent[0] + remaining * per_call[0], spent[1] + remaining * per_call[1]
+
+def over_budget(dollars:float, tokens:float) -> bool:
+    budget_dollars = get_budget("GPT_BUDGET_DOLLARS")
+    budget_tokens = get_budget("GPT_BUDGET_TOKENS")
+    return (budget_dollars is not None and dollars > budget_dollars) or \
+           (budget_tokens is not None and tokens > budget_tokens)
+
+# Called by utils.py before sending a request: raises budget_exceeded if the request could take
+# the experiment past its budget, and waits if the projected spend exceeds it
+def check(body:dict, max_tokens:int):
+    if get_budget("GPT_BUDGET_DOLLARS") is None and get_budget("GPT_BUDGET_TOKENS") is None:
+        return
+    assert is_enabled(), "A budget needs GPT_LEDGER, to count what the experiment has spent"
+    prompt_tokens = count_prompt_tokens(body)
+    worst_cost = get_cost(body["model"], prompt_tokens, max_tokens) or 0.0
+    worst = (worst_cost, prompt_tokens + max_tokens)
+    with lock:
+        spent = get_spent(get_experiment())
+        if over_budget(spent[0] + worst[0], spent[1] + worst[1]):
+            raise budget_exceeded("Experiment " + get_experiment() + " has spent ${:.2f} and {:d} tokens, ".format(*spent) +
+                                  "so this call (up to ${:.4f}, {:d} tokens) could go over budget".format(*worst))
+        projection = get_projection(spent, worst)
+        if projection is not None and not run_metrics["warned"]:
+            run_metrics["warned"] = True
+            print("ledger: projected spend for experiment", get_experiment(),
+                  "${:.2f}, {:.0f} tokens".format(*projection))
+        wait = 0
+        if projection is not None and over_budget(*projection):
+            run_metrics["slowed"] += 1
+            if run_metrics["slowed"] == 1:
+                print("ledger: projected spend is over budget, so slowing down; stop the run to stay under it")
+            # the next slot, so calls from several threads are spaced out too
+            run_metrics["last_call"] = max(time.time(), run_metrics["last_call"] + float(os.getenv("GPT_BUDGET_SLOW_SECONDS", "5")))
+            wait = run_metrics["last_call"] - time.time()
+    if wait > 0:
+        time.sleep(wait)
+
+# Called by utils.py with each response received from the API, to record its usage
+def record(engine:str, response):
+    usage = response.get("usage") if hasattr(response, "get") else None
+    if usage is None:
+        return
+    prompt_tokens, completion_tokens = usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+    cost = get_cost(engine, prompt_tokens, completion_tokens)
+    with lock:
+        run_metrics["calls"] += 1
+        run_metrics["prompt_tokens"] += prompt_tokens
+        run_metrics["completion_tokens"] += completion_tokens
+        run_metrics["cost"] += cost or 0.0
+        if is_enabled():
+            db = get_db()
+            db.execute("INSERT INTO calls VALUES (?, ?, ?, ?, ?, ?, ?)",
+                       (time.time(), get_experiment(), get_script(), engine, prompt_tokens, completion_tokens, cost))
+            db.commit()
+
+# Adds a request to the dry-run estimate, at worst case for the completion
+def add_estimate(body:dict, max_tokens:int):
+    prompt_tokens = count_prompt_tokens(body)
+    with lock:
+        run_metrics["estimated_calls"] += 1
+        run_metrics["estimated_prompt_tokens"] += prompt_tokens
+        run_metrics["estimated_max_tokens"] += max_tokens
+        run_metrics["estimated_cost"] += get_cost(body["model"], prompt_tokens, max_tokens) or 0.0
+
+def get_ledger_report() -> str:
+    with lock:
+        if run_metrics["estimated_calls"] > 0:
+            return "ledger: dry run of {:d} calls: {:d} prompt tokens, up to {:d} completion tokens, up to ${:.2f}".format(
+                run_metrics["estimated_calls"], run_metrics["estimated_prompt_tokens"],
+                run_metrics["estimated_max_tokens"], run_metrics["estimated_cost"])
+        rv = "ledger: {:d} calls: {:d} prompt + {:d} completion tokens, ${:.2f}".format(
+            run_metrics["calls"], run_metrics["prompt_tokens"], run_metrics["completion_tokens"], run_metrics["cost"])
+        if is_enabled():
+            rv += "; experiment " + get_experiment() + " total ${:.2f}, {:d} tokens".format(*get_spent(get_experiment()))
+        if run_metrics["slowed"] > 0:
+            rv += "; {:d} calls slowed down as over budget".format(run_metrics["slowed"])
+        return rv
+
+# Totals from the ledger, as a list of (group, calls, prompt tokens, completion tokens, dollars)
+def get_totals(filename:str, by:str, since=None) -> list:
+    group = {"engine": "engine", "script": "script", "experiment": "experiment",
+             "day": "date(time, 'unixepoch', 'localtime')"}[by]
+    db = sqlite3.connect(filename, timeout=60)
+    rows = db.execute("SELECT " + group + ", COUNT(*), SUM(prompt_tokens), SUM(completion_tokens), SUM(cost) "
+                      "FROM calls WHERE time >= ? GROUP BY 1 ORDER BY 5 DESC",
+                      (since if since is not None else 0,)).fetchall()
+    db.close()
+    return rows
+
+if __name__ == "__main__":
+    import argparse
+    import batch_file
+    parser = argparse.ArgumentParser(description='Report spending from the ledger, or estimate the cost of a batch file')
+    parser.add_argument('command', choices=["report", "estimate"])
+    parser.add_argument('filename', nargs="?", default=None,
+                        help='for report, the ledger (default GPT_LEDGER); for estimate, the batch file')
+    parser.add_argument('--by', default="experiment", choices=["engine", "script", "experiment", "day"])
+    parser.add_argument('--days', type=float, default=None,
+                        help='for report, only the last this many days')
+    args = parser.parse_args()
+
+    if args.command == "report":
+        assert args.filename is not None or is_enabled(), "report needs a ledger, or GPT_LEDGER set"
+        since = time.time() - args.days * 24 * 3600 if args.days is not None else None
+        print("{:40s} {:>8s} {:>12s} {:>12s} {:>10s}".format(args.by, "calls", "prompt", "completion", "dollars"))
+        for name, calls, prompt_tokens, completion_tokens, cost in get_totals(args.filename or get_filename(), args.by, since):
+            print("{:40s} {:8d} {:12d} {:12d} {:10.2f}".format(str(name), calls, prompt_tokens, completion_tokens, cost or 0.0))
+    else:
+        assert args.filename is not None, "estimate needs a batch file"
+        by_engine = dict()
+        for request in batch_file.read_jsonl(args.filename):
+            body = request["body"]
+            max_tokens = body.get("max_tokens") or 0 # gpt-4 requests may leave it to the provider
+            estimate = by_engine.setdefault(body["model"], [0, 0, 0, 0.0])
+            prompt_tokens = count_prompt_tokens(body)
+            estimate[0] += 1
+            estimate[1] += prompt_tokens
+            estimate[2] += max_tokens
+            estimate[3] += get_cost(body["model"], prompt_tokens, max_tokens) or 0.0
+        for engine, (calls, prompt_tokens, max_tokens, cost) in by_engine.items():
+            print(engine + ":", calls, "calls,", prompt_tokens, "prompt tokens, up to", max_tokens,
+                  "completion tokens, up to ${:.2f}".format(cost) + ("" if engine in PRICES else " (no price for this engine)"))
@@ -0,0 +1,450 @@
+# Compressed, indexed archive of the records in gpt3_log.txt, so that the response to a given
+# prompt can be found without scanning gigabytes of text.
+#
+# The archive (e.g. gpt3_log.logz) is a sequence of blocks, each holding about BLOCK_SIZE bytes of
+# records as JSON lines, compressed with a dictionary trained on the first records (statute text
+# repeats heavily across prompts, so even small blocks compress well).  The codec is zstandard if
+# it is installed, otherwise zlib with a preset dictionary.  Each block is preceded by its
+# length, so the blocks can be streamed in order, decompressing one at a time.
+# A side index (gpt3_log.logz.idx, SQLite) has, for every record, its block's offset and length
+# and its place in the block, keyed by prompt hash, case id, timestamp and engine, so any record
+# can be fetched with one seek.  The index also holds the codec and the dictionary.
+#
+# "python log_archive.py convert gpt3_log.txt gpt3_log.logz" adds the records from the log that
+# are not yet in the archive (it remembers how far it got), so it can be rerun as the log grows.
+# Setting GPT_LOG_ARCHIVE makes utils.py also add every record to that archive as it is logged.
+# convert skips those records when it reaches them in the log, so they are not archived twice.
+
+import os, re, json, zlib, struct, sqlite3, hashlib, threading
+from datetime import datetime
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+RECORD_SEPARATOR = "************************"
+PROMPT_SEPARATOR = "------- (prompt above/response below)"
+FEWER_TOKENS = "Trying 50 fewer tokens" # written by utils.call_gpt_raw() just before the response
+LOG_TIME_FORMAT = "%A %d-%B-%Y %H:%M:%S"
+COMMENT_MARKER = "  COMMENT:"
+BLOCK_SIZE = 1 << 16 # uncompressed bytes of records per block
+DICTIONARY_SIZE = 1 << 15 # zlib uses at most 32KB of preset dictionary
+NUM_SAMPLES = 2000 # records used to train the dictionary
+BLOCK_HEADER = struct.Struct(">I") # length of the compressed block that follows
+
+# Comments identifying what the following calls are about, as written by the experiment scripts.
+# A case id holds for the following records until another one, or any other comment naming a
+# script (e.g. "START call_gpt_with_sara.py" or "Synthetic applies probe in ..."), appears.
+CASE_ID_PATTERNS = [(re.compile(r"^Doing case id=(\S+)"), "{0}"), # call_gpt_with_sara.py
+                    (re.compile(r"^Seeing if GPT3 can id the text of (\d+) USC sec (\d+)"), "{0} USC {1}"), # USC_knowledge.py
+                    (re.compile(r"^probe GPT3 knowledge of SARA (\S+)"), "SARA {0}")] # SARA_knowledge.py
+HEADER_PATTERN = re.compile(r"engine=(\S+) temp=(\S+) max_tokens=(\S+) top_p=(\S+) freq_pen=(\S+) pres_pen=(\S+)")
+
+def hash_prompt(prompt:str) -> str:
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:32]
+
+def to_iso(timestamp:str) -> str:
+    try:
+        return datetime.strptime(timestamp, LOG_TIME_FORMAT).isoformat()
+    except ValueError:
+        return None
+
+# Turns the lines of gpt3_log.txt into records, one line at a time (see utils.call_gpt3_withlogging()).
+# Each record is a dict with the prompt, response, engine and parameters, timestamp (as in the
+# log, and ISO), the comments since the previous record, the case id, and the number of
+# "Trying 50 fewer tokens" retries.
+class log_parser:
+    def __init__(self, case_id=None):
+        self.state = "between" # or "header", "params", "prompt", "response"
+        self.comments = []
+        self.case_id = case_id # carried over from before where parsing starts
+        self.record = None
+        self.lines = []
+
+    # Returns the record this line completes, or None
+    def feed(self, line:str):
+        line = line.rstrip("\n")
+        if self.state == "between":
+            if line == RECORD_SEPARATOR:
+                self.record = {"timestamp": None, "engine": None, "params": {}, "comments": self.comments}
+                self.comments = []
+                self.state = "header"
+            elif COMMENT_MARKER in line:
+                comment = line[line.index(COMMENT_MARKER) + len(COMMENT_MARKER):]
+                self.comments.append(comment)
+                if ".py" in comment:
+                    self.case_id = None
+                for pattern, case_format in CASE_ID_PATTERNS:
+                    match = pattern.search(comment)
+                    if match is not None:
+                        self.case_id = case_format.format(*match.groups())
+        elif self.state == "header":
+            self.record["timestamp"] = line
+            self.state = "params"
+        elif self.state == "params":
+            match = HEADER_PATTERN.match(line)
+            assert match is not None, "Unexpected log header: " + line
+            self.record["engine"] = match[1]
+            self.record["params"] = {"temperature": float(match[2]), "max_tokens": int(match[3]), "top_p": float(match[4]),
+                                     "frequency_penalty": float(match[5]), "presence_penalty": float(match[6])}
+            self.state = "prompt"
+        elif self.state == "prompt":
+            if line == PROMPT_SEPARATOR:
+                self.record["prompt"] = "\n".join(self.lines)
+                self.lines = []
+                self.state = "response"
+            else:
+                self.lines.append(line)
+        elif self.state == "response":
+            if line == RECORD_SEPARATOR:
+                response = "\n".join(self.lines)
+                retries = 0
+                while response.startswith(FEWER_TOKENS):
+                    response = response[len(FEWER_TOKENS):]
+                    retries += 1
+                record = self.record
+                record["response"] = response
+                record["retries"] = retries
+                record["case_id"] = self.case_id
+                record["time"] = to_iso(record["timestamp"])
+                self.record = None
+                self.lines = []
+                self.state = "between"
+                return record
+            self.lines.append(line)
+        return None
+
+# Streams the records of a log written by utils.py, with the byte offset just past each
+# record, starting from byte offset start (which should be just past an earlier record,
+# whose case id is case_id)
+def parse_log(filename:str, start=0, case_id=None):
+    parser = log_parser(case_id)
+    with open(filename, "rb") as f:
+        f.seek(start)
+        offset = start
+        for line in f:
+            offset += len(line)
+            record = parser.feed(line.decode("utf-8", errors="replace"))
+            if record is not None:
+                yield record, offset
+
+# Picks the lines of prompts and responses that recur most across the records, weighted by length,
+# for zlib's preset dictionary.  They are escaped as in the JSON of the blocks.  zlib finds the end
+# of the dictionary the quickest, so the most useful lines go last.
+def train_zlib_dictionary(records:list, size=DICTIONARY_SIZE) -> bytes:
+    counts = dict()
+    for record in records:
+        for line in set(record["prompt"].split("\n") + record["response"].split("\n")):
+            if len(line) >= 8:
+                counts[line] = counts.get(line, 0) + 1
+    lines = sorted([line for line in counts.keys() if counts[line] > 1], key=lambda l: counts[l] * len(l), reverse=True)
+    chosen = []
+    total = 0
+    for line in lines:
+        escaped = json.dumps(line, ensure_ascii=False)[1:-1].encode("utf-8") + b"\\n"
+        if total + len(escaped) > size:
+            continue
+        chosen.append(escaped)
+        total += len(escaped)
+    return b"".join(reversed(chosen))
+
+def train_dictionary(codec:str, records:list) -> bytes:
+    records = records[:NUM_SAMPLES]
+    if codec == "zstd":
+        samples = [json.dumps(r, ensure_ascii=False).encode("utf-8") for r in records]
+        try:
+            return zstandard.train_dictionary(DICTIONARY_SIZE * 2, samples).as_bytes()
+        except zstandard.ZstdError: # too few samples to train on
+            return b""
+    return train_zlib_dictionary(records)
+
+class block_codec:
+    def __init__(self, codec:str, dictionary:bytes):
+        assert codec in ["zlib", "zstd"], "not implemented"
+        assert codec != "zstd" or zstandard is not None, "this archive needs the zstandard package"
+        self.codec = codec
+        self.dictionary = dictionary
+        if codec == "zstd":
+            zdict = zstandard.ZstdCompressionDict(dictionary) if len(dictionary) > 0 else None
+            self.compressor = zstandard.ZstdCompressor(level=10, dict_data=zdict)
+            self.decompressor = zstandard.ZstdDecompressor(dict_data=zdict)
+
+    def compress(self, data:bytes) -> bytes:
+        if self.codec == "zstd":
+            return self.compressor.compress(data)
+        compressor = zlib.compressobj(9, zdict=self.dictionary)
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data:bytes) -> bytes:
+        if self.codec == "zstd":
+            return self.decompressor.decompress(data)
+        decompressor = zlib.decompressobj(zdict=self.dictionary)
+        return decompressor.decompress(data) + decompressor.flush()
+
+def get_index_filename(filename:str) -> str:
+    return filename + ".idx"
+
+def open_index(filename:str) -> sqlite3.Connection:
+    db = sqlite3.connect(get_index_filename(filename), timeout=60, check_same_thread=False)
+    db.execute("CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value BLOB)")
+    db.execute("CREATE TABLE IF NOT EXISTS records (num INTEGER PRIMARY KEY, block_offset INTEGER, block_length INTEGER, "
+               "position INTEGER, prompt_hash TEXT, case_id TEXT, time TEXT, engine TEXT)")
+    for column in ["prompt_hash", "case_id", "time", "engine"]:
+        db.execute("CREATE INDEX IF NOT EXISTS records_" + column + " ON records (" + column + ")")
+    # records added as they were logged, and not yet matched to the log by convert()
+    db.execute("CREATE TABLE IF NOT EXISTS live_records (num INTEGER PRIMARY KEY)")
+    db.commit()
+    return db
+
+def get_setting(db:sqlite3.Connection, name:str, default=None):
+    row = db.execute("SELECT value FROM settings WHERE name = ?", (name,)).fetchone()
+    return default if row is None else row[0]
+
+def load_codec(db:sqlite3.Connection) -> block_codec:
+    codec = get_setting(db, "codec")
+    return None if codec is None else block_codec(codec, get_setting(db, "dictionary"))
+
+# Adds records to an archive, a block at a time; call close() at the end.  Several processes can
+# add to the same archive.  samples are records to train the dictionary on, if the archive is new
+# (otherwise it is trained on the first block).  live is for records added as they are logged,
+# which a later convert() of the same log then skips.
+class archive_writer:
+    def __init__(self, filename:str, samples=None, live=False):
+        self.filename = filename
+        self.live = live
+        self.db = open_index(filename)
+        self.codec = load_codec(self.db)
+        self.samples = samples
+        self.lines = [] # for the block being filled
+        self.size = 0
+        self.progress = None # (name, value) of a setting saved along with the block
+        self.lock = threading.Lock()
+
+    # progress, if given, is a setting (name, value) to save once this record is written
+    def add(self, record:dict, progress=None):
+        with self.lock:
+            line = json.dumps(record, ensure_ascii=False)
+            self.lines.append((record, line))
+            self.size += len(line)
+            self.progress = progress
+            if self.size >= BLOCK_SIZE:
+                self.write_block()
+
+    def flush(self):
+        with self.lock:
+            self.write_block()
+
+    # Call holding self.lock
+    def write_block(self):
+        if len(self.lines) == 0:
+            if self.progress is not None: # e.g. convert() skipped records already archived
+                self.db.execute("INSERT OR REPLACE INTO settings VALUES (?, ?)", self.progress)
+                self.db.commit()
+                self.progress = None
+            return
+        if self.codec is None:
+            codec = "zstd" if zstandard is not None else "zlib"
+            samples = self.samples if self.samples is not None else [record for record, _ in self.lines]
+            self.db.execute("INSERT OR IGNORE INTO settings VALUES ('codec', ?)", (codec,))
+            self.db.execute("INSERT OR IGNORE INTO settings VALUES ('dictionary', ?)", (train_dictionary(codec, samples),))
+            self.db.commit()
+            self.codec = load_codec(self.db) # another process may have got there first
+        with open(self.filename, "ab") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                self.db.execute("BEGIN IMMEDIATE")
+                row = self.db.execute("SELECT MAX(num), MAX(block_offset + block_length) FROM records").fetchone()
+                first_num = 0 if row[0] is None else row[0] + 1
+                offset = 0 if row[1] is None else row[1]
+                f.truncate(offset) # drops any partial block left by a crash
+                lines = []
+                for position, (record, line) in enumerate(self.lines):
+                    record["num"] = first_num + position
+                    lines.append(json.dumps(record, ensure_ascii=False))
+                data = self.codec.compress("\n".join(lines).encode("utf-8"))
+                f.write(BLOCK_HEADER.pack(len(data)) + data)
+                f.flush()
+                block_length = BLOCK_HEADER.size + len(data)
+                self.db.executemany("INSERT INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                    [(record["num"], offset, block_length, position, hash_prompt(record["prompt"]),
+                                      record.get("case_id"), record.get("time"), record.get("engine"))
+                                     for position, (record, _) in enumerate(self.lines)])
+                if self.live:
+                    self.db.executemany("INSERT INTO live_records VALUES (?)", [(record["num"],) for record, _ in self.lines])
+                if self.progress is not None:
+                    self.db.execute("INSERT OR REPLACE INTO settings VALUES (?, ?)", self.progress)
+                self.db.commit()
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+        self.lines = []
+        self.size = 0
+        self.progress = None
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+# Reads an archive: any record by number or by the index keys with one seek, or all of them in order
+class archive_reader:
+    def __init__(self, filename:str):
+        assert os.path.exists(get_index_filename(filename)), "No index for " + filename
+        self.filename = filename
+        self.db = open_index(filename)
+        self.codec = load_codec(self.db)
+        self.file = open(filename, "rb")
+        self.cached_block = (None, None) # (offset, records) of the last block read
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+
+    def read_block(self, offset:int, length:int) -> list:
+        with self.lock:
+            if self.cached_block[0] != offset:
+                self.file.seek(offset)
+                data = self.file.read(length)
+                self.cached_block = (offset, self.codec.decompress(data[BLOCK_HEADER.size:]).decode("utf-8").split("\n"))
+            return self.cached_block[1]
+
+    def get(self, num:int) -> dict:
+        row = self.db.execute("SELECT block_offset, block_length, position FROM records WHERE num = ?", (num,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(self.read_block(row[0], row[1])[row[2]])
+
+    # Records matching all the given keys, in order; start and end bound the ISO time, inclusive.
+    # Matching prompts are compared in full, not just by hash.
+    def find(self, prompt=None, case_id=None, engine=None, start=None, end=None) -> list:
+        conditions = []
+        values = []
+        for column, value in [("prompt_hash", None if prompt is None else hash_prompt(prompt)),
+                              ("case_id", case_id), ("engine", engine)]:
+            if value is not None:
+                conditions.append(column + " = ?")
+                values.append(value)
+        if start is not None:
+            conditions.append("time >= ?")
+            values.append(start)
+        if end is not None:
+            conditions.append("time <= ?")
+            values.append(end)
+        query = "SELECT num FROM records"
+        if len(conditions) > 0:
+            query += " WHERE " + " AND ".join(conditions)
+        rv = []
+        for (num,) in self.db.execute(query + " ORDER BY num", values).fetchall():
+            record = self.get(num)
+            if prompt is None or record["prompt"] == prompt:
+                rv.append(record)
+        return rv
+
+    # Streams every record in order, one block at a time
+    def __iter__(self):
+        with open(self.filename, "rb") as f:
+            while True:
+                header = f.read(BLOCK_HEADER.size)
+                if len(header) < BLOCK_HEADER.size:
+                    return
+                data = f.read(BLOCK_HEADER.unpack(header)[0])
+                if len(data) < BLOCK_HEADER.unpack(header)[0]: # a block still being written
+                    return
+                for line in self.codec.decompress(data).decode("utf-8").split("\n"):
+                    yield json.loads(line)
+
+    def close(self):
+        self.file.close()
+        self.db.close()
+
+# Whether two records are of the same call; the comments and case id are left out, since a
+# process archiving its own calls as it goes (utils.py with GPT_LOG_ARCHIVE) only sees its own comments
+def is_same_call(a:dict, b:dict) -> bool:
+    return all([a[key] == b[key] for key in ["time", "engine", "params", "prompt", "response", "retries"]])
+
+# Adds the records of the text log that are not yet in the archive; returns how many were added.
+# Records already archived as they were logged (see utils.py) are matched by content and skipped;
+# each of those matches at most one record of the log, so repeated identical calls are all kept.
+def convert(log_filename:str, archive_filename:str) -> int:
+    setting_name = "converted:" + os.path.abspath(log_filename)
+    db = open_index(archive_filename)
+    start, case_id = json.loads(get_setting(db, setting_name, "[0, null]")) # how far the last conversion got
+    live = set([num for num, in db.execute("SELECT num FROM live_records")])
+    db.close()
+    if os.path.getsize(log_filename) < start: # the log was replaced, e.g. rotated
+        start, case_id = 0, None
+    samples = []
+    for record, _ in parse_log(log_filename, start, case_id):
+        samples.append(record)
+        if len(samples) >= NUM_SAMPLES:
+            break
+    writer = archive_writer(archive_filename, samples)
+    reader = archive_reader(archive_filename) if len(live) > 0 else None
+    matched = [] # nums of the live records matched to a record of the log
+    num_added = 0
+    for record, offset in parse_log(log_filename, start, case_id):
+        progress = (setting_name, json.dumps([offset, record["case_id"]]))
+        archived = []
+        if reader is not None:
+            archived = [r for r in reader.find(prompt=record["prompt"], engine=record["engine"],
+                                               start=record["time"], end=record["time"])
+                        if r["num"] in live and is_same_call(r, record)]
+        if len(archived) > 0:
+            live.remove(archived[0]["num"])
+            matched.append(archived[0]["num"])
+            writer.progress = progress # saved with the next block written
+            continue
+        writer.add(record, progress)
+        num_added += 1
+    if reader is not None:
+        reader.close()
+    writer.close()
+    if len(matched) > 0:
+        db = open_index(archive_filename)
+        db.executemany("DELETE FROM live_records WHERE num = ?", [(num,) for num in matched])
+        db.commit()
+        db.close()
+    return num_added
+
+if __name__ == "__main__":
+    import argparse, time
+    parser = argparse.ArgumentParser(description='Convert gpt3_log.txt to a compressed, indexed archive, or look records up in one')
+    parser.add_argument('command', choices=["convert", "find", "stats"])
+    parser.add_argument('archive',
+                        help='the archive, e.g. gpt3_log.logz (its index is the same name plus .idx)')
+    parser.add_argument('--log', default="gpt3_log.txt",
+                        help='for convert, the log written by utils.py')
+    parser.add_argument('--prompt_file', default=None,
+                        help='for find, a file holding the exact prompt')
+    parser.add_argument('--case_id', default=None)
+    parser.add_argument('--engine', default=None)
+    parser.add_argument('--start', default=None,
+                        help='for find, earliest time, e.g. 2023-02-01T00:00:00')
+    parser.add_argument('--end', default=None)
+    args = parser.parse_args()
+
+    if args.command == "convert":
+        start_time = time.time()
+        num_added = convert(args.log, args.archive)
+        print("added", num_added, "records in {:.1f}s".format(time.time() - start_time))
+    if args.command in ["convert", "stats"]:
+        reader = archive_reader(args.archive)
+        archive_size = os.path.getsize(args.archive) + os.path.getsize(get_index_filename(args.archive))
+        print(len(reader), "records;", reader.codec.codec, "with a", len(reader.codec.dictionary), "byte dictionary;",
+              "{:.1f} MB including the index".format(archive_size / 1e6))
+    else:
+        prompt = None
+        if args.prompt_file is not None:
+            with open(args.prompt_file, "r") as f:
+                prompt = f.read()
+        reader = archive_reader(args.archive)
+        for record in reader.find(prompt, args.case_id, args.engine, args.start, args.end):
+            print(RECORD_SEPARATOR)
+            print("#" + str(record["num"]), record["timestamp"], record["engine"], record["params"], "case id:", record["case_id"])
+            print(record["prompt"])
+            print(PROMPT_SEPARATOR)
+            print(record["response"])
@@ -0,0 +1,133 @@
+# Small framework for running an experiment as a DAG of stages (e.g. load corpus -> build prompts ->
+# call model -> classify -> aggregate), so that changing one step only re-executes what depends on it.
+#
+# Each stage is a function of the outputs of the stages it takes as inputs (plus fixed params).
+# Its output is pickled into the cache directory under a key hashing the stage's code (its source,
+# and that of any helper functions listed in code), its params, and the *contents* of its inputs.
+# So a stage is recomputed only if its code or params changed or an input's contents changed;
+# if an upstream stage reruns but gives the same output, everything downstream stays cached.
+# A stage that reads files (e.g. one loading the corpus) lists them in files, and the key also
+# covers their sizes and modification times (for a directory, those of all the files under it).
+# Stages whose inputs are ready run in parallel, in threads (model calls spend their time waiting).
+#
+# A stage can return uncached(output) to pass the output on without caching it, e.g. when some
+# responses are still pending in batch mode (see batch_file.py).
+
+import os, json, pickle, hashlib, inspect, threading, time
+from concurrent import futures
+
+CACHE_DIRECTORY = "pipeline_cache"
+
+class uncached:
+    def __init__(self, value):
+        self.value = value
+
+class stage:
+    def __init__(self, name:str, func, inputs=(), params=None, code=(), files=()):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.params = params if params is not None else {}
+        self.code = list(code)
+        self.files = list(files)
+
+    def get_code_hash(self) -> str:
+        rv = hashlib.sha256()
+        for func in [self.func] + self.code:
+            rv.update(inspect.getsource(func).encode("utf-8"))
+        return rv.hexdigest()
+
+    # (path, size, modification time) of each file read, so that changing one reruns the stage
+    def get_file_states(self) -> list:
+        rv = []
+        for path in self.files:
+            if os.path.isdir(path):
+                for directory, _, filenames in sorted(os.walk(path)):
+                    rv.extend([get_file_state(os.path.join(directory, filename)) for filename in sorted(filenames)])
+            else:
+                rv.append(get_file_state(path))
+        return rv
+
+def get_file_state(path:str) -> list:
+    if not os.path.exists(path):
+        return [path, None, None]
+    stat = os.stat(path)
+    return [path, stat.st_size, stat.st_mtime_ns]
+
+class pipeline:
+    def __init__(self, name:str, cache_directory=CACHE_DIRECTORY, max_workers=4, verbose=True):
+        self.name = name
+        self.cache_directory = os.path.join(cache_directory, name)
+        self.max_workers = max_workers
+        self.verbose = verbose
+        self.stages = dict() # name -> stage, in the order added
+        self.print_lock = threading.Lock()
+
+    # Adds a stage; inputs are the names of earlier stages, whose outputs are passed to func in order,
+    # and files are the files (or directories) func reads
+    def add(self, name:str, func, inputs=(), params=None, code=(), files=()) -> str:
+        assert not name in self.stages, "Duplicate stage " + name
+        for input_name in inputs:
+            assert input_name in self.stages, "Stage " + name + " needs unknown stage " + input_name
+        self.stages[name] = stage(name, func, inputs, params, code, files)
+        return name
+
+    def log(self, *args):
+        if self.verbose:
+            with self.print_lock:
+                print("pipeline " + self.name + ":", *args)
+
+    # The stages that targets need, including themselves
+    def get_needed(self, targets:list) -> list:
+        needed = set()
+        todo = list(targets)
+        while len(todo) > 0:
+            name = todo.pop()
+            if not name in needed:
+                needed.add(name)
+                todo.extend(self.stages[name].inputs)
+        return [name for name in self.stages.keys() if name in needed]
+
+    # Returns (output, hash of its contents), from the cache if possible
+    def run_stage(self, s:stage, inputs:list, input_hashes:list, force:bool):
+        key = hashlib.sha256(json.dumps([s.name, s.get_code_hash(), s.params, input_hashes, s.get_file_states()],
+                                        sort_keys=True, default=repr).encode("utf-8")).hexdigest()
+        filename = os.path.join(self.cache_directory, s.name + "-" + key[:32] + ".pkl")
+        if not force and os.path.exists(filename):
+            with open(filename, "rb") as f:
+                data = f.read()
+            self.log(s.name, "cached")
+            return pickle.loads(data), hashlib.sha256(data).hexdigest()
+        start = time.time()
+        output = s.func(*inputs, **s.params)
+        data = pickle.dumps(output.value if isinstance(output, uncached) else output)
+        if isinstance(output, uncached):
+            self.log(s.name, "ran in {:.2f}s (not cached)".format(time.time() - start))
+            return output.value, hashlib.sha256(data).hexdigest()
+        os.makedirs(self.cache_directory, exist_ok=True)
+        with open(filename + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(filename + ".tmp", filename)
+        self.log(s.name, "ran in {:.2f}s".format(time.time() - start))
+        return output, hashlib.sha256(data).hexdigest()
+
+    # Runs the stages needed for targets (default all), in parallel where they are independent,
+    # and returns a dict of stage name -> output.  Stages named in force are rerun regardless.
+    def run(self, targets=None, force=()) -> dict:
+        needed = self.get_needed(targets if targets is not None else list(self.stages.keys()))
+        outputs = dict()
+        hashes = dict()
+        running = dict() # future -> stage name
+        with futures.ThreadPoolExecutor(self.max_workers) as executor:
+            while len(outputs) < len(needed):
+                for name in needed:
+                    s = self.stages[name]
+                    if not name in outputs and not name in running.values() and \
+                            all([input_name in outputs for input_name in s.inputs]):
+                        running[executor.submit(self.run_stage, s, [outputs[i] for i in s.inputs],
+                                                [hashes[i] for i in s.inputs], name in force)] = name
+                done, _ = futures.wait(running.keys(), return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    outputs[name], hashes[name] = future.result() # passes on any exception
+        return outputs
@@ -1,20 +1,52 @@
 # Aims to probe whether GPT3 knows about the statutes in SARA
 
-import sys, os
+import sys, os, argparse
 sys.path.append('../')
-import utils
+import utils, pipeline
+import compacted_statutes
 
 PROMPT = "\nWhere is the text above from?"
-STATUTES_DIR = "../statutes_compacted"
-
-for filename in sorted(os.listdir(STATUTES_DIR)):
-    utils.add_comment("probe GPT3 knowledge of SARA " + filename + " in " + __file__)
-    with open(STATUTES_DIR + "/" + filename, "r") as f:
-        statute_text = f.read()
-    assert statute_text[0] == "§"
-    # cut off the title line
-    statute_text = statute_text[statute_text.find("\n") + 1:].strip()
-    full_prompt = statute_text + PROMPT
-    statute_response = utils.call_gpt3_withlogging(full_prompt, "text-davinci-003", max_tokens=2000)
-    print(filename, "--------------------------")
+STATUTES_DIR = "../statutes_compacted" # built by running compacted_statutes.py from the top directory
+
+# The stages of the probe, run by pipeline.py so reruns reuse the cached responses
+
+# Returns the names of the statutes, sorted as the statute files used to be; the text is read
+# from the artifacts when asking rather than being cached here too
+def load_statutes() -> list:
+    return sorted(compacted_statutes.compacted_statutes(STATUTES_DIR).names())
+
+# Responses are None where still pending in batch mode, in which case they are not cached
+def ask(names, model):
+    statutes = compacted_statutes.compacted_statutes(STATUTES_DIR)
+    rv = []
+    for name in names:
+        utils.add_comment("probe GPT3 knowledge of SARA " + name + " in " + __file__)
+        # already compacted, with the title line cut off
+        full_prompt = statutes.get_text(name) + PROMPT
+        try:
+            rv.append(utils.call_gpt3_withlogging(full_prompt, model, max_tokens=2000))
+        except utils.ResponsePending:
+            rv.append(None)
+    return pipeline.uncached(rv) if None in rv else rv
+
+parser = argparse.ArgumentParser(description='Probe whether GPT3 knows where the SARA statutes are from')
+parser.add_argument('--model', default="text-davinci-003",
+                    help='name of the openai model to call')
+parser.add_argument('--force', nargs="*", default=[],
+                    help='pipeline stages to rerun even if cached, e.g. responses')
+args = parser.parse_args()
+
+probe = pipeline.pipeline("SARA_knowledge")
+probe.add("statutes", load_statutes, files=[STATUTES_DIR])
+probe.add("responses", ask, ["statutes"], {"model": args.model}, files=[STATUTES_DIR])
+outputs = probe.run(force=args.force)
+
+num_pending = 0
+for name, statute_response in zip(outputs["statutes"], outputs["responses"]):
+    if statute_response is None:
+        num_pending += 1
+        continue
+    print(name, "--------------------------")
     print(statute_response)
+if num_pending > 0:
+    print("num_pending=", num_pending, "(waiting on batch responses)")
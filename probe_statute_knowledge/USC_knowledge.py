@@ -1,58 +1,27 @@
 # Probes whether GPT3 can *identify* arbitrary sections of the U.S. Code based on their text.
 
-import xml.etree.ElementTree as ET
 import pickle, re, sys, statistics
 import os.path
 sys.path.append('../')
 import utils
+from statute_text import usc_ns_str, ns, get_IRC_text, compact_statute, parse_title
 import random
 random.seed(42) # ensure reproducability
 
-usc_ns_str = "http://xml.house.gov/schemas/uslm/1.0"
-ns = {"usc" : usc_ns_str}
-
-# Gets all non-header text from NON-repealed sections
-def get_IRC_text_recursive(x:ET.Element, top_level = True) -> str:
-    rv = ""
-    if x.text is not None:
-        rv += x.text + " "
-    for sub in x:
-        if "status" not in sub.attrib:
-            if "sourceCredit" not in sub.tag and \
-                    "notes" not in sub.tag and \
-                    (not top_level or ("num" not in sub.tag and "heading" not in sub.tag)):
-                rv += get_IRC_text_recursive(sub, False)
-        else:
-            # Count of statuses in all of IRC was the following: {'': 519201, 'repealed': 32}
-            # Thus we are making the assumption asserted below
-            assert sub.attrib["status"] in ["repealed" , 'transferred']
-    if x.tail is not None:
-        rv += x.tail + " "
-    return rv
-
-def compact_statute(orig_text:str) -> str:
-    rv = ""
-    for line in orig_text.split("\n"):
-        if not line.isspace():
-            rv += line.rstrip() + "\n"
-    rv = rv.replace("\n\n", "\n")
-    return rv
-
 USC_DIRECTORY = "xml_uscAll@117-327not263not286"
 
-def get_sections_from_title(title_num:int, min_len = 100, max_len = 1000) -> list:
+def get_sections_from_title(title_num:int, min_len = 100, max_len = 1000, usc_directory=USC_DIRECTORY) -> list:
     prefix = ""
     if title_num < 10:
         prefix = "0"
-    filename = USC_DIRECTORY + "/usc" + prefix + str(title_num) + ".xml"
+    filename = usc_directory + "/usc" + prefix + str(title_num) + ".xml"
     if not os.path.exists(filename):
         return None
 
     identifier_prefix = "/us/usc/t" + str(title_num) + "/s"
 
     # Load the Code itself (downloaded from https://uscode.house.gov/download/download.shtml earlier)
-    title_tree = ET.parse(filename)
-    title_root = title_tree.getroot()
+    title_root = parse_title(filename)
 
     sections = [] # list of ALL tuples of (section number, text, word length) that qualify
 
@@ -63,7 +32,7 @@ def get_sections_from_title(title_num:int, min_len = 100, max_len = 1000) -> lis
             num_minus_prefix = num[len(identifier_prefix):]
             # must exclude sections with dashes or letters; will be asking GPT3 for arabic numeral sections
             if num_minus_prefix.isnumeric():
-                sect_text = get_IRC_text_recursive(s)
+                sect_text = get_IRC_text(s)
                 sect_text_compact = compact_statute(sect_text)
                 words_in_section = len(sect_text_compact.split())
                 if min_len <= words_in_section <= max_len:
@@ -132,8 +101,23 @@ def GPT3_id(section, title_num):
     return extracted_title_num, extracted_section_num
 
 if __name__ == "__main__":
+    import argparse
+    import section_sampler
+
+    parser = argparse.ArgumentParser(description='Probe whether GPT3 can identify sections of the U.S. Code')
+    parser.add_argument('--per_title', type=int, default=10,
+                        help='how many sections to sample from each title')
+    parser.add_argument('--num_bins', type=int, default=0,
+                        help='if > 0, stratify the sample into this many word-length bins between 100 and 1000')
+    parser.add_argument('--per_bin', type=int, default=None,
+                        help='with --num_bins, how many sections to sample from each bin of each title (default --per_title)')
+    args = parser.parse_args()
+    if args.per_bin is None:
+        args.per_bin = args.per_title
+    assert args.num_bins == 0 or args.per_bin > 0, "--per_bin must be > 0 with --num_bins"
 
     total_sections = 0
+    total_pending = 0 # in batch mode (see batch_file.py), sections still waiting on a response
     total_NOtitle = 0
     total_titlewrong = 0
     total_titleright_NOsection = 0
@@ -149,14 +133,26 @@ if __name__ == "__main__":
         # if title > 15:
         #     break
         print("Title", title, end="\t")
-        sections = get_sections_from_title(title)
-        if sections is None:
+        qualifying = section_sampler.get_word_count_rows(title, 100, 1000)
+        if qualifying is None:
             print("None")
         else:
-            print("num sections =", len(sections))
-            for sect in random.sample(sections, k=10): # using sample instead of choice ensures no replacement
+            print("num sections =", len(qualifying))
+            if args.num_bins > 0:
+                bins = section_sampler.length_bins(100, 1000, args.num_bins)
+                sampled = []
+                for bin_sections in section_sampler.stratified_sample(title, bins, args.per_bin):
+                    sampled.extend(bin_sections)
+            else:
+                # using sample instead of choice ensures no replacement
+                sampled = section_sampler.sample_sections(title, args.per_title, 100, 1000)
+            for sect in sampled:
+                try:
+                    extracted_title, extracted_section = GPT3_id(sect, title) # KEY CALL!
+                except utils.ResponsePending:
+                    total_pending += 1
+                    continue
                 total_sections += 1
-                extracted_title, extracted_section = GPT3_id(sect, title) # KEY CALL!
                 num_words = len(sect[1].split())
                 if num_words not in dict_len_all:
                     dict_len_all[num_words] = 0
@@ -194,6 +190,8 @@ if __name__ == "__main__":
         print("++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++")
         print("PROGRESS:")
         print("total_sections =", total_sections)
+        if total_pending > 0:
+            print("total_pending =", total_pending)
         print("total_NOtitle = ", total_NOtitle)
         print("total_titlewrong = ", total_titlewrong)
         print("total_titleright_NOsection = ", total_titleright_NOsection)
@@ -14,6 +14,7 @@ actual_recalled_at = []
 percentile_actual_recall = []
 list_raw_section_distance = [] # raw section distance from actual section and one with best BLEU
 recall_at1_by_title = [0] * 55
+total_pending = 0 # in batch mode (see batch_file.py) or a dry run, sections still waiting on a response
 
 NUM_PER_TITLE = 10
 
@@ -37,7 +38,11 @@ for title in range(1, 55):
         else:
             prompt = "The text of " + str(title) + " U.S. Code section " + str(s) + " is:"
             print("Calling GPT3:", prompt)
-            response = utils.call_gpt3_withlogging(prompt, engine="text-davinci-003", max_tokens=3000)
+            try:
+                response = utils.call_gpt3_withlogging(prompt, engine="text-davinci-003", max_tokens=3000)
+            except utils.ResponsePending: # skipped until a later batch has the response
+                total_pending += 1
+                continue
             with open(gpt_fileloc, "w") as f_out:
                 f_out.write(response)
 
@@ -86,6 +91,8 @@ for title in range(1, 55):
 
 print("actual_recalled_at=", actual_recalled_at)
 print("TOTAL =", len(actual_recalled_at))
+if total_pending > 0:
+    print("total_pending =", total_pending, "(waiting on responses, so not in the results)")
 print("recall @ 1:", len([x for x in actual_recalled_at if x == 1]))
 print("recall @ 5:", len([x for x in actual_recalled_at if x <= 5]))
 print("MRR=", numpy.mean([1/x for x in actual_recalled_at]))
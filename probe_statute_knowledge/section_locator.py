@@ -0,0 +1,207 @@
+# Byte-offset locator for single sections of the U.S. Code.
+# Parsing an entire title just to get the text of one section takes tens of seconds for the
+# big titles.  Instead, we scan each title's XML once and record, for every section, the byte
+# offset and length of its element.  Any one section can then be pulled out with a single seek.
+
+import xml.etree.ElementTree as ET
+import xml.parsers.expat
+import argparse, json, os, sys
+sys.path.append('../')
+import USC_knowledge
+import utils
+from statute_text import usc_ns_str, get_IRC_text, compact_statute
+
+INDEX_DIRECTORY = "usc_section_index"
+FRAGMENT_WRAPPER = "locator_fragment" # dummy root used to re-attach namespaces to an extracted section
+
+def get_title_filename(title_num:int, usc_directory=USC_knowledge.USC_DIRECTORY) -> str:
+    prefix = ""
+    if title_num < 10:
+        prefix = "0"
+    return usc_directory + "/usc" + prefix + str(title_num) + ".xml"
+
+def get_index_filename(title_num:int, usc_directory=USC_knowledge.USC_DIRECTORY) -> str:
+    # indices are kept per release point, so that several releases can be indexed side by side
+    return os.path.join(INDEX_DIRECTORY, os.path.basename(os.path.normpath(usc_directory)),
+                        "usc" + str(title_num) + ".json")
+
+# Scans the XML of a title once and returns the index as a dict.  Each entry of "sections" is
+# [section (e.g. "61" or "25A"), byte offset, byte length, status], in document order.
+# The length also covers the text following the closing tag, since get_IRC_text()
+# includes the tail of the section element.
+def build_section_index(title_num:int, usc_directory=USC_knowledge.USC_DIRECTORY) -> dict:
+    filename = get_title_filename(title_num, usc_directory)
+    if not os.path.exists(filename):
+        return None
+    with open(filename, "rb") as f:
+        data = f.read()
+
+    identifier_prefix = "/us/usc/t" + str(title_num) + "/s"
+    section_tag = usc_ns_str + "}section"
+    namespaces = {} # prefix -> uri, needed to parse a section on its own
+    sections = []
+    open_sections = [] # stack with the entry (or None if not indexed) of every open section element
+
+    parser = xml.parsers.expat.ParserCreate(namespace_separator="}")
+
+    def start_namespace(prefix, uri):
+        if prefix is None: # the default namespace; "" rather than None so that it survives json
+            prefix = ""
+        if prefix not in namespaces:
+            namespaces[prefix] = uri
+
+    def start_element(name, attrs):
+        if name != section_tag:
+            return
+        entry = None
+        if "identifier" in attrs:
+            num = attrs["identifier"]
+            assert num.startswith(identifier_prefix)
+            entry = [num[len(identifier_prefix):], parser.CurrentByteIndex, None, attrs.get("status", "")]
+            sections.append(entry)
+        open_sections.append(entry)
+
+    def end_element(name):
+        if name != section_tag:
+            return
+        entry = open_sections.pop()
+        if entry is None:
+            return
+        end_tag = parser.CurrentByteIndex
+        if data.startswith(b"</", end_tag):
+            end = data.index(b">", end_tag) + 1
+        else: # empty element, e.g. <section .../>
+            end = data.index(b"/>", entry[1]) + 2
+        tail_end = data.find(b"<", end)
+        if tail_end < 0:
+            tail_end = len(data)
+        entry[2] = tail_end - entry[1]
+
+    parser.StartNamespaceDeclHandler = start_namespace
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.Parse(data, True)
+
+    stat = os.stat(filename)
+    return {"filename": filename, "size": stat.st_size, "mtime": stat.st_mtime,
+            "namespaces": namespaces, "sections": sections}
+
+# Returns the index for the title, (re)building it if missing or if the XML has changed.
+def load_section_index(title_num:int, usc_directory=USC_knowledge.USC_DIRECTORY) -> dict:
+    filename = get_title_filename(title_num, usc_directory)
+    if not os.path.exists(filename):
+        return None
+    index_filename = get_index_filename(title_num, usc_directory)
+    if os.path.exists(index_filename):
+        with open(index_filename, "r") as f:
+            index = json.load(f)
+        stat = os.stat(filename)
+        if index["size"] == stat.st_size and index["mtime"] == stat.st_mtime:
+            return index
+
+    index = build_section_index(title_num, usc_directory)
+    os.makedirs(os.path.dirname(index_filename), exist_ok=True)
+    with open(index_filename, "w") as f:
+        json.dump(index, f)
+    return index
+
+class section_locator:
+    def __init__(self, usc_directory=USC_knowledge.USC_DIRECTORY):
+        self.usc_directory = usc_directory
+        self.indices = {} # title_num -> index
+        self.lookups = {} # title_num -> dict of section -> list of entries
+
+    # A few titles reuse a section number, e.g. a repealed section followed by a live one.  The entries
+    # for a section are its non-repealed ones in document order, i.e. the order get_sections_from_title()
+    # returns them in; only if all of them are repealed is it the repealed ones instead.
+    def get_index(self, title_num:int) -> dict:
+        if title_num not in self.indices:
+            index = load_section_index(title_num, self.usc_directory)
+            self.indices[title_num] = index
+            live = {}
+            repealed = {}
+            if index is not None:
+                for entry in index["sections"]:
+                    (repealed if entry[3] == "repealed" else live).setdefault(entry[0], []).append(entry)
+            for section, entries in repealed.items():
+                live.setdefault(section, entries)
+            self.lookups[title_num] = live
+        return self.indices[title_num]
+
+    def has_section(self, title_num:int, section) -> bool:
+        self.get_index(title_num)
+        return str(section) in self.lookups[title_num]
+
+    # How many entries there are for the section (more than 1 only for reused numbers)
+    def count_occurrences(self, title_num:int, section) -> int:
+        self.get_index(title_num)
+        return len(self.lookups[title_num].get(str(section), []))
+
+    # Reads the raw bytes of one section with a single seek; occurrence picks among reused numbers
+    def read_section_bytes(self, title_num:int, section, occurrence=0) -> bytes:
+        index = self.get_index(title_num)
+        assert index is not None, "No XML for title " + str(title_num)
+        entry = self.lookups[title_num][str(section)][occurrence]
+        with open(index["filename"], "rb") as f:
+            f.seek(entry[1])
+            return f.read(entry[2])
+
+    # Returns the section as an element equivalent to the one found by parsing the whole title
+    def get_section_element(self, title_num:int, section, occurrence=0) -> ET.Element:
+        index = self.get_index(title_num)
+        fragment = self.read_section_bytes(title_num, section, occurrence)
+        declarations = ""
+        for prefix, uri in index["namespaces"].items():
+            if prefix == "":
+                declarations += ' xmlns="' + uri + '"'
+            else:
+                declarations += ' xmlns:' + prefix + '="' + uri + '"'
+        wrapped = ("<" + FRAGMENT_WRAPPER + declarations + ">").encode("utf-8") + \
+                  fragment + \
+                  ("</" + FRAGMENT_WRAPPER + ">").encode("utf-8")
+        return ET.fromstring(wrapped)[0]
+
+    # Returns the compacted text, exactly as get_sections_from_title() would produce it for the
+    # occurrence-th (from 0) live section with this number
+    def get_section_text(self, title_num:int, section, occurrence=0) -> str:
+        element = self.get_section_element(title_num, section, occurrence)
+        return compact_statute(get_IRC_text(element))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Index the U.S. Code by section and retrieve single sections')
+    parser.add_argument('--title', type=int,
+                        help='title to index or retrieve from; if omitted with --build, indexes titles 1 to 54')
+    parser.add_argument('--section',
+                        help='section to retrieve, e.g. 61 or 25A')
+    parser.add_argument('--build', action="store_true",
+                        help='(re)build the index rather than retrieving a section')
+    parser.add_argument('--probe', action="store_true",
+                        help='run USC_knowledge.GPT3_id() on the retrieved section')
+    parser.add_argument('--usc_directory', default=USC_knowledge.USC_DIRECTORY,
+                        help='directory holding the uscNN.xml files of a release point')
+    args = parser.parse_args()
+
+    if args.build:
+        titles = [args.title] if args.title is not None else range(1, 55)
+        for title in titles:
+            index = load_section_index(title, args.usc_directory)
+            if index is None:
+                print("Title", title, "None")
+            else:
+                print("Title", title, "num sections =", len(index["sections"]))
+    else:
+        if args.title is None or args.section is None:
+            print("Need both --title and --section to retrieve a section")
+            exit(0)
+        locator = section_locator(args.usc_directory)
+        if not locator.has_section(args.title, args.section):
+            print("No section", args.section, "in title", args.title)
+            exit(0)
+        text = locator.get_section_text(args.title, args.section)
+        print(text)
+        if args.probe:
+            assert args.section.isnumeric(), "GPT3_id() asks for arabic numeral sections"
+            try:
+                print("extracted:", USC_knowledge.GPT3_id((int(args.section), text), args.title))
+            except utils.ResponsePending:
+                print("pending: the response is not in the batch results yet")
@@ -0,0 +1,108 @@
+# Samples sections of the U.S. Code by length without holding every section's text in memory.
+# Word counts for each title are computed once and cached next to the section index; the text
+# is then fetched (via section_locator) only for the sections actually chosen.
+
+import json, os, random
+import USC_knowledge
+import section_locator
+
+TABLE_VERSION = 2 # tables from before the occurrence column are rebuilt
+
+def get_word_count_filename(title_num:int, usc_directory=USC_knowledge.USC_DIRECTORY) -> str:
+    return section_locator.get_index_filename(title_num, usc_directory)[:-len(".json")] + "_words.json"
+
+# Returns list of 3-tuples of (section number, word length, occurrence) for ALL arabic-numeral,
+# non-repealed sections of the title, in document order (i.e., the same order get_sections_from_title()
+# uses).  occurrence counts the earlier rows with the same (reused) section number, for section_locator.
+def load_word_count_table(title_num:int, usc_directory=USC_knowledge.USC_DIRECTORY) -> list:
+    filename = section_locator.get_title_filename(title_num, usc_directory)
+    if not os.path.exists(filename):
+        return None
+    stat = os.stat(filename)
+    table_filename = get_word_count_filename(title_num, usc_directory)
+    if os.path.exists(table_filename):
+        with open(table_filename, "r") as f:
+            table = json.load(f)
+        if table.get("version") == TABLE_VERSION and table["size"] == stat.st_size and table["mtime"] == stat.st_mtime:
+            return [tuple(row) for row in table["rows"]]
+
+    sections = USC_knowledge.get_sections_from_title(title_num, 0, float("inf"), usc_directory)
+    rows = [] # drop the text; only the counts are kept
+    occurrences = {}
+    for s in sections:
+        rows.append((s[0], s[2], occurrences.get(s[0], 0)))
+        occurrences[s[0]] = occurrences.get(s[0], 0) + 1
+
+    os.makedirs(os.path.dirname(table_filename), exist_ok=True)
+    with open(table_filename, "w") as f:
+        json.dump({"version": TABLE_VERSION, "size": stat.st_size, "mtime": stat.st_mtime, "rows": rows}, f)
+    return rows
+
+# Just the (section number, word length, occurrence) rows with min_len <= word length <= max_len
+def get_word_count_rows(title_num:int, min_len = 100, max_len = 1000,
+                        usc_directory=USC_knowledge.USC_DIRECTORY) -> list:
+    table = load_word_count_table(title_num, usc_directory)
+    if table is None:
+        return None
+    return [row for row in table if min_len <= row[1] <= max_len]
+
+# Turns rows of (section number, word length, occurrence) into the (section number, text, word length)
+# tuples used by USC_knowledge.py, reading only those sections from the XML.
+def fetch_sections(title_num:int, rows:list, locator=None) -> list:
+    if locator is None:
+        locator = section_locator.section_locator()
+    rv = []
+    for section_num, words_in_section, occurrence in rows:
+        sect_text_compact = locator.get_section_text(title_num, section_num, occurrence)
+        assert len(sect_text_compact.split()) == words_in_section, "Word count table is stale"
+        rv.append((section_num, sect_text_compact, words_in_section))
+    return rv
+
+# Same result as random.sample(get_sections_from_title(title_num, min_len, max_len), k) given the
+# same random state, but only k sections are ever extracted.
+def sample_sections(title_num:int, k:int, min_len = 100, max_len = 1000, rand_gen=random,
+                    usc_directory=USC_knowledge.USC_DIRECTORY, locator=None) -> list:
+    rows = get_word_count_rows(title_num, min_len, max_len, usc_directory)
+    if rows is None:
+        return None
+    if locator is None:
+        locator = section_locator.section_locator(usc_directory)
+    return fetch_sections(title_num, rand_gen.sample(rows, k=k), locator)
+
+# Splits [min_len, max_len] into num_bins contiguous, inclusive (low, high) word-count bins
+def length_bins(min_len:int, max_len:int, num_bins:int) -> list:
+    assert num_bins > 0 and max_len - min_len + 1 >= num_bins
+    rv = []
+    for i in range(num_bins):
+        low = min_len + (i * (max_len - min_len + 1)) // num_bins
+        high = min_len + ((i + 1) * (max_len - min_len + 1)) // num_bins - 1
+        rv.append((low, high))
+    return rv
+
+# Samples up to per_bin sections from each length bin (fewer if a bin does not have enough).
+# Returns a list with one list of (section number, text, word length) per bin.
+# Deterministic given the state of rand_gen, since bins are visited in order.
+def stratified_sample(title_num:int, bins:list, per_bin:int, rand_gen=random,
+                      usc_directory=USC_knowledge.USC_DIRECTORY, locator=None) -> list:
+    table = load_word_count_table(title_num, usc_directory)
+    if table is None:
+        return None
+    if locator is None:
+        locator = section_locator.section_locator(usc_directory)
+    rv = []
+    for low, high in bins:
+        rows = [row for row in table if low <= row[1] <= high]
+        chosen = rand_gen.sample(rows, k=min(per_bin, len(rows)))
+        rv.append(fetch_sections(title_num, chosen, locator))
+    return rv
+
+# Dict of word length -> number of sections of that length, computed from the table alone
+def word_count_histogram(title_num:int, min_len = 0, max_len = float("inf"),
+                         usc_directory=USC_knowledge.USC_DIRECTORY) -> dict:
+    rows = get_word_count_rows(title_num, min_len, max_len, usc_directory)
+    if rows is None:
+        return None
+    rv = {}
+    for _, words_in_section, _ in rows:
+        rv[words_in_section] = rv.get(words_in_section, 0) + 1
+    return rv
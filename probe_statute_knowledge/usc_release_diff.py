@@ -0,0 +1,186 @@
+# Incremental ingest of a new U.S. Code release point (e.g. moving on from xml_uscAll@117-327not263not286).
+# Every section's extracted text is hashed once per release and cached next to the section index.
+# A title whose XML file is byte-identical to the previous release is not re-parsed at all.
+# Diffing two releases then gives the sections that are new or changed, which are the only
+# ones that need re-processing, and shows which cached probe results are no longer valid.
+
+import argparse, hashlib, json, os, pickle, re, sys
+sys.path.append('../')
+import USC_knowledge
+import section_locator
+
+HASHES_FILENAME = "section_hashes.json"
+HASHES_VERSION = 2 # titles hashed by an older version are hashed again
+
+def get_hashes_filename(usc_directory:str) -> str:
+    return os.path.join(section_locator.INDEX_DIRECTORY, os.path.basename(os.path.normpath(usc_directory)),
+                        HASHES_FILENAME)
+
+def hash_text(text:str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def hash_file(filename:str) -> str:
+    rv = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            rv.update(block)
+    return rv.hexdigest()
+
+def load_hashes(usc_directory:str) -> dict:
+    filename = get_hashes_filename(usc_directory)
+    if not os.path.exists(filename):
+        return {}
+    with open(filename, "r") as f:
+        return json.load(f)
+
+# Sections are keyed by number and occurrence, e.g. "7#0", since a number can be reused by more than
+# one live section (occurrence counts them in document order, as section_locator.py does)
+def get_section_key(section_num:int, occurrence:int) -> str:
+    return "{}#{}".format(section_num, occurrence)
+
+def parse_section_key(key:str) -> tuple:
+    section_num, occurrence = key.split("#")
+    return int(section_num), int(occurrence)
+
+# Returns dict of title (as str, since json) -> {"file_sha256": ..., "version": ..., "sections": {section key:
+# [text sha256, words]}} covering the arabic-numeral, non-repealed sections that the probes draw from.
+# Titles whose XML is unchanged, either since the last run on this release or relative to any of
+# previous_releases, are copied over rather than re-parsed.
+def hash_release(usc_directory:str, previous_releases=(), verbose=True) -> dict:
+    hashes = load_hashes(usc_directory)
+    known_files = {} # file sha256 -> title entry, from releases already hashed
+    for previous in previous_releases:
+        for entry in load_hashes(previous).values():
+            if entry.get("version") == HASHES_VERSION:
+                known_files[entry["file_sha256"]] = entry
+
+    rv = {}
+    for title in range(1, 55):
+        filename = section_locator.get_title_filename(title, usc_directory)
+        if not os.path.exists(filename):
+            continue
+        file_sha256 = hash_file(filename)
+        if str(title) in hashes and hashes[str(title)]["file_sha256"] == file_sha256 and \
+                hashes[str(title)].get("version") == HASHES_VERSION:
+            rv[str(title)] = hashes[str(title)]
+            how = "cached"
+        elif file_sha256 in known_files:
+            rv[str(title)] = known_files[file_sha256]
+            how = "unchanged from previous release"
+        else:
+            sections = {}
+            occurrences = {} # section number -> how many live sections with it so far
+            for section_num, text, words in USC_knowledge.get_sections_from_title(title, 0, float("inf"),
+                                                                                  usc_directory):
+                occurrence = occurrences.get(section_num, 0)
+                occurrences[section_num] = occurrence + 1
+                sections[get_section_key(section_num, occurrence)] = [hash_text(text), words]
+            rv[str(title)] = {"file_sha256": file_sha256, "version": HASHES_VERSION, "sections": sections}
+            how = "parsed"
+        if verbose:
+            print("Title", title, how, "num sections =", len(rv[str(title)]["sections"]))
+
+    hashes_filename = get_hashes_filename(usc_directory)
+    os.makedirs(os.path.dirname(hashes_filename), exist_ok=True)
+    with open(hashes_filename, "w") as f:
+        json.dump(rv, f)
+    return rv
+
+# Returns dict of title (int) -> {"added": [...], "removed": [...], "changed": [...], "unchanged": int},
+# only for titles with at least one difference.  Sections are (section number, occurrence) tuples.
+def diff_releases(old_hashes:dict, new_hashes:dict) -> dict:
+    rv = {}
+    for title in sorted(set(old_hashes.keys()) | set(new_hashes.keys()), key=int):
+        old_sections = old_hashes.get(title, {"sections": {}})["sections"]
+        new_sections = new_hashes.get(title, {"sections": {}})["sections"]
+        added = sorted([parse_section_key(s) for s in new_sections if s not in old_sections])
+        removed = sorted([parse_section_key(s) for s in old_sections if s not in new_sections])
+        changed = sorted([parse_section_key(s) for s in new_sections
+                          if s in old_sections and new_sections[s][0] != old_sections[s][0]])
+        if len(added) + len(removed) + len(changed) > 0:
+            rv[int(title)] = {"added": added, "removed": removed, "changed": changed,
+                              "unchanged": len(new_sections) - len(added) - len(changed)}
+    return rv
+
+# Sections that are new or whose text changed, as (title, section number, occurrence); the only ones
+# that need to be re-processed.
+def sections_to_reprocess(diff:dict) -> list:
+    rv = []
+    for title, title_diff in diff.items():
+        for section_num, occurrence in title_diff["added"] + title_diff["changed"]:
+            rv.append((title, section_num, occurrence))
+    return rv
+
+# probe_text_recitation.py ranks the response by BLEU against *every* section of the title, so its
+# results go stale when anything in the title changes.  The cached GPT responses in gpt_output/ were
+# prompted with just the cite, so they remain usable; only the scoring has to be redone.
+def invalid_recitation_results(diff:dict, results_filename:str) -> list:
+    if not os.path.exists(results_filename):
+        return []
+    with open(results_filename, "rb") as f:
+        results = pickle.load(f)
+    return [r for r in results if r["title"] in diff]
+
+# GPT3_id() prompts with the section's text, so any outcome for a changed or removed section is invalid.
+# USC_knowledge.py only pickles aggregates, so the probed sections are recovered from the log comments.
+# Those do not say which occurrence of a reused number was probed, so any occurrence counts.
+def invalid_GPT3_id_results(diff:dict, log_filename:str) -> list:
+    if not os.path.exists(log_filename):
+        return []
+    probed = re.compile(r"COMMENT:Seeing if GPT3 can id the text of (\d+) USC sec (\d+) ")
+    rv = []
+    with open(log_filename, "r") as f:
+        for line in f:
+            match = probed.search(line)
+            if match is None:
+                continue
+            title, section = int(match[1]), int(match[2])
+            if title in diff and section in [section_num for section_num, _ in
+                                             diff[title]["changed"] + diff[title]["removed"]]:
+                if (title, section) not in rv:
+                    rv.append((title, section))
+    return rv
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Hash sections of a new U.S. Code release and diff against the old one')
+    parser.add_argument('--old', default=USC_knowledge.USC_DIRECTORY,
+                        help='directory of the previous release point')
+    parser.add_argument('--new', required=True,
+                        help='directory of the new release point')
+    parser.add_argument('--recitation_results', default="probe_text_recitation_results.pkl",
+                        help='pickled results of probe_text_recitation.py to check')
+    parser.add_argument('--log', default="gpt3_log.txt",
+                        help='log written by utils.py, used to find which sections GPT3_id() probed')
+    parser.add_argument('--report', default=None,
+                        help='if given, also write the change report to this json file')
+    args = parser.parse_args()
+
+    print("Hashing old release", args.old)
+    old_hashes = hash_release(args.old)
+    print("Hashing new release", args.new)
+    new_hashes = hash_release(args.new, previous_releases=[args.old])
+
+    diff = diff_releases(old_hashes, new_hashes)
+    for title, title_diff in diff.items():
+        print("Title", title, "added", len(title_diff["added"]), "removed", len(title_diff["removed"]),
+              "changed", len(title_diff["changed"]), "unchanged", title_diff["unchanged"])
+    reprocess = sections_to_reprocess(diff)
+    print("Sections to re-process:", len(reprocess))
+
+    stale_recitations = invalid_recitation_results(diff, args.recitation_results)
+    print("Recitation results needing re-scoring (cached responses still valid):", len(stale_recitations))
+    for r in stale_recitations:
+        print("   ", r["title"], "USC", r["section"])
+
+    stale_ids = invalid_GPT3_id_results(diff, args.log)
+    print("GPT3_id outcomes made invalid:", len(stale_ids))
+    for title, section in stale_ids:
+        print("   ", title, "USC", section)
+
+    if args.report is not None:
+        with open(args.report, "w") as f:
+            json.dump({"old": args.old, "new": args.new,
+                       "diff": {str(t): d for t, d in diff.items()},
+                       "reprocess": reprocess,
+                       "invalid_recitation_results": [[r["title"], r["section"]] for r in stale_recitations],
+                       "invalid_GPT3_id_results": stale_ids}, f, indent=1)
@@ -0,0 +1,164 @@
+# Shares one API rate limit among all the experiment scripts running on this machine
+# (call_gpt_with_sara.py, applies_probe_synstat.py, USC_knowledge.py, ...), so they stay near
+# the account limit together instead of each finding it by getting RateLimitErrors.
+# utils.py calls acquire() before every request and report_rate_limited() on a RateLimitError.
+#
+# The processes share a token bucket (requests per minute, and optionally tokens per minute)
+# kept in a small JSON file, updated under an fcntl lock.  When several processes are waiting,
+# the next request goes to the one with the lowest virtual start time (start-time fair queuing):
+# each request a process makes advances its virtual time by 1/priority, so a priority-2 script
+# gets twice the share of a priority-1 script while both are busy.  A process that was idle
+# starts again from the virtual time of the last request sent, so it cannot save up a share.
+#
+# Off unless GPT_RATE_LIMIT_RPM is set.  Settings, all from the environment:
+#   GPT_RATE_LIMIT_RPM       requests per minute for all processes together
+#   GPT_RATE_LIMIT_TPM       tokens per minute for all processes together (optional)
+#   GPT_RATE_LIMIT_PRIORITY  this process's share weight (default 1)
+#   GPT_RATE_LIMIT_FILE      the shared state file (default gpt_rate_limit.json in the temp directory)
+
+import os, json, time, tempfile
+try:
+    import fcntl
+except ImportError: # e.g. Windows; coordination is then turned off
+    fcntl = None
+
+STALE_SECONDS = 30 # waiters not heard from for this long (e.g. killed) are dropped
+POLL_SECONDS = 0.05 # longest to sleep between checks while waiting
+RATE_LIMITED_PAUSE = 5 # seconds everyone holds off after any process gets a RateLimitError
+
+def get_setting(name:str, default=None):
+    value = os.getenv(name)
+    if value is None or value == "":
+        return default
+    return float(value)
+
+def is_enabled() -> bool:
+    return fcntl is not None and get_setting("GPT_RATE_LIMIT_RPM") is not None
+
+def get_state_filename() -> str:
+    return os.getenv("GPT_RATE_LIMIT_FILE", os.path.join(tempfile.gettempdir(), "gpt_rate_limit.json"))
+
+# Rough token count for the TPM bucket: about 4 characters per token, plus what may be generated
+def estimate_tokens(prompt:str, max_tokens:int) -> int:
+    return len(prompt) // 4 + max_tokens
+
+# Runs update(state, now) on the shared state while holding the lock, saves it, and returns
+# whatever update() returns
+def with_state(update):
+    with open(get_state_filename(), "a+") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.seek(0)
+            text = f.read()
+            state = json.loads(text) if len(text) > 0 else {}
+            now = time.time()
+            rv = update(state, now)
+            f.seek(0)
+            f.truncate()
+            json.dump(state, f)
+            f.flush()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+    return rv
+
+# Adds what has accrued since the last update to a bucket; rate is per minute
+def refill(state:dict, name:str, rate:float, now:float):
+    capacity = max(1.0, rate / 60) # allows a burst of one second's worth
+    bucket = state.setdefault(name, {"level": capacity, "updated": now})
+    bucket["level"] = min(capacity, bucket["level"] + (now - bucket["updated"]) * rate / 60)
+    bucket["updated"] = now
+    return bucket, capacity
+
+# Blocks until this process may send a request of about num_tokens tokens
+def acquire(num_tokens=0):
+    if not is_enabled():
+        return
+    rpm = get_setting("GPT_RATE_LIMIT_RPM")
+    tpm = get_setting("GPT_RATE_LIMIT_TPM")
+    priority = get_setting("GPT_RATE_LIMIT_PRIORITY", 1.0)
+    assert rpm > 0 and priority > 0
+    pid = str(os.getpid())
+
+    def try_acquire(state, now):
+        waiters = state.setdefault("waiters", {})
+        for other in list(waiters.keys()):
+            if now - waiters[other]["seen"] > STALE_SECONDS:
+                del waiters[other]
+        if not pid in waiters:
+            # start after this process's last request, but not before the last request sent by anyone
+            vtime = max(state.get("vtimes", {}).get(pid, 0.0), state.get("vtime", 0.0))
+            waiters[pid] = {"vtime": vtime, "seen": now}
+        waiters[pid]["seen"] = now
+        wait = 0.0
+        if now < state.get("paused_until", 0):
+            wait = state["paused_until"] - now
+        if min(waiters.items(), key=lambda x: (x[1]["vtime"], x[0]))[0] != pid:
+            return max(wait, POLL_SECONDS) # someone else is next
+        requests, _ = refill(state, "requests", rpm, now)
+        wait = max(wait, (1 - requests["level"]) * 60 / rpm)
+        if tpm is not None:
+            tokens, capacity = refill(state, "tokens", tpm, now)
+            needed = min(num_tokens, capacity) # so a huge request can still go once the bucket is full
+            wait = max(wait, (needed - tokens["level"]) * 60 / tpm)
+        if wait > 0:
+            return wait
+        requests["level"] -= 1
+        if tpm is not None:
+            tokens["level"] -= needed
+        start_vtime = waiters.pop(pid)["vtime"]
+        state["vtime"] = start_vtime
+        state.setdefault("vtimes", {})[pid] = start_vtime + 1 / priority # when this process's next request may start
+        if len(state["vtimes"]) > 1000: # forget long-gone processes
+            state["vtimes"] = {pid: state["vtimes"][pid]}
+        return 0
+
+    while True:
+        wait = with_state(try_acquire)
+        if wait <= 0:
+            return
+        time.sleep(min(wait, POLL_SECONDS))
+
+# Called after a RateLimitError, so every process holds off rather than all retrying at once
+def report_rate_limited(pause=RATE_LIMITED_PAUSE):
+    if not is_enabled():
+        return
+    def update(state, now):
+        state["paused_until"] = max(state.get("paused_until", 0), now + pause)
+        if "requests" in state:
+            state["requests"]["level"] = min(state["requests"]["level"], 0)
+    with_state(update)
+
+# Demonstration: several processes with different priorities compete for one limit
+if __name__ == "__main__":
+    import argparse, multiprocessing
+    parser = argparse.ArgumentParser(description='Show how processes share a rate limit')
+    parser.add_argument('--rpm', type=float, default=600)
+    parser.add_argument('--priorities', type=float, nargs="*", default=[1, 1, 2])
+    parser.add_argument('--seconds', type=float, default=6)
+    args = parser.parse_args()
+
+    os.environ["GPT_RATE_LIMIT_RPM"] = str(args.rpm)
+    os.environ["GPT_RATE_LIMIT_FILE"] = os.path.join(tempfile.mkdtemp(), "rate_limit_demo.json")
+    def worker(priority, end, results):
+        os.environ["GPT_RATE_LIMIT_PRIORITY"] = str(priority)
+        count = 0
+        while True:
+            acquire()
+            if time.time() > end:
+                break
+            count += 1
+        results.put((priority, count))
+
+    end = time.time() + args.seconds
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=worker, args=(p, end, results)) for p in args.priorities]
+    for p in processes:
+        p.start()
+    counts = [results.get() for p in processes]
+    for p in processes:
+        p.join()
+    total = sum([c for p, c in counts])
+    print("{:.0f} requests in {:.0f}s against a limit of {:.0f}/min ({:.0f} expected, plus a burst of {:.0f})".format(
+        total, args.seconds, args.rpm, args.rpm * args.seconds / 60, max(1, args.rpm / 60)))
+    for priority, count in sorted(counts):
+        print("  priority {:.1f}: {:d} requests ({:.0%})".format(priority, count, count / total))
@@ -0,0 +1,120 @@
+# Zero-network replay of past runs.  After changing how responses are scored (e.g. utils.is_match,
+# the entail/contradict detection in call_gpt_with_sara.py, or the dollar regex in
+# call_gpt_with_sara_numerical.py), rerun the experiment script in replay mode: it rebuilds its
+# prompts as usual, but each call is answered from the responses already in the logs (or archives,
+# see log_archive.py), so the script's current scoring code gives updated results in seconds.
+#
+# A call whose prompt is not in the logs is not sent; it raises utils.ResponsePending, which the
+# scripts catch and count, and the request is added to a file of missing requests, in the batch
+# format of batch_file.py, to be run live or as a batch.  Nothing is written to gpt3_log.txt
+# during a replay, since the responses are already there.
+#
+# Usage, from the script's directory, e.g.:
+#   python ../replay.py --logs gpt3_log.txt call_gpt_with_sara.py --letsthink Yes --withstatute no --ptype 0shot
+# or set the environment variables yourself:
+#   GPT_REPLAY          logs and/or archives to take responses from, comma separated
+#   GPT_REPLAY_MISSING  where to add the requests whose prompts are missing (default replay_missing.jsonl)
+
+import os, json, threading
+import log_archive
+import batch_file
+
+lock = threading.Lock()
+loaded = {"filenames": None, "texts": {}, "archives": [], "missing": set()}
+replay_metrics = {"answered": 0, "missing": 0}
+
+def is_enabled() -> bool:
+    return os.getenv("GPT_REPLAY", "") != ""
+
+def get_missing_filename() -> str:
+    return os.getenv("GPT_REPLAY_MISSING", "replay_missing.jsonl")
+
+# (Re)loads the logs if the settings changed; call holding lock.  Text logs are parsed into memory,
+# as (engine, prompt) -> records; archives are looked up through their index.
+def load_logs():
+    filenames = [name for name in os.getenv("GPT_REPLAY").split(",") if name != ""]
+    if loaded["filenames"] == filenames:
+        return
+    if os.path.exists(get_missing_filename()): # from an earlier replay
+        loaded["missing"] = set([request["custom_id"] for request in batch_file.read_jsonl(get_missing_filename())])
+    loaded["texts"] = {}
+    loaded["archives"] = []
+    for filename in filenames:
+        if os.path.exists(log_archive.get_index_filename(filename)):
+            loaded["archives"].append(log_archive.archive_reader(filename))
+        else:
+            for record, _ in log_archive.parse_log(filename):
+                loaded["texts"].setdefault((record["engine"], record["prompt"]), []).append(record)
+    loaded["filenames"] = filenames
+
+def same_params(record:dict, params:dict) -> bool:
+    # as logged by utils.py, to 2 decimal places
+    for name, value in params.items():
+        logged = record["params"].get(name)
+        if isinstance(value, float) or isinstance(logged, float):
+            if round(float(value), 2) != round(float(logged), 2):
+                return False
+        elif value != logged:
+            return False
+    return True
+
+# The most recent logged response to this prompt (as written in the log) with these parameters, or None
+def find_response(engine:str, prompt:str, params:dict) -> str:
+    with lock:
+        load_logs()
+        records = list(loaded["texts"].get((engine, prompt), []))
+        for reader in loaded["archives"]:
+            records += reader.find(prompt=prompt, engine=engine)
+    records = [r for r in records if same_params(r, params)]
+    if len(records) == 0:
+        return None
+    return records[-1]["response"]
+
+# Returns the response to a call, shaped like the API's; key and body are as for batch_file.get_response().
+# Raises ResponsePending, after adding the request to the missing file, if the prompt was never logged.
+def get_response(key:str, kind:str, body:dict, logged_prompt:str, params:dict) -> dict:
+    response_text = find_response(body["model"], logged_prompt, params)
+    if response_text is not None:
+        with lock:
+            replay_metrics["answered"] += 1
+        if kind == "chat":
+            return {"choices": [{"message": {"role": "assistant", "content": response_text}}]}
+        return {"choices": [{"text": response_text}]}
+    custom_id = batch_file.get_custom_id(key)
+    with lock:
+        replay_metrics["missing"] += 1
+        if not custom_id in loaded["missing"]:
+            with open(get_missing_filename(), "a", encoding="utf-8") as f:
+                f.write(json.dumps({"custom_id": custom_id, "method": "POST", "url": batch_file.URLS[kind],
+                                    "body": body}, ensure_ascii=False) + "\n")
+            loaded["missing"].add(custom_id)
+    raise batch_file.ResponsePending(custom_id)
+
+def get_replay_report() -> str:
+    with lock:
+        rv = "replay: {:d} calls answered from the logs, {:d} missing".format(
+            replay_metrics["answered"], replay_metrics["missing"])
+        if replay_metrics["missing"] > 0:
+            rv += " (requests in " + get_missing_filename() + ")"
+        return rv
+
+if __name__ == "__main__":
+    import argparse, runpy, sys
+    parser = argparse.ArgumentParser(description='Rerun an experiment script, answering its calls from the logs instead of the API')
+    parser.add_argument('--logs', default="gpt3_log.txt",
+                        help='logs and/or archives (see log_archive.py) to take the responses from, comma separated')
+    parser.add_argument('--missing', default="replay_missing.jsonl",
+                        help='where to add the requests for prompts not in the logs, in batch format')
+    parser.add_argument('script',
+                        help='the experiment script to run')
+    parser.add_argument('script_args', nargs=argparse.REMAINDER,
+                        help='arguments for the script')
+    args = parser.parse_args()
+
+    for filename in args.logs.split(","):
+        assert os.path.exists(filename), "No such log " + filename
+    os.environ["GPT_REPLAY"] = args.logs
+    os.environ["GPT_REPLAY_MISSING"] = args.missing
+    sys.argv = [args.script] + args.script_args
+    sys.path.insert(0, os.path.dirname(os.path.abspath(args.script))) # as if the script were run directly
+    runpy.run_path(args.script, run_name="__main__") # utils.py prints the replay report at exit
@@ -2,7 +2,7 @@
 # Contradiction (i.e., not dollar figures).
 import json, sys, argparse
 sys.path.append('../')
-import utils
+import utils, pipeline
 from utils import is_entail, is_contra, is_entail_or_contra, reformat_case, print_confusion_matrix
 
 ENTAILMENT = "Entailment" # these ensure string typos don't throw off statistics
@@ -30,113 +30,174 @@ parser.add_argument('--ptype', required=True, choices=["0shot", "4shot", "chaino
                     help='These are the basic types of prompting we handle')
 parser.add_argument('--model', default="text-davinci-003",
                     help='name of the openai model to call')
+parser.add_argument('--force', nargs="*", default=[],
+                    help='pipeline stages to rerun even if cached, e.g. ask')
 
 args = parser.parse_args()
 
-max_tokens = 1200  # works safely for most of our calls to GPT3
-
-CoT_text = "" # if we are doing chain of thought reasoning, we should read in the hand-crafted chains now
-if args.ptype == "chainofthought":
-    if args.withstatute == "Yes":
-        with open("sara-chain-of-thought-prompt.txt", "r") as fCOT:
-            CoT_text = fCOT.read()
-        max_tokens = 336 # most that can be accomodated with this prompt as is
-    else:
-        with open("sara-chain-of-thought-prompt-NOSTATUTES.txt", "r") as fCOT:
-            CoT_text = fCOT.read()
-
-num_run = 0
-
-# used to get the confusion matrix for dollar-figure-based entailment problems
-dollar_groundtruth_vs_response = { ENTAILMENT: {ENTAILMENT:0, CONTRADICTION:0, "unclear":0},
-                                  CONTRADICTION: {ENTAILMENT:0, CONTRADICTION:0, "unclear":0}}
-nodollar_groundtruth_vs_response = { ENTAILMENT: {ENTAILMENT:0, CONTRADICTION:0, "unclear":0},
-                                  CONTRADICTION: {ENTAILMENT:0, CONTRADICTION:0, "unclear":0}}
-
-utils.add_comment("START " + __file__)
-
 START_PROMPT = "We are going to be doing Entailment/Contradiction reasoning applying the statute below:\n\n"
 
-json_records = json.load(open('statutory-reasoning-gpt-prompts.json', 'r'))
-for json_item in json_records:
-    if not is_entail_or_contra(json_item["answer"]):
-        continue # only handling non-number cases in this file; number cases are in call_gpt_with_sara_numerical.py
-
-    has_dollar = ("$" in json_item['test case']) # separates out the numerical and non-numerical ones
-
-    prompt = ""
-    if args.ptype == "chainofthought":
-        prompt += CoT_text
-    else:
-        if args.withstatute == "Yes":
-            prompt += START_PROMPT
-            prompt += json_item['statute'].replace("\n\n", "\n")  # removes double newlines
-            prompt = prompt.strip() + "\n\n"
-
-        if args.ptype == "4shot":
-            prompt += reformat_case(json_item['case1'],     "Premise: ", "Hypothesis: ", "Answer: ",
-                                    add_cite_before_section=(args.withstatute == "no")) + "\n\n"
-            prompt += reformat_case(json_item['case2'],     "Premise: ", "Hypothesis: ", "Answer: ",
-                                    add_cite_before_section=(args.withstatute == "no")) + "\n\n"
-            prompt += reformat_case(json_item['case3'],     "Premise: ", "Hypothesis: ", "Answer: ",
-                                    add_cite_before_section=(args.withstatute == "no")) + "\n\n"
-            prompt += reformat_case(json_item['case4'],     "Premise: ", "Hypothesis: ", "Answer: ",
-                                    add_cite_before_section=(args.withstatute == "no")) + "\n"
-    prompt = prompt.strip() + "\n\n"
-
-    # Now the one we want answered:
-    prompt += reformat_case(json_item['test case'], "Premise: ", "Hypothesis: ", "Answer: ", True,
-                            add_cite_before_section=(args.withstatute == "no"))
-
-    if args.letsthink == "Yes":
-        prompt += "Let's think step by step." # following Kojima et al. 2022
-
-    prompt = prompt.strip() # GPT-* apparently does not like whitespace at the start or end of the prompt
-
-    utils.add_comment("Doing case id=" + json_item["case id"])
-    first_response = utils.call_gpt3_withlogging(prompt, args.model, max_tokens=max_tokens)
-    utils.add_comment("NOTE that correct response is " + json_item["answer"])
-
+# The stages of the experiment, run by pipeline.py so that e.g. changing how responses are
+# classified reuses the cached model responses.  The log is as it always was, but the results are
+# printed once all the cases have been asked, rather than as each one is.
+
+def load_cases() -> list:
+    json_records = json.load(open('statutory-reasoning-gpt-prompts.json', 'r'))
+    # only handling non-number cases in this file; number cases are in call_gpt_with_sara_numerical.py
+    return [json_item for json_item in json_records if is_entail_or_contra(json_item["answer"])]
+
+# Returns the hand-crafted chains (if we are doing chain of thought reasoning) and max_tokens
+def load_chain_of_thought(ptype, withstatute):
+    max_tokens = 1200  # works safely for most of our calls to GPT3
+    CoT_text = ""
+    if ptype == "chainofthought":
+        if withstatute == "Yes":
+            with open("sara-chain-of-thought-prompt.txt", "r") as fCOT:
+                CoT_text = fCOT.read()
+            max_tokens = 336 # most that can be accomodated with this prompt as is
+        else:
+            with open("sara-chain-of-thought-prompt-NOSTATUTES.txt", "r") as fCOT:
+                CoT_text = fCOT.read()
+    return CoT_text, max_tokens
+
+def build_prompts(json_records, chain_of_thought, letsthink, withstatute, ptype) -> list:
+    CoT_text, _ = chain_of_thought
+    rv = []
+    for json_item in json_records:
+        prompt = ""
+        if ptype == "chainofthought":
+            prompt += CoT_text
+        else:
+            if withstatute == "Yes":
+                prompt += START_PROMPT
+                prompt += json_item['statute'].replace("\n\n", "\n")  # removes double newlines
+                prompt = prompt.strip() + "\n\n"
+
+            if ptype == "4shot":
+                prompt += reformat_case(json_item['case1'],     "Premise: ", "Hypothesis: ", "Answer: ",
+                                        add_cite_before_section=(withstatute == "no")) + "\n\n"
+                prompt += reformat_case(json_item['case2'],     "Premise: ", "Hypothesis: ", "Answer: ",
+                                        add_cite_before_section=(withstatute == "no")) + "\n\n"
+                prompt += reformat_case(json_item['case3'],     "Premise: ", "Hypothesis: ", "Answer: ",
+                                        add_cite_before_section=(withstatute == "no")) + "\n\n"
+                prompt += reformat_case(json_item['case4'],     "Premise: ", "Hypothesis: ", "Answer: ",
+                                        add_cite_before_section=(withstatute == "no")) + "\n"
+        prompt = prompt.strip() + "\n\n"
+
+        # Now the one we want answered:
+        prompt += reformat_case(json_item['test case'], "Premise: ", "Hypothesis: ", "Answer: ", True,
+                                add_cite_before_section=(withstatute == "no"))
+
+        if letsthink == "Yes":
+            prompt += "Let's think step by step." # following Kojima et al. 2022
+
+        prompt = prompt.strip() # GPT-* apparently does not like whitespace at the start or end of the prompt
+        rv.append({"case id": json_item["case id"], "answer": json_item["answer"], "prompt": prompt,
+                   "has_dollar": ("$" in json_item['test case'])}) # separates out the numerical and non-numerical ones
+    return rv
+
+def get_second_prompt(prompt, first_response) -> str:
     stripped_response = first_response.lstrip() # note that there is a space at the start of what will be appended
     if not stripped_response[0].isspace():
         stripped_response = " " + stripped_response
-    second_prompt = prompt + \
-                    stripped_response + \
-                    " Therefore, the answer (Entailment or Contradiction) is" # see Kojima et al 2022 A.5
-    second_response = utils.call_gpt3_withlogging(second_prompt,
-                                                  args.model,
-                                                  max_tokens=(max_tokens-len(first_response.split()))) # approximate
-
-    if is_entail(json_item["answer"]):
-        groundtruth = ENTAILMENT
-    else:
-        groundtruth = CONTRADICTION
-
-    entail = "entail" in second_response.lower()
-    contradict = "contradict" in second_response.lower()
-    if entail and contradict:
-        print("Got BOTH entail and contradict!")
-        response = "unclear"
-    elif entail:
-        response = ENTAILMENT
-    elif contradict:
-        response = CONTRADICTION
-    else:
-        response = "unclear"
-
-    print("{:15s}".format(json_item["case id"]),
-          "GPT Response: {:20s}".format(second_response),
-          "Interpreted as: {:15s}".format(response),
-          "Groundtruth:", json_item["answer"])
-
-    if has_dollar:
-        dollar_groundtruth_vs_response[groundtruth][response] += 1
-        print("dollar_groundtruth_vs_response:", dollar_groundtruth_vs_response)
-    else:
-        nodollar_groundtruth_vs_response[groundtruth][response] += 1
-        print("nodollar_groundtruth_vs_response", nodollar_groundtruth_vs_response)
+    return prompt + \
+           stripped_response + \
+           " Therefore, the answer (Entailment or Contradiction) is" # see Kojima et al 2022 A.5
+
+# Asks each case and then for its answer, logging the two calls of a case together as the script
+# always has.  Returns the second response per case, or None where still pending in batch mode,
+# in which case they are not cached.
+def ask(prompts, chain_of_thought, model):
+    _, max_tokens = chain_of_thought
+    rv = []
+    for case in prompts:
+        utils.add_comment("Doing case id=" + case["case id"])
+        try:
+            first_response = utils.call_gpt3_withlogging(case["prompt"], model, max_tokens=max_tokens)
+        except utils.ResponsePending:
+            first_response = None
+        utils.add_comment("NOTE that correct response is " + case["answer"])
+        if first_response is None:
+            rv.append(None)
+            continue
+        try:
+            rv.append(utils.call_gpt3_withlogging(get_second_prompt(case["prompt"], first_response),
+                                                  model,
+                                                  max_tokens=(max_tokens-len(first_response.split())))) # approximate
+        except utils.ResponsePending:
+            rv.append(None)
+    return pipeline.uncached(rv) if None in rv else rv
+
+# Returns the interpretation of each response (None if pending), and whether it had both entail and contradict
+def classify(second_responses) -> list:
+    rv = []
+    for second_response in second_responses:
+        if second_response is None:
+            rv.append((None, False))
+            continue
+        entail = "entail" in second_response.lower()
+        contradict = "contradict" in second_response.lower()
+        if entail and contradict:
+            response = "unclear"
+        elif entail:
+            response = ENTAILMENT
+        elif contradict:
+            response = CONTRADICTION
+        else:
+            response = "unclear"
+        rv.append((response, entail and contradict))
+    return rv
+
+# Returns the lines to print for each case, and the confusion matrices for the cases with and without dollar figures
+def aggregate(prompts, second_responses, classified):
+    # used to get the confusion matrix for dollar-figure-based entailment problems
+    dollar_groundtruth_vs_response = { ENTAILMENT: {ENTAILMENT:0, CONTRADICTION:0, "unclear":0},
+                                      CONTRADICTION: {ENTAILMENT:0, CONTRADICTION:0, "unclear":0}}
+    nodollar_groundtruth_vs_response = { ENTAILMENT: {ENTAILMENT:0, CONTRADICTION:0, "unclear":0},
+                                      CONTRADICTION: {ENTAILMENT:0, CONTRADICTION:0, "unclear":0}}
+    lines = []
+    num_pending = 0
+    for case, second_response, (response, both) in zip(prompts, second_responses, classified):
+        if response is None:
+            num_pending += 1
+            continue
+        if is_entail(case["answer"]):
+            groundtruth = ENTAILMENT
+        else:
+            groundtruth = CONTRADICTION
+        if both:
+            lines.append("Got BOTH entail and contradict!")
+        lines.append(" ".join(["{:15s}".format(case["case id"]),
+                               "GPT Response: {:20s}".format(second_response),
+                               "Interpreted as: {:15s}".format(response),
+                               "Groundtruth:", case["answer"]]))
+        if case["has_dollar"]:
+            dollar_groundtruth_vs_response[groundtruth][response] += 1
+            lines.append("dollar_groundtruth_vs_response: " + str(dollar_groundtruth_vs_response))
+        else:
+            nodollar_groundtruth_vs_response[groundtruth][response] += 1
+            lines.append("nodollar_groundtruth_vs_response " + str(nodollar_groundtruth_vs_response))
+    return lines, dollar_groundtruth_vs_response, nodollar_groundtruth_vs_response, num_pending
 
+utils.add_comment("START " + __file__)
 
+experiment = pipeline.pipeline("call_gpt_with_sara")
+experiment.add("cases", load_cases, files=["statutory-reasoning-gpt-prompts.json"])
+experiment.add("chain_of_thought", load_chain_of_thought, params={"ptype": args.ptype, "withstatute": args.withstatute},
+               files=["sara-chain-of-thought-prompt.txt", "sara-chain-of-thought-prompt-NOSTATUTES.txt"])
+experiment.add("prompts", build_prompts, ["cases", "chain_of_thought"],
+               {"letsthink": args.letsthink, "withstatute": args.withstatute, "ptype": args.ptype}, code=[reformat_case])
+experiment.add("ask", ask, ["prompts", "chain_of_thought"], {"model": args.model}, code=[get_second_prompt])
+experiment.add("classify", classify, ["ask"])
+experiment.add("aggregate", aggregate, ["prompts", "ask", "classify"], code=[is_entail])
+lines, dollar_groundtruth_vs_response, nodollar_groundtruth_vs_response, num_pending = \
+    experiment.run(force=args.force)["aggregate"]
+
+for line in lines:
+    print(line)
+
+if num_pending > 0:
+    print("NOTE", num_pending, "cases are still waiting on batch responses and are not counted below")
 print("FINAL dollar_groundtruth_vs_response:")
 print_confusion_matrix(dollar_groundtruth_vs_response)
 print("FINAL nodollar_groundtruth_vs_response:")
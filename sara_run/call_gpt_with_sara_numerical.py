@@ -6,7 +6,7 @@ import json, sys, argparse
 import re
 
 sys.path.append('../')
-import utils
+import utils, pipeline
 
 MODEL = "gpt-4-0314" # maximizes reproducability by using frozen version
 
@@ -25,61 +25,116 @@ def dollar_string_to_float(txt) -> float:
     txt = txt.strip()
     return float(txt)
 
+# The stages of the experiment, run by pipeline.py so that e.g. changing the dollar regex reuses
+# the cached model responses.  The log is as it always was, but the results are printed once all
+# the cases have been asked, rather than as each one is.
+
 # Gather the set of just the numerical cases (i.e., where answers are dollar figures)
-dollar_cases = [] # stored as a list of tuples of 2-tuples of (question, answer)
-json_records = json.load(open('statutory-reasoning-gpt-prompts.json', 'r'))
-for json_item in json_records:
-    if "$" in json_item["answer"]:
-        dollar_cases.append((json_item["test case"], json_item["answer"]))
-    for training_case in ["case1", "case2", "case3", "case4"]:
-        if json_item[training_case][-1].isnumeric():
-            idx_dollar = json_item[training_case].rfind("$")
-            assert idx_dollar > (len(json_item[training_case]) - 10)
-            dollar_cases.append((json_item[training_case][:idx_dollar].rstrip(),
-                                 json_item[training_case][idx_dollar:].strip()))
-
-print("len(dollar_cases)=",len(dollar_cases))
-# for rec in dollar_cases:
-#     print(rec[0],"\n\t", rec[1])
+def load_dollar_cases() -> list:
+    dollar_cases = [] # stored as a list of tuples of 2-tuples of (question, answer)
+    json_records = json.load(open('statutory-reasoning-gpt-prompts.json', 'r'))
+    for json_item in json_records:
+        if "$" in json_item["answer"]:
+            dollar_cases.append((json_item["test case"], json_item["answer"]))
+        for training_case in ["case1", "case2", "case3", "case4"]:
+            if json_item[training_case][-1].isnumeric():
+                idx_dollar = json_item[training_case].rfind("$")
+                assert idx_dollar > (len(json_item[training_case]) - 10)
+                dollar_cases.append((json_item[training_case][:idx_dollar].rstrip(),
+                                     json_item[training_case][idx_dollar:].strip()))
+    return dollar_cases
 
 # Load SARA statutes to put at start of prompt
-with open('all_sara_statutes.txt', 'r') as f:
-    all_sara_statutes = f.read()
+def load_statutes() -> str:
+    with open('all_sara_statutes.txt', 'r') as f:
+        return f.read()
 
-# The results will be stored as 2-tuples of (float groundtruth, float predicted by GPT)
-groundtruth_vs_predicted = []
-
-for case in dollar_cases:
+def get_messages(case, all_sara_statutes) -> list:
     prompt = all_sara_statutes + "\n\n" + case[0]
-
-    print("RUNNING:", case[0])
-    print("Groundtruth:", case[1])
-    groundtruth = dollar_string_to_float(case[1])
-
-    messages = [
+    return [
         {"role": "system", "content": SYSTEM_TEXT},
         {"role": "user", "content": prompt}
     ]
 
-    response = utils.call_gpt_raw(messages, MODEL)
-    print("Response 1:", response)
-    utils.add_comment("Correct answer=" + case[1])
-
-    messages2 = messages.copy()
-    messages2.append({"role": "assistant", "content": response})
-    messages2.append({"role": "user", "content": "Therefore, the answer (dollar figure) is:"})
-    response2 = utils.call_gpt_raw(messages2, MODEL, max_tokens=300) # may run out of space
-
-    response2_dollar_figure = re.search("\$(\d|,)*\d(\.\d\d)?\.?\s*$",  response2)
-
-    if response2_dollar_figure is not None:
-        dollar_amount = dollar_string_to_float(response2_dollar_figure[0])
-    else:
-        print("Got no good dollar figure:", response2)
-        continue
+# Asks each case and then for its dollar figure, logging the two calls of a case together as the
+# script always has.  Returns a 2-tuple of (first response, second response) per case, or None
+# where still pending in batch mode, in which case they are not cached.
+def ask(dollar_cases, all_sara_statutes, model):
+    rv = []
+    for case in dollar_cases:
+        messages = get_messages(case, all_sara_statutes)
+        try:
+            response = utils.call_gpt_raw(messages, model)
+        except utils.ResponsePending:
+            response = None
+        utils.add_comment("Correct answer=" + case[1])
+        if response is None:
+            rv.append(None)
+            continue
+        messages2 = messages.copy()
+        messages2.append({"role": "assistant", "content": response})
+        messages2.append({"role": "user", "content": "Therefore, the answer (dollar figure) is:"})
+        try:
+            rv.append((response, utils.call_gpt_raw(messages2, model, max_tokens=300))) # may run out of space
+        except utils.ResponsePending:
+            rv.append(None)
+    return pipeline.uncached(rv) if None in rv else rv
+
+# The dollar figure at the end of each response, or None if there is none
+def extract_dollar_figures(responses) -> list:
+    rv = []
+    for case_responses in responses:
+        response2_dollar_figure = None
+        if case_responses is not None:
+            response2_dollar_figure = re.search("\$(\d|,)*\d(\.\d\d)?\.?\s*$",  case_responses[1])
+        if response2_dollar_figure is not None:
+            rv.append(dollar_string_to_float(response2_dollar_figure[0]))
+        else:
+            rv.append(None)
+    return rv
+
+# Returns the lines to print for each case, and 2-tuples of (float groundtruth, float predicted by GPT)
+def aggregate(dollar_cases, responses, dollar_amounts):
+    lines = []
+    groundtruth_vs_predicted = []
+    num_pending = 0 # in batch or replay mode, cases still waiting on a response
+    for case, case_responses, dollar_amount in zip(dollar_cases, responses, dollar_amounts):
+        lines.append("RUNNING: " + case[0])
+        lines.append("Groundtruth: " + case[1])
+        groundtruth = dollar_string_to_float(case[1])
+        if case_responses is None:
+            num_pending += 1
+            continue
+        response, response2 = case_responses
+        lines.append("Response 1: " + response)
+        if dollar_amount is None:
+            lines.append("Got no good dollar figure: " + response2)
+            continue
+        lines.append("RESULT gt {:11.2f} pred {:11.2f}".format(groundtruth, dollar_amount))
+        groundtruth_vs_predicted.append((groundtruth, dollar_amount))
+    return lines, groundtruth_vs_predicted, num_pending
+
+parser = argparse.ArgumentParser(description='Call GPT-4 with the SARA cases answered by dollar figures')
+parser.add_argument('--force', nargs="*", default=[],
+                    help='pipeline stages to rerun even if cached, e.g. ask')
+args = parser.parse_args()
+
+experiment = pipeline.pipeline("call_gpt_with_sara_numerical")
+experiment.add("cases", load_dollar_cases, files=["statutory-reasoning-gpt-prompts.json"])
+experiment.add("statutes", load_statutes, files=["all_sara_statutes.txt"])
+experiment.add("ask", ask, ["cases", "statutes"], {"model": MODEL}, code=[get_messages])
+experiment.add("extract", extract_dollar_figures, ["ask"], code=[dollar_string_to_float])
+experiment.add("aggregate", aggregate, ["cases", "ask", "extract"], code=[dollar_string_to_float])
+outputs = experiment.run(force=args.force)
+lines, groundtruth_vs_predicted, num_pending = outputs["aggregate"]
+
+print("len(dollar_cases)=",len(outputs["cases"]))
+# for rec in dollar_cases:
+#     print(rec[0],"\n\t", rec[1])
 
-    print("RESULT gt {:11.2f} pred {:11.2f}".format(groundtruth, dollar_amount))
-    groundtruth_vs_predicted.append((groundtruth, dollar_amount))
+for line in lines:
+    print(line)
 
 print("len(groundtruth_vs_predicted)=", len(groundtruth_vs_predicted))
-
+if num_pending > 0:
+    print("num_pending=", num_pending, "(waiting on responses, so not counted)")
@@ -0,0 +1,142 @@
+# Shared helpers for extracting and compacting statutory text from the U.S. Code XML.
+# The tree is walked iteratively and the text pieces are joined once at the end, rather than
+# built up by repeated string concatenation, which was quadratic on deeply nested sections.
+# Uses lxml to parse if it is installed, which is considerably faster on the large titles.
+
+import xml.etree.ElementTree as ET
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+usc_ns_str = "http://xml.house.gov/schemas/uslm/1.0"
+ns = {"usc" : usc_ns_str}
+
+USE_LXML = lxml_etree is not None # can be turned off to force the standard library parser
+
+# Parses a title's XML and returns the root element
+def parse_title(filename:str, use_lxml=None):
+    if use_lxml is None:
+        use_lxml = USE_LXML
+    if use_lxml:
+        assert lxml_etree is not None, "lxml is not installed"
+        # Dropping comments and processing instructions at parse time merges the text around
+        # them, just as ElementTree does, so the extracted text is identical.
+        parser = lxml_etree.XMLParser(remove_comments=True, remove_pis=True, huge_tree=True)
+        return lxml_etree.parse(filename, parser).getroot()
+    return ET.parse(filename).getroot()
+
+# Gets all non-header text from NON-repealed sections
+def get_IRC_text(x, top_level = True) -> str:
+    pieces = []
+    append = pieces.append
+    if x.text is not None:
+        append(x.text)
+        append(" ")
+    stack = [(x, iter(x), top_level)] # (element, iterator over its remaining children, whether top level)
+    while len(stack) > 0:
+        element, children, is_top_level = stack[-1]
+        for sub in children:
+            if "status" in sub.attrib:
+                # Count of statuses in all of IRC was the following: {'': 519201, 'repealed': 32}
+                # Thus we are making the assumption asserted below
+                assert sub.attrib["status"] in ["repealed" , 'transferred']
+                continue
+            tag = sub.tag
+            if "sourceCredit" in tag or \
+                    "notes" in tag or \
+                    (is_top_level and ("num" in tag or "heading" in tag)):
+                continue
+            if sub.text is not None:
+                append(sub.text)
+                append(" ")
+            stack.append((sub, iter(sub), False)) # descend; come back to element's other children later
+            break
+        else: # all children done, so the tail comes next
+            stack.pop()
+            if element.tail is not None:
+                append(element.tail)
+                append(" ")
+    return "".join(pieces)
+
+def compact_statute(orig_text:str) -> str:
+    rv = "".join([line.rstrip() + "\n" for line in orig_text.split("\n") if not line.isspace()])
+    rv = rv.replace("\n\n", "\n")
+    return rv
+
+# The original recursive, concatenating implementations, kept as the reference that the ones
+# above must match byte for byte (see the benchmark below and tests/test_statute_text.py)
+def get_IRC_text_recursive(x, top_level = True) -> str:
+    rv = ""
+    if x.text is not None:
+        rv += x.text + " "
+    for sub in x:
+        if "status" not in sub.attrib:
+            if "sourceCredit" not in sub.tag and \
+                    "notes" not in sub.tag and \
+                    (not top_level or ("num" not in sub.tag and "heading" not in sub.tag)):
+                rv += get_IRC_text_recursive(sub, False)
+        else:
+            assert sub.attrib["status"] in ["repealed" , 'transferred']
+    if x.tail is not None:
+        rv += x.tail + " "
+    return rv
+
+def compact_statute_concatenating(orig_text:str) -> str:
+    rv = ""
+    for line in orig_text.split("\n"):
+        if not line.isspace():
+            rv += line.rstrip() + "\n"
+    rv = rv.replace("\n\n", "\n")
+    return rv
+
+if __name__ == "__main__":
+    # Throughput benchmark, which also checks that the output is byte-identical to the
+    # original recursive implementation on every section of every title.
+    import argparse, os, time
+
+    parser = argparse.ArgumentParser(description='Benchmark and check U.S. Code text extraction')
+    parser.add_argument('--usc_directory', default="probe_statute_knowledge/xml_uscAll@117-327not263not286",
+                        help='directory holding the uscNN.xml files')
+    parser.add_argument('--titles', type=int, nargs="*", default=list(range(1, 55)),
+                        help='which titles to run over')
+    args = parser.parse_args()
+
+    parsers = ["ElementTree"]
+    if lxml_etree is not None:
+        parsers.append("lxml")
+
+    print("{:>5s} {:>9s} {:>8s}  {:>12s} {:>12s} {:>12s}".format(
+        "title", "sections", "MB", "old sec/s", "new sec/s", "speedup"))
+    for title in args.titles:
+        filename = args.usc_directory + "/usc" + ("0" if title < 10 else "") + str(title) + ".xml"
+        if not os.path.exists(filename):
+            continue
+        megabytes = os.path.getsize(filename) / 1e6
+        for parser_name in parsers:
+            start = time.perf_counter()
+            root = parse_title(filename, use_lxml=(parser_name == "lxml"))
+            parse_time = time.perf_counter() - start
+            sections = [s for s in root.iter('{' + usc_ns_str + '}section') if "identifier" in s.attrib]
+
+            start = time.perf_counter()
+            old_texts = [compact_statute_concatenating(get_IRC_text_recursive(s)) for s in sections]
+            old_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            new_texts = [compact_statute(get_IRC_text(s)) for s in sections]
+            new_time = time.perf_counter() - start
+
+            for s, old_text, new_text in zip(sections, old_texts, new_texts):
+                assert old_text == new_text, "Mismatch in " + s.attrib["identifier"]
+            if parser_name == "lxml": # also must match what ElementTree gives
+                et_sections = [s for s in ET.parse(filename).getroot().iter('{' + usc_ns_str + '}section')
+                               if "identifier" in s.attrib]
+                assert len(et_sections) == len(sections)
+                for s, new_text in zip(et_sections, new_texts):
+                    assert compact_statute(get_IRC_text(s)) == new_text, "lxml mismatch in " + s.attrib["identifier"]
+
+            print("{:5d} {:9d} {:8.1f}  {:12.1f} {:12.1f} {:11.2f}x  (parse with {:s}: {:.2f}s)".format(
+                title, len(sections), megabytes,
+                len(sections) / max(old_time, 1e-9), len(sections) / max(new_time, 1e-9),
+                old_time / max(new_time, 1e-9), parser_name, parse_time))
@@ -3,8 +3,12 @@
 # N-shot, etc.
 
 import generate_synstat
-from generate_synstat import statute_part
-import sys, argparse
+import term_source
+import synstat_dataset
+from generate_synstat import statute_part, does_A_apply_to_anyB
+from tree_index import tree_index
+from synstat_ask import ask_query
+import sys, argparse, functools, multiprocessing
 sys.path.append('../')
 import utils
 import random
@@ -24,8 +28,8 @@ parser.add_argument('--width', required=True, type=int,
                     help='Width of the synthetic tree to generate; 2 or 3 are common')
 parser.add_argument('--depth', required=True, type=int,
                     help='Depth of the synthetic tree to generate; 2 or 3 are common')
-parser.add_argument('--termtype', required=True, choices=["nonces", "ids"],
-                    help='These are the basic types of prompting we handle')
+parser.add_argument('--termtype', required=True, choices=["nonces", "ids", "pseudowords", "unlimited_ids"],
+                    help='These are the basic types of prompting we handle; pseudowords and unlimited_ids never run out (see term_source.py)')
 parser.add_argument('--numruns', required=True, type=int,
                     help='These are the basic types of prompting we handle')
 parser.add_argument('--perrun', type=int, default=0,
@@ -48,6 +52,16 @@ parser.add_argument('--model', default="text-davinci-003",
                     help='which openai model to use')
 parser.add_argument('--question_form', type=int, default=6,
                     help='how to phrase question; e.g. "Does section __ apply to __?"')
+parser.add_argument('--gen_workers', type=int, default=0,
+                    help='if >0, generate the statutes for upcoming runs in this many worker processes')
+parser.add_argument('--prune_prompt', action="store_true",
+                    help='put only the subsections relevant to each question in the prompt, rather than the full statute')
+parser.add_argument('--distractors', type=int, default=0,
+                    help='with --prune_prompt, also include up to this many sibling subsections of each relevant one')
+parser.add_argument('--export', default=None,
+                    help='instead of calling GPT, write the queries as a sharded dataset to this directory (see synstat_dataset.py)')
+parser.add_argument('--shard_size', type=int, default=synstat_dataset.DEFAULT_SHARD_SIZE,
+                    help='with --export, the number of queries per shard')
 
 
 args = parser.parse_args()
@@ -69,60 +83,34 @@ if args.do_sentences and args.Nshot > 0:
     print("Doing sentences with N-shot for N>0 not yet implemented")
     exit(0)
 
+if args.gen_workers > 0 and not "fork" in multiprocessing.get_all_start_methods():
+    print("gen_workers needs the fork start method, which this platform lacks")
+    exit(0)
+
+if args.distractors > 0 and not args.prune_prompt:
+    print("distractors only make sense with prune_prompt")
+    exit(0)
+
 if args.max_num > 0 and args.max_num <= args.skip_first:
     print("Expected max_num to be greater than skip_first.  We run from skip_first to max_num.")
     print("Got max_num=", args.max_num, "and skip_first=", args.skip_first)
     exit(0)
 
-# This function derives the ground truth against which we measure accuracy.  It's important.
-# Returns True if it definitely applies.
-# Returns False if it definitely does NOT apply
-# Returns *None* if may or may not apply -- so shouldn't test
-# To understand reasoning, consider statute "(i) foo means (I) any bar or (II) any boo"
-def does_A_apply_to_anyB(A, B):
-    if A == B:
-        if not A.has_children():
-            # if Alice is a boo, then (i)(II) definitely applies to Alice
-            return True
-        else:
-            # If Alice is a foo, then does (i) above apply to Alice?
-            # It's Unclear, since Alice was a foo even without (i).  So return None since ambiguous.
-            return None
-
-    # if A is a parent, grandparent, etc. of B,  it definitely applies
-    # For example, if A is (i) and B is boo.
-    x = B
-    while not x is None:
-        if x == A:
-            assert A != B or not A.has_children()
-            return True
-        x = x.parent
-    # if sentence can be used to construct the part, then arguably applies
-    y = A
-    while not y is None:
-        if y == B:
-            # If Alice is a foo, then does (I) above apply to Alice?
-            # Unclear, so we return None in that circumstance.
-            return None
-        y = y.parent
-    return False
-
-def select_furthest_items(L:list, a:statute_part, b=None) -> list:
+# The index, if given, must be for the tree that L, a and b are all in.
+def select_furthest_items(L:list, a:statute_part, b=None, index:tree_index=None) -> list:
     assert len(L) > 0
-    max_dist = 0
-    for x in L:
-        dist = x.get_dist(a)
-        if b is not None: # if b is provided, we want items that maximize the distance from b as well
-            dist += x.get_dist(b)
-        max_dist = max(max_dist, dist)
-    rv = []
+    if index is None:
+        get_dist = lambda x, y: x.get_dist(y)
+    else:
+        get_dist = index.get_dist
+    dists = []
     for x in L:
-        dist = x.get_dist(a)
+        dist = get_dist(x, a)
         if b is not None: # if b is provided, we want items that maximize the distance from b as well
-            dist += x.get_dist(b)
-        if dist == max_dist:
-            rv.append(x)
-    return rv
+            dist += get_dist(x, b)
+        dists.append(dist)
+    max_dist = max(dists)
+    return [x for x, dist in zip(L, dists) if dist == max_dist]
 
 # We need to use random names with equal change of each gender to avoid bias.
 # The below were drawn from the top 15 baby names each at https://www.ssa.gov/oact/babynames/decades/names2000s.html.
@@ -134,33 +122,38 @@ NAMES = MALE_NAMES.copy()
 NAMES.extend(FEMALE_NAMES) # merge
 
 
-def write_multistatute_Nshot_prompt(args, Nshot_statutes, names_set, test_applies_to, test_person_type) -> str:
+# N-shot prompts are built in two steps, so that prompt text is only rendered for the queries
+# actually asked.  The plan_* functions make all the random choices (and so must be called for
+# every possible query, to keep Nshot_random in step); the write_* functions then render a plan.
+
+# Plans the prompt with N statutes (or N/2), each followed by one (or two) example questions.
+# Returns a list with, for each statute, a tuple of (sec_num, target_subsection, examples),
+# where examples is a list of (name, person_type, is_true).
+def plan_multistatute_Nshot_prompt(args, Nshot_indices, names_set, test_applies_to, test_person_type) -> list:
     if not args.Nshot_type in ["N_samepos", "N/2_samepos"]:
         test_applies_to = test_person_type = None # ensures not used if not appropriate
 
-    rv = ""
+    rv = []
     used_sec_nums = set()
 
     # to ensure balance (not too many false examples or too many true examples)
     # we generate a balanced list of positives and negatives and then randomly shuffle
-    list_positive = [True] * int(len(Nshot_statutes) / 2)
-    list_positive.extend([False] * int(len(Nshot_statutes) / 2))
-    if len(Nshot_statutes) % 2 == 1:
+    list_positive = [True] * int(len(Nshot_indices) / 2)
+    list_positive.extend([False] * int(len(Nshot_indices) / 2))
+    if len(Nshot_indices) % 2 == 1:
         list_positive.append(Nshot_random.random() < 0.5)
     Nshot_random.shuffle(list_positive)
     assert -1 <= (len([x for x in list_positive if x]) - len([x for x in list_positive if not x])) <= 1
 
-    for abst in Nshot_statutes:
+    for abst_index in Nshot_indices:
+        abst = abst_index.parts[0]
         # randomly generate a statute
         sec_num = None
         while sec_num is None or sec_num in used_sec_nums:
             sec_num = Nshot_random.randint(1010, 9999)
         used_sec_nums.add(sec_num)
 
-        # append the statute to the prompt
-        rv += generate_synstat.abstract_to_statute(abst, sec_num=sec_num) + "\n"
-
-        all_parts = generate_synstat.extract_all_used_parts(abst)
+        all_parts = abst_index.parts
 
         name1 = names_set.pop() # the names set was already randomly shuffled
         name2 = names_set.pop()
@@ -179,10 +172,8 @@ def write_multistatute_Nshot_prompt(args, Nshot_statutes, names_set, test_applie
                 assert False, "not implemented"
             target_subsection = Nshot_random.choice(possible_target_subsection)
 
-        true_type = \
-            Nshot_random.choice([p for p in all_parts if True == does_A_apply_to_anyB(target_subsection, p)])
-        false_type = \
-            Nshot_random.choice([p for p in all_parts if False == does_A_apply_to_anyB(target_subsection, p)])
+        true_type = Nshot_random.choice(abst_index.select(abst_index.mask(A=target_subsection, value=True)))
+        false_type = Nshot_random.choice(abst_index.select(abst_index.mask(A=target_subsection, value=False)))
 
         if args.Nshot_type in ["N_samepos", "N/2_samepos"]: # exactly match in position to test type
             if does_A_apply_to_anyB(test_applies_to, test_person_type):
@@ -193,27 +184,39 @@ def write_multistatute_Nshot_prompt(args, Nshot_statutes, names_set, test_applie
         # For N-statute N-shot, generate a true example with 50% chance
         # For N/2-statute N-shot, generate the true example first with 50% chance
         if list_positive.pop():
-            rv += write_facts_and_question(name1, true_type, target_subsection)
-            rv += write_explanation_true(name1, true_type, target_subsection)
+            examples = [(name1, true_type, True)]
             if args.Nshot_type.startswith("N/2"): # now generate a false example
-                rv += write_facts_and_question(name2, false_type, target_subsection)
-                rv += write_explanation_false(name2, target_subsection)
+                examples.append((name2, false_type, False))
         else:
-            rv += write_facts_and_question(name1, false_type, target_subsection)
-            rv += write_explanation_false(name1, target_subsection)
+            examples = [(name1, false_type, False)]
             if args.Nshot_type.startswith("N/2"): # now generate a true example
-                rv += write_facts_and_question(name2, true_type, target_subsection)
-                rv += write_explanation_true(name2, true_type, target_subsection)
+                examples.append((name2, true_type, True))
+        rv.append((sec_num, target_subsection, examples))
 
     assert len(list_positive) == 0, "Should have exactly used up our list of positives or negatives"
     return rv
 
+def write_multistatute_Nshot_prompt(args, Nshot_statutes, render_cache, plan) -> str:
+    rv = ""
+    for abst, (sec_num, target_subsection, examples) in zip(Nshot_statutes, plan):
+        # append the statute to the prompt; this also sets the citations used in the examples
+        rv += render_cache.abstract_to_statute(abst, sec_num=sec_num) + "\n"
+        for name, person_type, is_true in examples:
+            rv += write_facts_and_question(name, person_type, target_subsection, args)
+            if is_true:
+                rv += write_explanation_true(name, person_type, target_subsection)
+            else:
+                rv += write_explanation_false(name, target_subsection)
+    return rv
+
 # This is used for the N-shot prompting where we have a single statute (which is used for test as well)
 # and create N questions (half yes, half no) that come right before the test question.
-def write_1statute_Nshot_prompt(args, names_set, test_applies_to, test_person_type, all_parts) -> str:
+# Returns a list with, for each pair of questions, a tuple of
+# (name1, name2, target_subsection, true_item, false_item, false_first).
+def plan_1statute_Nshot_prompt(args, names_set, test_applies_to, test_person_type, index:tree_index) -> list:
     assert (args.Nshot % 2) == 0
     already_used_subsections = set()
-    rv = ""
+    rv = []
 
     for i in range(0, args.Nshot, 2): # do in pairs
         name1 = names_set.pop()
@@ -222,22 +225,20 @@ def write_1statute_Nshot_prompt(args, names_set, test_applies_to, test_person_ty
         # Both Yes and No questions will be based on the same reference section
         # We randomly choose the reference section.
         example_level = args.depth - 1
-        candidate_subsections = []
-        for x in all_parts:
-            if x.get_level() == example_level:
-                if False == does_A_apply_to_anyB(test_applies_to, x) and \
-                        False == does_A_apply_to_anyB(x, test_applies_to) and \
-                        not x in already_used_subsections:
-                    candidate_subsections.append(x)
+        candidate_mask = index.level_mask(example_level) & \
+                         index.mask(A=test_applies_to, value=False) & \
+                         index.mask(B=test_applies_to, value=False) & \
+                         ~index.parts_mask(already_used_subsections)
+        candidate_subsections = index.select(candidate_mask)
         assert len(candidate_subsections) > 0, "Too few subsections for N shot with N=" + str(args.Nshot)
 
         # We ideally want an example section that doesn't apply to the person type
-        ideal_candidate_subsections = [x for x in candidate_subsections if False == does_A_apply_to_anyB(x, test_person_type)]
+        ideal_candidate_subsections = index.select(candidate_mask & index.mask(B=test_person_type, value=False))
         if len(ideal_candidate_subsections) > 0:
             candidate_subsections = ideal_candidate_subsections
 
         # We want the example to be as far as possible from both the person type and the target section
-        candidate_subsections = select_furthest_items(candidate_subsections, test_person_type, test_applies_to)
+        candidate_subsections = select_furthest_items(candidate_subsections, test_person_type, test_applies_to, index)
         print("For test_person_type=", test_person_type.term, "and ", test_applies_to.stat_defined,
               "candidates:", [x.term + ":" + x.stat_defined for x in candidate_subsections])
 
@@ -247,7 +248,7 @@ def write_1statute_Nshot_prompt(args, names_set, test_applies_to, test_person_ty
         print("  chosen=", target_subsection.term + ":" + target_subsection.stat_defined)
 
         # choose the true target
-        candidates_true = select_furthest_items(target_subsection.get_all_descendants(), test_person_type)
+        candidates_true = select_furthest_items(target_subsection.get_all_descendants(), test_person_type, index=index)
         print("true target candidates are:", [x.term + ":" + x.stat_used for x in candidates_true])
         true_item = Nshot_random.choice(candidates_true)
         print("  true_item chosen=", true_item.term + ":" + true_item.stat_used)
@@ -256,13 +257,11 @@ def write_1statute_Nshot_prompt(args, names_set, test_applies_to, test_person_ty
         assert test_applies_to != true_item
 
         # choose the false target from valid ones, so that it is farthest from the test person type and test applies to
-        candidates_false = []
-        for x in all_parts:
-            if False == does_A_apply_to_anyB(target_subsection, x):
-                candidates_false.append(x)
+        candidates_false = index.select(index.mask(A=target_subsection, value=False))
         assert len(candidates_false) > 0
-        candidates_false = select_furthest_items(candidates_false, test_person_type, test_applies_to)
-        ideal_candidate_subsections_false = [x for x in candidates_false if False == does_A_apply_to_anyB(test_applies_to, x)]
+        candidates_false = select_furthest_items(candidates_false, test_person_type, test_applies_to, index)
+        ideal_candidate_subsections_false = \
+            index.select(index.parts_mask(candidates_false) & index.mask(A=test_applies_to, value=False))
         if len(ideal_candidate_subsections_false) > 0:
             candidates_false = ideal_candidate_subsections_false
         print("false target candidates are:", [x.term + ":" + x.stat_used for x in candidates_false])
@@ -272,8 +271,15 @@ def write_1statute_Nshot_prompt(args, names_set, test_applies_to, test_person_ty
         assert does_A_apply_to_anyB(test_applies_to, false_item) == False or (args.width == 2)
         assert test_applies_to != false_item
 
-        # Generate the actual text.  With 50% probability, the false one comes first, second only second
-        if Nshot_random.random() < 0.5:
+        # With 50% probability, the false one comes first, second only second
+        rv.append((name1, name2, target_subsection, true_item, false_item, Nshot_random.random() < 0.5))
+
+    return rv
+
+def write_1statute_Nshot_prompt(args, plan) -> str:
+    rv = ""
+    for name1, name2, target_subsection, true_item, false_item, false_first in plan:
+        if false_first:
             rv += write_facts_and_question(name1, false_item, target_subsection, args)
             rv += write_explanation_false(name1, target_subsection)
             rv += write_facts_and_question(name2, true_item, target_subsection, args)
@@ -283,7 +289,6 @@ def write_1statute_Nshot_prompt(args, names_set, test_applies_to, test_person_ty
             rv += write_explanation_true(name1, true_item, target_subsection)
             rv += write_facts_and_question(name2, false_item, target_subsection, args)
             rv += write_explanation_false(name2, target_subsection)
-
     return rv
 
 def write_out_sentence(statute):
@@ -395,14 +400,20 @@ def write_facts_and_question(person_name, person_type, target_section, args, sen
 
     return rv
 
+# Describes one possible query.  The prompt text is only rendered, by render_query(), for the
+# queries that filter_and_balance_queries() selects.
 class Query:
     statute_query = None
     sentence_query = None
     groundtruth = None
+    person_type = None
+    applies_target = None
+    person_name = None
+    Nshot_plan = None # from plan_multistatute_Nshot_prompt() or plan_1statute_Nshot_prompt()
 
 
-# This builds up all possible queries.  It returns a list of Query.
-def build_possible_queries(args, all_parts, curr_statute, sentences_form):
+# This builds up all possible queries.  It returns a list of Query, without their prompts.
+def build_possible_queries(args, all_parts, index:tree_index):
     rv = []
 
     if args.subdivs == "leavesonly":
@@ -417,12 +428,14 @@ def build_possible_queries(args, all_parts, curr_statute, sentences_form):
     for person_type in all_parts: # iterate over all the possible types for the person
         for applies_target in parts_to_test: # iterate over all subsections to ask if applies
             query = Query()
+            query.person_type = person_type
+            query.applies_target = applies_target
 
             names_set = NAMES.copy() # we will pop names out
             Nshot_random.shuffle(names_set)
-            person_name = names_set.pop() # this always used to be Alice but is now randomly selected to avoid bias
+            query.person_name = names_set.pop() # this always used to be Alice but is now randomly selected to avoid bias
 
-            query.groundtruth = does_A_apply_to_anyB(applies_target, person_type)
+            query.groundtruth = index.does_A_apply_to_anyB(applies_target, person_type)
 
             if args.subdivs == "leavesonly":
                 assert not applies_target.has_children()
@@ -430,37 +443,84 @@ def build_possible_queries(args, all_parts, curr_statute, sentences_form):
                 assert applies_target.has_children()
 
             if not query.groundtruth is None:
-
-                # Build the question
-                statute_prompt = ""
+                # Make the random choices for the examples now, so Nshot_random stays in step
                 if args.Nshot > 0 and args.Nshot_type.startswith("N"):
-                    statute_prompt = write_multistatute_Nshot_prompt(args,
-                                                                     Nshot_statutes,
-                                                                     names_set,
-                                                                     applies_target,
-                                                                     person_type)
-                statute_prompt += curr_statute
+                    query.Nshot_plan = plan_multistatute_Nshot_prompt(args,
+                                                                      Nshot_indices,
+                                                                      names_set,
+                                                                      applies_target,
+                                                                      person_type)
 
                 if args.Nshot > 0 and args.Nshot_type == "1":
-                    examples = write_1statute_Nshot_prompt(args, names_set, applies_target, person_type, all_parts)
-                    statute_prompt += "\n" + examples
+                    query.Nshot_plan = plan_1statute_Nshot_prompt(args, names_set, applies_target, person_type, index)
                     print("-----")
 
-                statute_question = write_facts_and_question(person_name, person_type, applies_target, args)
-                if args.Nshot == 0: # We don't add this if we already have examples
-                    statute_question += " Let's think step by step."
-                statute_prompt = statute_prompt.rstrip() + "\n\n" + statute_question
-                query.statute_query = statute_prompt
-
-                if args.do_sentences:
-                    sentence_prompt = sentences_form.rstrip() + "\n\n"
-                    sentence_prompt += write_facts_and_question(person_name, person_type, applies_target, args, True)
-                    sentence_prompt += " Let's think step by step."
-                    query.sentence_query = sentence_prompt
-
                 rv.append(query)
     return rv
 
+# For --prune_prompt, the parts of the test statute to show: the root, every part on the paths from
+# the root to the applies-to target and to the person's type (and to the parts used in 1-statute
+# N-shot examples), plus up to args.distractors siblings of each of those that have subsections.
+def get_pruned_parts(args, query) -> set:
+    needed = [query.applies_target, query.person_type]
+    if args.Nshot > 0 and args.Nshot_type == "1":
+        for name1, name2, target_subsection, true_item, false_item, false_first in query.Nshot_plan:
+            needed.extend([target_subsection, true_item, false_item])
+    on_paths = set()
+    for part in needed:
+        while part is not None and not part in on_paths:
+            on_paths.add(part)
+            part = part.parent
+    rv = set(on_paths)
+    for part in on_paths:
+        if part.parent is not None:
+            siblings = [x for x in part.parent.children if x.has_children() and not x in on_paths]
+            rv.update(siblings[:args.distractors])
+    return rv
+
+# Word counts of the test statute in prompts, for reporting the savings from --prune_prompt
+statute_words = {"full": 0, "pruned": 0}
+
+# Fills in query.statute_query (and query.sentence_query, if doing sentences)
+def render_query(args, query, curr_statute, sentences_form):
+    person_name, person_type, applies_target = query.person_name, query.person_type, query.applies_target
+
+    # Build the question
+    statute_prompt = ""
+    if args.Nshot > 0 and args.Nshot_type.startswith("N"):
+        statute_prompt = write_multistatute_Nshot_prompt(args, Nshot_statutes, Nshot_render_cache, query.Nshot_plan)
+    if args.prune_prompt:
+        pruned_statute = generate_synstat.abstract_to_statute(person_type.get_root(), keep=get_pruned_parts(args, query))
+        statute_words["full"] += len(curr_statute.split())
+        statute_words["pruned"] += len(pruned_statute.split())
+        statute_prompt += pruned_statute
+    else:
+        statute_prompt += curr_statute
+
+    if args.Nshot > 0 and args.Nshot_type == "1":
+        examples = write_1statute_Nshot_prompt(args, query.Nshot_plan)
+        statute_prompt += "\n" + examples
+
+    statute_question = write_facts_and_question(person_name, person_type, applies_target, args)
+    if args.Nshot == 0: # We don't add this if we already have examples
+        statute_question += " Let's think step by step."
+    statute_prompt = statute_prompt.rstrip() + "\n\n" + statute_question
+    query.statute_query = statute_prompt
+
+    if args.do_sentences:
+        sentence_prompt = sentences_form.rstrip() + "\n\n"
+        sentence_prompt += write_facts_and_question(person_name, person_type, applies_target, args, True)
+        sentence_prompt += " Let's think step by step."
+        query.sentence_query = sentence_prompt
+
+# Asks GPT the statute query, and then for its answer; returns both responses
+def ask_statute_query(args, query):
+    return ask_query(query.statute_query, args.model, __file__, args.Nshot_type)
+
+# Asks GPT the sentence query, and then for its answer; returns both responses
+def ask_sentence_query(args, query):
+    return ask_query(query.sentence_query, args.model, __file__)
+
 def filter_and_balance_queries(args, possible_queries):
     positive_queries = [x for x in possible_queries if x.groundtruth]
     negative_queries = [x for x in possible_queries if not x.groundtruth]
@@ -482,28 +542,29 @@ def filter_and_balance_queries(args, possible_queries):
 
 if args.termtype == "nonces":
     raw_nonce_list = generate_synstat.read_nonces()
-else:
+elif args.termtype == "ids":
     raw_nonce_list = generate_synstat.generate_systematic(statute_random)
-
-total_statute_results = {"True Positive": 0, "True Negative": 0,
-                         "False Positive": 0, "False Negative": 0, "unclear":0}
-total_sentence_results = total_statute_results.copy()
-total_num = 0
-
-for run_num in range(args.numruns):
-    if 0 < args.max_num <= total_num:
-        assert total_num == args.max_num, "should never go over"
-        break  # if we go over the total number allowed, stop further calls
-
-    print("@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@")
-    print("run_num=", run_num)
-
+else: # generate_run() makes a term_source for each run
+    raw_nonce_list = None
+
+# Generates everything for one run that depends only on the run number, i.e. that does not use
+# Nshot_random or runsubset_random, which carry over from run to run.  So runs can be generated
+# ahead of time in worker processes (--gen_workers) and still match a sequential run exactly.
+# Returns (run_num, (abst, curr_statute, all_sentences, curr_index, Nshot_statutes, Nshot_indices,
+# Nshot_render_cache)).
+def generate_run(args, raw_nonce_list, run_num):
     # Generate the statute about which we will ask questions
-    nonce_list = raw_nonce_list.copy()
     statute_random.seed(run_num) # re-seeding right before new shuffle fixes unexpected-reshuffling issues
-    statute_random.shuffle(nonce_list)
+    if args.termtype == "pseudowords":
+        nonce_list = term_source.term_source(run_num, "pseudowords")
+    elif args.termtype == "unlimited_ids":
+        nonce_list = term_source.term_source(run_num, "ids")
+    else:
+        nonce_list = raw_nonce_list.copy()
+        statute_random.shuffle(nonce_list)
     abst = generate_synstat.generate_abstract(nonce_list, args.depth, args.width)
-    curr_statute = generate_synstat.abstract_to_statute(abst)
+    # one walk gives both the statute and the semantically identical sentences (used if do_sentences)
+    curr_statute, all_sentences, num_sentences, _ = generate_synstat.render_abstract(abst, sentence_num_format="Sentence {:d}: ")
 
     # if we are doing many-statute N-shot prompting, we need to generate the N statutes used in prompting
     Nshot_statutes = []
@@ -516,15 +577,75 @@ for run_num in range(args.numruns):
             # note that the nonce_list items are .pop()'ed, which prevents reuse
             extra_abstract = generate_synstat.generate_abstract(nonce_list, args.depth, args.width)
             Nshot_statutes.append(extra_abstract)
+    Nshot_indices = [tree_index(x) for x in Nshot_statutes] # for constant-time applies-to and distance queries
+    Nshot_render_cache = generate_synstat.statute_render_cache() # these are rendered for every query, with varying sec_num
+    for x in Nshot_statutes:
+        Nshot_render_cache.abstract_to_statute(x) # fills in the templates now
+
+    # everything is returned together, so parts are still shared after pickling back from a worker
+    return run_num, (abst, curr_statute, all_sentences, tree_index(abst), Nshot_statutes, Nshot_indices, Nshot_render_cache)
+
+total_statute_results = {"True Positive": 0, "True Negative": 0,
+                         "False Positive": 0, "False Negative": 0, "unclear":0}
+total_sentence_results = total_statute_results.copy()
+total_num = 0
+total_pending = 0 # in batch mode (see batch_file.py), queries still waiting on a response
+
+dataset = None
+if args.export is not None:
+    settings = {"width": args.width, "depth": args.depth, "termtype": args.termtype, "numruns": args.numruns,
+                "perrun": args.perrun, "do_sentences": args.do_sentences, "Nshot": args.Nshot,
+                "Nshot_type": args.Nshot_type, "subdivs": args.subdivs, "question_form": args.question_form,
+                "max_num": args.max_num, "skip_first": args.skip_first,
+                "prune_prompt": args.prune_prompt, "distractors": args.distractors}
+    seeds = {"statute_random": "run_num", "Nshot_random": 42, "runsubset_random": 42,
+             "term_source": "run_num" if args.termtype in ["pseudowords", "unlimited_ids"] else None}
+    dataset = synstat_dataset.dataset_writer(args.export, settings, seeds, args.shard_size)
+
+# The record for one query in an exported dataset
+def make_record(run_num, query, index) -> dict:
+    person_type, applies_target = query.person_type, query.applies_target
+    return {"run_num": run_num,
+            "prompt": query.statute_query,
+            "sentence_prompt": query.sentence_query,
+            "groundtruth": query.groundtruth,
+            "person_name": query.person_name,
+            "person_type": {"term": person_type.term, "level": index.get_level(person_type),
+                            "citation": person_type.stat_used},
+            "applies_target": {"term": applies_target.term, "level": index.get_level(applies_target),
+                               "citation": applies_target.stat_defined if not applies_target.stat_defined is None
+                                           else applies_target.stat_used,
+                               "sentence_num": applies_target.sentence_num if args.do_sentences else None,
+                               "is_leaf": not applies_target.has_children()},
+            "distance": index.get_dist(person_type, applies_target),
+            "tree": {"width": args.width, "depth": args.depth, "num_parts": len(index.parts),
+                     "root_term": index.parts[0].term}}
+
+if args.gen_workers > 0:
+    # imap keeps the workers generating upcoming runs while this process makes the calls
+    gen_pool = multiprocessing.get_context("fork").Pool(args.gen_workers)
+    generated_runs = gen_pool.imap(functools.partial(generate_run, args, raw_nonce_list), range(args.numruns))
+else:
+    generated_runs = (generate_run(args, raw_nonce_list, run_num) for run_num in range(args.numruns))
+
+for run_num, generated_run in generated_runs:
+    if 0 < args.max_num <= total_num:
+        assert total_num == args.max_num, "should never go over"
+        break  # if we go over the total number allowed, stop further calls
+
+    print("@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@")
+    print("run_num=", run_num)
+
+    abst, curr_statute, all_sentences, curr_index, Nshot_statutes, Nshot_indices, Nshot_render_cache = generated_run
 
     # if also doing sentence testing, generate the sentences about which we will ask questions
     sentences_form=None
     if args.do_sentences:
-        sentences_form, num_sentences = generate_synstat.abstract_to_sentences(abst, "Sentence {:d}: ")
+        sentences_form = all_sentences
         print(sentences_form)
         print("")
 
-    all_parts = generate_synstat.extract_all_used_parts(abst)
+    all_parts = curr_index.parts # same as generate_synstat.extract_all_used_parts(abst)
 
     statute_results = {"True Positive": 0, "True Negative": 0,
                        "False Positive":0, "False Negative": 0, "unclear":0}
@@ -533,8 +654,7 @@ for run_num in range(args.numruns):
     num_this_run = 0
 
     # build up all possible queries
-    possible_queries = \
-        build_possible_queries(args, all_parts, curr_statute, sentences_form)
+    possible_queries = build_possible_queries(args, all_parts, curr_index)
 
     # filter the queries so that the positive/false are balanced and we have appropriate num
     queries = filter_and_balance_queries(args, possible_queries)
@@ -545,39 +665,37 @@ for run_num in range(args.numruns):
             assert total_num == args.max_num, "should never go over"
             break  # if we go over the total number allowed, stop further calls
 
+        render_query(args, query, curr_statute, sentences_form)
+        if dataset is not None:
+            if not (args.skip_first > 0 and total_num < args.skip_first):
+                dataset.add(make_record(run_num, query, curr_index))
+            num_this_run += 1
+            total_num += 1
+            continue
         print("----------")
         print(query.statute_query) # this is the text to pass to GPT
 
         if args.skip_first > 0 and total_num < args.skip_first:
             print("SKIPPING as at total_num=", total_num, " when skip_first=",args.skip_first)
         else:
+            pending = False
             if not args.noGPT:
-                utils.add_comment("Synthetic applies probe in " + __file__)
-                statute_response = utils.call_gpt3_withlogging(query.statute_query, args.model, max_tokens=1000)
-
-                SECOND_PROMPT = "\nTherefore, the answer (Yes or No) is"  # cf. Kojima et al. 2022 appendix A.5
-
-                # for the N-shot prompting where there are 2 questions after each statute,
-                # GPT3 will generally try to answer the first question and then produce and
-                # answer a second question!  To address this, we need to construct a second
-                # prompt that removes this second question & answer.
-                construct_normal_second_prompt = True
-                if args.Nshot_type in ["N/2", "N/2_samepos"]:
-                    if statute_response.count("\n\n") > 1:
-                        print("POSSIBLE PROBLEM: More than one double carriage return in response.\n")
-                    if "\n\n" in statute_response:
-                        construct_normal_second_prompt = False # turns off normal construction
-                        second_statute_prompt = \
-                            query.statute_query + \
-                            statute_response.split("\n\n")[0] + \
-                            SECOND_PROMPT
-
-                utils.add_comment("Synthetic applies probe in " + __file__ + " SECOND PROMPT")
-                if construct_normal_second_prompt:
-                    second_statute_prompt = query.statute_query + statute_response + SECOND_PROMPT
-                second_statute_response = utils.call_gpt3_withlogging(second_statute_prompt, args.model, max_tokens=400)
+                try:
+                    statute_response, second_statute_response = ask_statute_query(args, query)
+                except utils.ResponsePending:
+                    pending = True
+                if args.do_sentences: # asked now, so in batch mode both queries' prompts go in the same batch
+                    try:
+                        sent_response, second_sent_response = ask_sentence_query(args, query)
+                    except utils.ResponsePending:
+                        pending = True
             else:
                 statute_response = second_statute_response = ["No.","No","Yes.", "maybe?"][num_this_run % 4]
+            if pending: # skipped until a later batch has the responses
+                total_pending += 1
+                num_this_run += 1
+                total_num += 1
+                continue
 
             statute_result = "unclear"
             if utils.is_yes(second_statute_response):
@@ -605,17 +723,7 @@ for run_num in range(args.numruns):
                 print(query.sentence_query)  # this is the text to pass to GPT
                 print("-----")
 
-                if not args.noGPT:
-                    utils.add_comment("Synthetic applies probe in " + __file__)
-                    sent_response = utils.call_gpt3_withlogging(query.sentence_query, args.model, max_tokens=1000)
-
-                    SECOND_PROMPT = "\nTherefore, the answer (Yes or No) is"  # cf. Kojima et al. 2022 appendix A.5
-
-                    utils.add_comment("Synthetic applies probe in " + __file__ + " SECOND PROMPT")
-                    second_sent_prompt = query.sentence_query + sent_response + SECOND_PROMPT
-                    second_sent_response = utils.call_gpt3_withlogging(second_sent_prompt, args.model,
-                                                                          max_tokens=400)
-                else:
+                if args.noGPT: # otherwise already asked above
                     sent_response = second_sent_response = ["No.", "No", "Yes.", "maybe?"][num_this_run % 4]
 
                 sent_result = "unclear"
@@ -644,6 +752,8 @@ for run_num in range(args.numruns):
         print("")
 
     print("num_this_run=", num_this_run)
+    if dataset is not None: # nothing was asked, so no results
+        continue
     print("This run statute_results:" , statute_results)
     if args.do_sentences:
         print("This run sentence_results: ", sentence_results)
@@ -653,23 +763,38 @@ for run_num in range(args.numruns):
         total_statute_results[t] += statute_results[t]
         total_sentence_results[t] += sentence_results[t]
         check_sum += total_statute_results[t]
+    num_answered = total_num - total_pending
     if args.skip_first > 0:
         if total_num > args.skip_first:
-            assert check_sum == (total_num - args.skip_first)
+            assert check_sum == (num_answered - args.skip_first)
     else:
-        assert check_sum == total_num
+        assert check_sum == num_answered
 
     print("total_num=", total_num)
+    if total_pending > 0:
+        print("total_pending=", total_pending, "(waiting on batch responses, so not in the results)")
+    if num_answered == 0:
+        continue
     print("so-far total_statute_results=", total_statute_results)
     statute_correct = (total_statute_results['True Positive'] + total_statute_results['True Negative'])
-    print("so-far statute accuracy: {:.2f}".format(statute_correct/float(total_num)),
-          "(" + str(statute_correct) + "/" + str(total_num) + ")")
+    print("so-far statute accuracy: {:.2f}".format(statute_correct/float(num_answered)),
+          "(" + str(statute_correct) + "/" + str(num_answered) + ")")
     if args.do_sentences:
         print("so-far total_sentence_results=", total_sentence_results)
         sentence_correct = (total_sentence_results['True Positive'] + total_sentence_results['True Negative'])
-        print("so-far sentence accuracy: {:.2f}".format(sentence_correct / float(total_num)),
-              "(" + str(sentence_correct) + "/" + str(total_num) + ")")
+        print("so-far sentence accuracy: {:.2f}".format(sentence_correct / float(num_answered)),
+              "(" + str(sentence_correct) + "/" + str(num_answered) + ")")
+
+if args.gen_workers > 0:
+    gen_pool.terminate() # may still be generating runs past max_num
+
+if args.prune_prompt and statute_words["full"] > 0:
+    print("prune_prompt: statutes in prompts had", statute_words["pruned"], "words instead of", statute_words["full"],
+          "({:.1f}% fewer; word counts, as a proxy for tokens)".format(100 * (1 - statute_words["pruned"] / statute_words["full"])))
 
+if dataset is not None:
+    manifest = dataset.close()
+    print("Exported", manifest["num_records"], "queries in", len(manifest["shards"]), "shards to", args.export)
 
 suggested_filename = args.termtype+"_w"+ str(args.width)+ \
                      "_d"+str(args.depth)+"_"+ \
@@ -0,0 +1,144 @@
+# Benchmarks for generating and analyzing large synthetic statutes.
+# Compares the flat, array-backed tree (flat_statute.py) against generate_synstat.statute_part,
+# checking along the way that both give identical results.  Also times the all-pairs ground
+# truth from tree_index.applies_matrix() against calling does_A_apply_to_anyB() on every pair,
+# generate_synstat.statute_render_cache against re-running abstract_to_statute(), and
+# the single-walk generate_synstat.render_abstract() against the recursive renderers.
+
+import argparse, random, sys, time, tracemalloc
+import generate_synstat
+import flat_statute
+import tree_index
+
+sys.setrecursionlimit(100000)
+
+def num_parts(width:int, depth:int) -> int:
+    return sum([width ** d for d in range(depth + 1)])
+
+def get_names(n:int) -> list:
+    return ["T" + str(i) for i in range(n)]
+
+# Returns (result, seconds taken)
+def timed(function, *args):
+    start = time.perf_counter()
+    rv = function(*args)
+    return rv, time.perf_counter() - start
+
+# Returns MB allocated by function and still held by its result.  Done as a separate run,
+# since tracing allocations slows everything down.
+def memory_used(function, *args):
+    tracemalloc.start()
+    rv = function(*args)
+    current = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del rv
+    return current / 1e6
+
+def benchmark_trees(width:int, depth:int, num_dist_queries:int):
+    n = num_parts(width, depth)
+    print("width", width, "depth", depth, "=", n, "parts")
+
+    results = {}
+    for name, generate in [("statute_part", generate_synstat.generate_abstract),
+                           ("flat_statute", flat_statute.generate_abstract_flat)]:
+        build_mb = memory_used(generate, get_names(n), depth, width)
+        abst, build_seconds = timed(generate, get_names(n), depth, width)
+        parts, walk_seconds = timed(abst.get_all_descendants)
+        start = time.perf_counter()
+        levels = [p.get_level() for p in parts]
+        level_seconds = time.perf_counter() - start
+        rand_gen = random.Random(42)
+        pairs = [(rand_gen.randrange(n), rand_gen.randrange(n)) for _ in range(num_dist_queries)]
+        start = time.perf_counter()
+        dists = [parts[a].get_dist(parts[b]) for a, b in pairs]
+        dist_seconds = time.perf_counter() - start
+        print("  {:13s} build {:8.3f}s {:9.1f}MB   descendants {:7.3f}s   get_level {:7.3f}s   get_dist x{:d} {:7.3f}s".format(
+            name, build_seconds, build_mb, walk_seconds, level_seconds, num_dist_queries, dist_seconds))
+        results[name] = ([p.term for p in parts], levels, dists)
+    assert results["statute_part"] == results["flat_statute"], "flat_statute gave different results"
+
+def benchmark_groundtruth(width:int, depth:int):
+    abst = generate_synstat.generate_abstract(get_names(num_parts(width, depth)), depth, width)
+    parts = generate_synstat.extract_all_used_parts(abst)
+    print("width", width, "depth", depth, "=", len(parts), "parts =", len(parts) ** 2, "pairs")
+    pairwise, pairwise_seconds = timed(lambda: [[generate_synstat.does_A_apply_to_anyB(a, b) for b in parts] for a in parts])
+    index, index_seconds = timed(tree_index.tree_index, abst)
+    matrix, matrix_seconds = timed(index.applies_matrix)
+    print("  does_A_apply_to_anyB per pair {:8.3f}s   tree_index {:7.3f}s + applies_matrix {:7.3f}s ({:s})".format(
+        pairwise_seconds, index_seconds, matrix_seconds, "numpy" if tree_index.numpy is not None else "no numpy"))
+    assert [[tree_index.CODE_APPLIES[int(x)] for x in row] for row in matrix] == pairwise, "applies_matrix gave different results"
+
+def benchmark_render_cache(width:int, depth:int, num_renders:int):
+    abst = generate_synstat.generate_abstract(get_names(num_parts(width, depth)), depth, width)
+    parts = generate_synstat.extract_all_used_parts(abst)
+    rand_gen = random.Random(42)
+    sec_nums = [rand_gen.randint(1010, 9999) for _ in range(num_renders)]
+    print("width", width, "depth", depth, "=", len(parts), "parts,", num_renders, "renders")
+
+    def render_all(render):
+        return [(render(abst, sec_num=sec_num), [(p.stat_used, p.stat_defined) for p in parts]) for sec_num in sec_nums]
+    direct, direct_seconds = timed(render_all, generate_synstat.abstract_to_statute)
+    cache = generate_synstat.statute_render_cache()
+    cached, cached_seconds = timed(render_all, cache.abstract_to_statute)
+    print("  abstract_to_statute {:7.3f}s   statute_render_cache {:7.3f}s".format(direct_seconds, cached_seconds))
+    assert direct == cached, "statute_render_cache gave different results"
+
+# Renders the statute, the sentences and the line-numbered sentences the old way
+def render_recursive(abst):
+    statute = generate_synstat.abstract_to_statute(abst)
+    sentences, num_sentence = generate_synstat.abstract_to_sentences(abst)
+    return statute, sentences, num_sentence, generate_synstat.add_line_numbers(sentences)
+
+def benchmark_renderer(width:int, depth:int):
+    abst = generate_synstat.generate_abstract(get_names(num_parts(width, depth)), depth, width)
+    parts = generate_synstat.extract_all_used_parts(abst)
+    recursive, recursive_seconds = timed(render_recursive, abst)
+    recursive_parts = [(p.stat_used, p.stat_defined, p.sentence_num) for p in parts]
+    single_walk, single_walk_seconds = timed(generate_synstat.render_abstract, abst)
+    print("width {:d} depth {:d} = {:d} parts   recursive {:7.3f}s   render_abstract {:7.3f}s   {:8.0f} parts/s".format(
+        width, depth, len(parts), recursive_seconds, single_walk_seconds, len(parts) / max(single_walk_seconds, 1e-9)))
+    assert recursive == single_walk, "render_abstract gave different text"
+    assert recursive_parts == [(p.stat_used, p.stat_defined, p.sentence_num) for p in parts], \
+        "render_abstract gave different citations"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark synthetic statute trees')
+    parser.add_argument('--sizes', nargs="*", default=["10x3", "10x4", "10x5", "4x8"],
+                        help='trees to build, as WIDTHxDEPTH')
+    parser.add_argument('--dist_queries', type=int, default=10000,
+                        help='number of random get_dist() calls to time')
+    parser.add_argument('--groundtruth_sizes', nargs="*", default=["3x3", "4x4", "5x4"],
+                        help='trees for which to time the all-pairs ground truth, as WIDTHxDEPTH')
+    parser.add_argument('--render_sizes', nargs="*", default=["2x2", "3x3", "5x4"],
+                        help='trees for which to time repeated rendering with different section numbers, as WIDTHxDEPTH')
+    parser.add_argument('--renders', type=int, default=1000,
+                        help='number of times to render each tree')
+    parser.add_argument('--renderer_sizes', nargs="*", default=["3x3", "10x3", "5x5", "2x12", "30x2", "10x4"],
+                        help='trees for which to time render_abstract() against the recursive renderers, as WIDTHxDEPTH')
+    args = parser.parse_args()
+
+    # the two backends must also render identical statutes
+    small = generate_synstat.generate_abstract(get_names(200), 3, 3)
+    small_flat = flat_statute.generate_abstract_flat(get_names(200), 3, 3)
+    assert generate_synstat.abstract_to_statute(small) == generate_synstat.abstract_to_statute(small_flat)
+    assert [(p.stat_used, p.stat_defined) for p in generate_synstat.extract_all_used_parts(small)] == \
+           [(p.stat_used, p.stat_defined) for p in generate_synstat.extract_all_used_parts(small_flat)]
+    converted = flat_statute.from_statute_part(small)
+    assert [p.stat_used for p in generate_synstat.extract_all_used_parts(small)] == \
+           [p.stat_used for p in generate_synstat.extract_all_used_parts(converted)]
+
+    for size in args.sizes:
+        width, depth = [int(x) for x in size.split("x")]
+        benchmark_trees(width, depth, args.dist_queries)
+
+    for size in args.groundtruth_sizes:
+        width, depth = [int(x) for x in size.split("x")]
+        benchmark_groundtruth(width, depth)
+
+    for size in args.render_sizes:
+        width, depth = [int(x) for x in size.split("x")]
+        benchmark_render_cache(width, depth, args.renders)
+
+    for size in args.renderer_sizes:
+        width, depth = [int(x) for x in size.split("x")]
+        benchmark_renderer(width, depth)
@@ -0,0 +1,110 @@
+# Runs a model on a dataset exported by applies_probe_synstat.py --export (see synstat_dataset.py),
+# as a pipeline (see pipeline.py): for each shard, load -> ask -> classify, with the shards run in
+# parallel, then one stage aggregating the results.  Each shard's responses are cached, keyed on
+# the shard's sha256, so changing the classification (e.g. utils.is_match) or the aggregation
+# reruns only those stages, and a dataset with one added shard only asks the new shard.
+#
+# Usage, e.g.:
+#   python applies_probe_synstat.py --width 2 --depth 2 --termtype ids --numruns 10 --export ds_w2_d2
+#   python dataset_pipeline.py ds_w2_d2 --model text-davinci-003
+
+import argparse, os, sys
+sys.path.append('../')
+import utils, pipeline
+import synstat_dataset
+from synstat_ask import ask_query
+
+def load_shard(directory, filename, sha256) -> list:
+    manifest = synstat_dataset.load_manifest(directory)
+    shard = [s for s in manifest["shards"] if s["filename"] == filename][0]
+    assert shard["sha256"] == sha256, "Shard " + filename + " changed since the pipeline was set up"
+    return list(synstat_dataset.iter_shard(directory, shard, verify=True))
+
+# Returns, for each record, a dict of "statute" (and "sentence") -> the two responses, or None
+# where still pending in batch mode, in which case they are not cached
+def ask(records, model, Nshot_type):
+    rv = []
+    for record in records:
+        responses = {}
+        try:
+            responses["statute"] = ask_query(record["prompt"], model, __file__, Nshot_type)
+            if record["sentence_prompt"] is not None:
+                responses["sentence"] = ask_query(record["sentence_prompt"], model, __file__)
+        except utils.ResponsePending:
+            responses = None
+        rv.append(responses)
+    return pipeline.uncached(rv) if None in rv else rv
+
+def get_result(second_response:str, groundtruth:bool) -> str:
+    if utils.is_yes(second_response):
+        return "True Positive" if groundtruth else "False Positive"
+    elif utils.is_no(second_response):
+        return "False Negative" if groundtruth else "True Negative"
+    return "unclear"
+
+# Returns, for each record, a dict of "statute" (and "sentence") -> result, or None if pending
+def classify(records, responses) -> list:
+    rv = []
+    for record, record_responses in zip(records, responses):
+        if record_responses is None:
+            rv.append(None)
+            continue
+        rv.append({query_type: get_result(second_response, record["groundtruth"])
+                   for query_type, (_, second_response) in record_responses.items()})
+    return rv
+
+# Totals the results over all the shards; returns (results by query type, num_pending)
+def aggregate(*shard_results):
+    totals = {}
+    num_pending = 0
+    for results in shard_results:
+        for result in results:
+            if result is None:
+                num_pending += 1
+                continue
+            for query_type, value in result.items():
+                totals.setdefault(query_type, {"True Positive": 0, "True Negative": 0,
+                                               "False Positive": 0, "False Negative": 0, "unclear": 0})
+                totals[query_type][value] += 1
+    return totals, num_pending
+
+def print_totals(totals:dict):
+    for query_type, results in totals.items():
+        num_answered = sum(results.values())
+        correct = results["True Positive"] + results["True Negative"]
+        print(query_type + "_results=", results)
+        print(query_type, "accuracy: {:.2f}".format(correct / float(num_answered)),
+              "(" + str(correct) + "/" + str(num_answered) + ")")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run a model on an exported synthetic-statute dataset, shard by shard')
+    parser.add_argument('directory',
+                        help='dataset directory written by applies_probe_synstat.py --export')
+    parser.add_argument('--model', default="text-davinci-003",
+                        help='name of the openai model to call')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='shards to run at once')
+    parser.add_argument('--force', nargs="*", default=[],
+                        help='pipeline stages to rerun even if cached, e.g. ask-00000')
+    args = parser.parse_args()
+
+    manifest = synstat_dataset.load_manifest(args.directory)
+    experiment = pipeline.pipeline("dataset_" + os.path.basename(os.path.normpath(args.directory)),
+                                   max_workers=args.workers)
+    classify_stages = []
+    for shard_num, shard in enumerate(manifest["shards"]):
+        suffix = "-{:05d}".format(shard_num)
+        experiment.add("load" + suffix, load_shard,
+                       params={"directory": args.directory, "filename": shard["filename"], "sha256": shard["sha256"]})
+        experiment.add("ask" + suffix, ask, ["load" + suffix],
+                       {"model": args.model, "Nshot_type": manifest["settings"]["Nshot_type"]}, code=[ask_query])
+        classify_stages.append(experiment.add("classify" + suffix, classify, ["load" + suffix, "ask" + suffix],
+                                              code=[get_result, utils.is_match]))
+    experiment.add("aggregate", aggregate, classify_stages)
+    totals, num_pending = experiment.run(force=args.force)["aggregate"]
+
+    print("dataset", args.directory, "with", manifest["num_records"], "queries in", len(manifest["shards"]), "shards")
+    print("settings=", manifest["settings"])
+    if num_pending > 0:
+        print("num_pending=", num_pending, "(waiting on batch responses, so not in the results)")
+    print_totals(totals)
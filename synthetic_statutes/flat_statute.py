@@ -0,0 +1,237 @@
+# Array-backed alternative to generate_synstat.statute_part, for scaling studies with trees of
+# 10^5 - 10^6 parts.  The whole tree is stored as flat arrays (parent, depth, child range, term id,
+# citations), laid out in breadth-first order so that each part's children are contiguous.
+# flat_statute_part is a thin view onto one position in the arrays, with the same API as
+# statute_part, so the rest of the code (abstract_to_statute(), does_A_apply_to_anyB(), etc.)
+# works on either.
+
+from array import array
+
+class flat_statute:
+    def __init__(self):
+        self.parent = array('i') # -1 for root
+        self.depth = array('i')
+        self.first_child = array('i') # children of i are first_child[i] ... first_child[i] + num_children[i] - 1
+        self.num_children = array('i')
+        self.term_id = array('i') # index into terms
+        self.terms = []
+        self.stat_used = [] # e.g. 1001(a)(3)(A); None until abstract_to_statute() is run
+        self.stat_defined = []
+        self.sentence_num = []
+        self.preorder = None # computed when first needed
+
+    def __len__(self):
+        return len(self.parent)
+
+    # Adds a part; parts must be added in breadth-first order, with all of a part's children in a row
+    def add_part(self, term:str, parent:int) -> int:
+        idx = len(self.parent)
+        self.parent.append(parent)
+        self.depth.append(0 if parent < 0 else self.depth[parent] + 1)
+        self.first_child.append(-1)
+        self.num_children.append(0)
+        self.term_id.append(len(self.terms))
+        self.terms.append(term)
+        self.stat_used.append(None)
+        self.stat_defined.append(None)
+        self.sentence_num.append(None)
+        if parent >= 0:
+            if self.num_children[parent] == 0:
+                self.first_child[parent] = idx
+            assert self.first_child[parent] + self.num_children[parent] == idx, "children must be contiguous"
+            self.num_children[parent] += 1
+        self.preorder = None
+        return idx
+
+    def get_part(self, idx:int):
+        return flat_statute_part(self, idx)
+
+    def get_root(self):
+        return flat_statute_part(self, 0)
+
+    # Indices in the same order as statute_part.get_all_descendants() visits the parts
+    def get_preorder(self) -> array:
+        if self.preorder is None:
+            self.preorder = self.get_subtree_preorder(0)
+        return self.preorder
+
+    def get_subtree_preorder(self, idx:int) -> array:
+        rv = array('i')
+        append = rv.append
+        first_child, num_children = self.first_child, self.num_children
+        stack = [idx]
+        pop, extend = stack.pop, stack.extend
+        while len(stack) > 0:
+            i = pop()
+            append(i)
+            n = num_children[i]
+            if n > 0:
+                first = first_child[i]
+                extend(range(first + n - 1, first - 1, -1))
+        return rv
+
+class flat_statute_part:
+    __slots__ = ("tree", "index")
+
+    def __init__(self, tree:flat_statute, index:int):
+        self.tree = tree
+        self.index = index
+
+    def __eq__(self, other):
+        return isinstance(other, flat_statute_part) and self.index == other.index and self.tree is other.tree
+
+    def __hash__(self):
+        return hash((id(self.tree), self.index))
+
+    def __repr__(self):
+        return "flat_statute_part(" + str(self.index) + ", " + repr(self.term) + ")"
+
+    @property
+    def term(self) -> str:
+        return self.tree.terms[self.tree.term_id[self.index]]
+
+    @term.setter
+    def term(self, value:str):
+        self.tree.term_id[self.index] = len(self.tree.terms)
+        self.tree.terms.append(value)
+
+    @property
+    def parent(self):
+        p = self.tree.parent[self.index]
+        if p < 0:
+            return None
+        return flat_statute_part(self.tree, p)
+
+    @property
+    def children(self): # like statute_part, None rather than an empty list for leaves
+        n = self.tree.num_children[self.index]
+        if n == 0:
+            return None
+        first = self.tree.first_child[self.index]
+        return [flat_statute_part(self.tree, c) for c in range(first, first + n)]
+
+    @property
+    def stat_used(self):
+        return self.tree.stat_used[self.index]
+
+    @stat_used.setter
+    def stat_used(self, value):
+        self.tree.stat_used[self.index] = value
+
+    @property
+    def stat_defined(self):
+        return self.tree.stat_defined[self.index]
+
+    @stat_defined.setter
+    def stat_defined(self, value):
+        self.tree.stat_defined[self.index] = value
+
+    @property
+    def sentence_num(self):
+        return self.tree.sentence_num[self.index]
+
+    @sentence_num.setter
+    def sentence_num(self, value):
+        self.tree.sentence_num[self.index] = value
+
+    def has_children(self):
+        return self.tree.num_children[self.index] > 0
+
+    def has_grandchildren(self):
+        return self.has_children() and self.tree.num_children[self.tree.first_child[self.index]] > 0
+
+    def get_all_descendants(self) -> list:
+        return [flat_statute_part(self.tree, i) for i in self.tree.get_subtree_preorder(self.index)]
+
+    def print_statute_info_recursive(self):
+        for i in self.tree.get_subtree_preorder(self.index):
+            part = flat_statute_part(self.tree, i)
+            used = "--"
+            if not part.stat_used is None:
+                used = part.stat_used
+            defined = "--"
+            if not part.stat_defined is None:
+                defined = part.stat_defined
+            print("{0:<25s} {1:<25s}".format(used, defined), part.term)
+
+    def print_statute_info(self):
+        print("{0:<25s} {1:<25s}".format("stat_used", "stat_defined"))
+        self.print_statute_info_recursive()
+
+    def get_level(self):
+        return self.tree.depth[self.index]
+
+    # gets distance, in tree edges, from x
+    def get_dist(self, x):
+        assert self.tree is x.tree, "Got two that are not in the same tree"
+        parent, depth = self.tree.parent, self.tree.depth
+        a, b = self.index, x.index
+        rv = 0
+        while depth[a] > depth[b]:
+            a = parent[a]
+            rv += 1
+        while depth[b] > depth[a]:
+            b = parent[b]
+            rv += 1
+        while a != b:
+            a = parent[a]
+            b = parent[b]
+            rv += 2
+        return rv
+
+    # Find the item in the other_statute that is in the exact same position as self.
+    def get_analogous_item(self, other_statute):
+        tree_branches = []
+        i = self.index
+        while self.tree.parent[i] >= 0:
+            tree_branches.append(i - self.tree.first_child[self.tree.parent[i]])
+            i = self.tree.parent[i]
+        y = other_statute
+        while len(tree_branches) > 0:
+            y = y.children[tree_branches.pop()]
+        return y
+
+    def get_root(self):
+        return flat_statute_part(self.tree, 0)
+
+# Same as generate_synstat.generate_abstract(), and pops the names in the same order, so the two
+# give identical statutes; but returns the root of a flat_statute.
+def generate_abstract_flat(stack_names, tree_depth:int, branch_factor:int) -> flat_statute_part:
+    # With every level full, the breadth-first layout can be filled in directly: the children of
+    # part i are parts i*branch_factor + 1 ... i*branch_factor + branch_factor.
+    n = sum([branch_factor ** d for d in range(tree_depth + 1)])
+    num_internal = n - branch_factor ** tree_depth
+    tree = flat_statute()
+    tree.parent = array('i', [-1]) + array('i', [(i - 1) // branch_factor for i in range(1, n)])
+    for d in range(tree_depth + 1):
+        tree.depth.extend(array('i', [d]) * (branch_factor ** d))
+    tree.first_child = array('i', range(1, num_internal * branch_factor + 1, branch_factor)) + \
+                       array('i', [-1]) * (n - num_internal)
+    tree.num_children = array('i', [branch_factor]) * num_internal + array('i', [0]) * (n - num_internal)
+    tree.term_id = array('i', range(n))
+    tree.terms = [None] * n
+    tree.stat_used = [None] * n
+    tree.stat_defined = [None] * n
+    tree.sentence_num = [None] * n
+
+    # generate_abstract() pops a name for each part, other than the root, in preorder; then the root
+    terms = tree.terms
+    preorder = tree.get_preorder()
+    for i in preorder[1:]:
+        terms[i] = stack_names.pop()
+    terms[0] = stack_names.pop()
+    return tree.get_root()
+
+# Copies a tree of statute_part into a flat_statute (including any citations already filled in)
+def from_statute_part(abst) -> flat_statute_part:
+    tree = flat_statute()
+    queue = [(abst, -1)]
+    for part, parent in queue: # breadth first; queue grows as we go
+        idx = tree.add_part(part.term, parent)
+        tree.stat_used[idx] = part.stat_used
+        tree.stat_defined[idx] = part.stat_defined
+        tree.sentence_num[idx] = part.sentence_num
+        if part.has_children():
+            for child in part.children:
+                queue.append((child, idx))
+    return tree.get_root()
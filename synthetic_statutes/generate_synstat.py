@@ -127,6 +127,39 @@ def extract_all_used_parts(abst) -> list:
     return rv
 
 
+# This function derives the ground truth against which we measure accuracy.  It's important.
+# Returns True if it definitely applies.
+# Returns False if it definitely does NOT apply
+# Returns *None* if may or may not apply -- so shouldn't test
+# To understand reasoning, consider statute "(i) foo means (I) any bar or (II) any boo"
+def does_A_apply_to_anyB(A, B):
+    if A == B:
+        if not A.has_children():
+            # if Alice is a boo, then (i)(II) definitely applies to Alice
+            return True
+        else:
+            # If Alice is a foo, then does (i) above apply to Alice?
+            # It's Unclear, since Alice was a foo even without (i).  So return None since ambiguous.
+            return None
+
+    # if A is a parent, grandparent, etc. of B,  it definitely applies
+    # For example, if A is (i) and B is boo.
+    x = B
+    while not x is None:
+        if x == A:
+            assert A != B or not A.has_children()
+            return True
+        x = x.parent
+    # if sentence can be used to construct the part, then arguably applies
+    y = A
+    while not y is None:
+        if y == B:
+            # If Alice is a foo, then does (I) above apply to Alice?
+            # Unclear, so we return None in that circumstance.
+            return None
+        y = y.parent
+    return False
+
 # Reads from a file filled with nonces generated by https://www.soybomb.com/tricks/words/
 def read_nonces() -> list:
     with open("nonces.txt", "r") as f:
@@ -134,13 +167,15 @@ def read_nonces() -> list:
     lowercase_nonce_list = nonce_txt.split()
     # verify none are duplicated, which would cause statutory problems
     rv = []
+    seen = set()
     for nonce in lowercase_nonce_list:
         capitalize_first = nonce[0].upper() + nonce[1:].lower()
-        assert not capitalize_first in rv
+        assert not capitalize_first in seen
+        seen.add(capitalize_first)
         rv.append(capitalize_first)
     return rv
 
-# This generates a random set of names like "M11" and "Z66"
+# This generates a random set of names like "M11" and "Z66".  For more than 260, see term_source.py.
 def generate_systematic(rand_gen) -> list:
     rv = []
     for idx_letter in range(26):
@@ -150,30 +185,40 @@ def generate_systematic(rand_gen) -> list:
     return rv
 
 # Used to generate roman numerals, which are used for clause and subclause numbering
+ROMAN_NUMERALS = [(1000, "m"), (900, "cm"), (500, "d"), (400, "cd"), (100, "c"), (90, "xc"),
+                  (50, "l"), (40, "xl"), (10, "x"), (9, "ix"), (5, "v"), (4, "iv"), (1, "i")]
 def int_to_roman(num):
-    if 1 <= num <= 3:
-        return "i" * num
-    elif num == 4:
-        return "iv"
-    elif 5 <= num <= 8:
-        return "v" + ("i" * (num-5))
-    else:
-        assert False, "not implemented"
+    assert num >= 1, "not implemented"
+    rv = ""
+    for value, numeral in ROMAN_NUMERALS:
+        while num >= value:
+            rv += numeral
+            num -= value
+    return rv
+
+# Letters for numbering, doubled past z as the U.S. Code does: a, ..., z, aa, bb, ..., zz, aaa, ...
+def int_to_letters(num:int, min_repeat=1) -> str:
+    return chr(ord('a') + num % 26) * (num // 26 + min_repeat)
 
+# Levels past subclause follow the U.S. Code's items (aa) and subitems (AA), then start over
+# from (a), so trees of any depth can be numbered.
 def level_num_label(level:int, num:int):
     rv = "  " * level + "("
-    if level == 0: # subsection   (a)
-        rv += chr(ord('a') + num)
-    elif level == 1: # paragraph  (1)
+    style = level % 7
+    if style == 0: # subsection   (a)
+        rv += int_to_letters(num)
+    elif style == 1: # paragraph  (1)
         rv += str(num+1)
-    elif level == 2: # subparagraph (A)
-        rv += chr(ord('A') + num)
-    elif level == 3: # clause (i)
+    elif style == 2: # subparagraph (A)
+        rv += int_to_letters(num).upper()
+    elif style == 3: # clause (i)
         rv += int_to_roman(num+1).lower()
-    elif level == 4: # subclause (I)
+    elif style == 4: # subclause (I)
         rv += int_to_roman(num+1).upper()
-    else:
-        assert False, "not implemented"
+    elif style == 5: # item (aa)
+        rv += int_to_letters(num, 2)
+    else: # subitem (AA)
+        rv += int_to_letters(num, 2).upper()
     return rv + ")"
 
 # Creates appropriate separator between parts of a statute.
@@ -187,7 +232,9 @@ def sep(index, len_list) -> str:
 
 # Takes an abstract representation and creates a statute (recursively)
 # Also fills in the citation
-def abstract_to_statute(abst, level = 0, context = None, sec_num = 1001) -> str:
+# If keep (a set of parts) is given, only the subsections for those parts are written out,
+# though every definition still lists all its terms; numbering is the same as the full statute.
+def abstract_to_statute(abst, level = 0, context = None, sec_num = 1001, keep = None) -> str:
     rv = ""
     if level == 0:
         rv  = "Section " + str(sec_num) + ".  Definition of " + abst.term +".\n"
@@ -210,12 +257,41 @@ def abstract_to_statute(abst, level = 0, context = None, sec_num = 1001) -> str:
             child.stat_used = abst.stat_defined.strip() + def_label.strip() + used_label.strip()
 
         for i, child in enumerate(abst.children):
+            if keep is not None and not child in keep:
+                continue
             head_label = level_num_label(level, i+1)
             rv += head_label + " " + child.term + "\n"
-            rv += abstract_to_statute(child, level + 1, context.strip() + head_label.strip())
+            rv += abstract_to_statute(child, level + 1, context.strip() + head_label.strip(), keep=keep)
 
     return rv
 
+# Caches abstract_to_statute() for trees that get rendered over and over with different section
+# numbers, as the N-statute N-shot prompts do.  Each tree is rendered once, with a placeholder for
+# the section number; after that, rendering is just joins, plus putting back the citations
+# (stat_used, stat_defined) that abstract_to_statute() would have filled in.
+# The trees must not be changed after they are first rendered.
+SEC_NUM_PLACEHOLDER = "\x00" # cannot appear in a term
+class statute_render_cache:
+    def __init__(self):
+        self.templates = dict() # abst -> (text pieces, [(part, attribute name, citation pieces)])
+
+    def abstract_to_statute(self, abst, sec_num = 1001) -> str:
+        if not abst in self.templates:
+            text = abstract_to_statute(abst, sec_num=SEC_NUM_PLACEHOLDER)
+            citations = []
+            for part in extract_all_used_parts(abst):
+                for attribute in ["stat_used", "stat_defined"]:
+                    value = getattr(part, attribute)
+                    if value is not None and SEC_NUM_PLACEHOLDER in value: # i.e. set by abstract_to_statute()
+                        citations.append((part, attribute, value.split(SEC_NUM_PLACEHOLDER)))
+            self.templates[abst] = (text.split(SEC_NUM_PLACEHOLDER), citations)
+
+        pieces, citations = self.templates[abst]
+        sec_str = str(sec_num)
+        for part, attribute, citation_pieces in citations:
+            setattr(part, attribute, sec_str.join(citation_pieces))
+        return sec_str.join(pieces)
+
 # This will produce text in a non-statutory format to use as a benchmark
 # Also sets the sentence numbers
 def abstract_to_sentences(abst, sentence_num_format=None, num_sentence=1):
@@ -257,6 +333,69 @@ def get_dict_of_sentence_definitions(abst):
     return rv
 
 
+# Renders both the statute (as abstract_to_statute() does) and the prose sentences (as
+# abstract_to_sentences() does, then add_line_numbers()) in a single walk over the tree, filling
+# in the citations and sentence numbers along the way.  The text is gathered in lists and joined
+# once, and the walk uses a stack rather than recursion, so it scales to large and deep trees.
+# Returns (statute, sentences, next sentence number, sentences with line numbers).
+def render_abstract(abst, sec_num = 1001, sentence_num_format=None):
+    assert abst.parent is None
+    statute = ["Section " + str(sec_num) + ".  Definition of " + abst.term + ".\n"]
+    sentences = []
+    num_sentence = 1
+    labels = dict() # (level, num) -> (label, stripped label), since the same few come up over and over
+    def get_label(level, num):
+        if not (level, num) in labels:
+            label = level_num_label(level, num)
+            labels[(level, num)] = (label, label.strip())
+        return labels[(level, num)]
+
+    stack = [(abst, 0, "section " + str(sec_num), None)] # (part, level, context, heading line)
+    while len(stack) > 0:
+        part, level, context, heading = stack.pop()
+        if heading is not None:
+            statute.append(heading)
+        children = part.children
+        term = part.term.lower()
+        any_terms = ["any " + child.term.lower() for child in children]
+
+        # the statute
+        if not part.has_grandchildren(): # simple; definition in terms of leaf nodes
+            statute.append("  " * (level-1) + "The term \"" + term + "\" means-\n")
+            part.stat_defined = context
+            for i, child in enumerate(children):
+                used_label, used_stripped = get_label(level, i)
+                child.stat_used = context + used_stripped
+                statute.append(used_label + " " + any_terms[i] + sep(i, len(children)))
+        else:
+            def_label, def_stripped = get_label(level, 0)
+            statute.append(def_label + " General rule\n")
+            statute.append("  " * (level) + "The term \"" + term + "\" means-\n")
+            part.stat_defined = context
+            for i, child in enumerate(children):
+                used_label, used_stripped = get_label(level + 1, i)
+                statute.append(used_label + " " + any_terms[i] + sep(i, len(children)))
+                child.stat_used = context + def_stripped + used_stripped
+            for i in range(len(children) - 1, -1, -1): # pushed in reverse, so visited in order
+                head_label, head_stripped = get_label(level, i+1)
+                stack.append((children[i], level + 1, context + head_stripped,
+                              head_label + " " + children[i].term + "\n"))
+
+        # the sentence
+        sentence = ""
+        if not sentence_num_format is None:
+            sentence = sentence_num_format.format(num_sentence)
+        part.sentence_num = num_sentence
+        num_sentence += 1
+        if len(any_terms) <= 2:
+            sentence += "The term \"" + term + "\" means " + " or ".join(any_terms) + "."
+        else:
+            sentence += "The term \"" + term + "\" means " + ", ".join(any_terms[:-1]) + ", or " + any_terms[-1] + "."
+        sentences.append(sentence)
+
+    numbered = ["(" + str(idx+1) + ") " + sentence + "\n" for idx, sentence in enumerate(sentences)]
+    return "".join(statute), "\n".join(sentences) + "\n", num_sentence, "".join(numbered)
+
 # This can be used for the output of abstract_to_sentences to number the lines, to
 # allow references for precise reasoning.
 def add_line_numbers(text:str) -> str:
@@ -0,0 +1,68 @@
+# Runs a dataset exported by applies_probe_synstat.py --export through the work queue of
+# work_queue.py, so that any number of workers, on any number of machines, can share the queries.
+# Enqueueing again (e.g. after adding shards) only adds the queries not already in the queue.
+#
+# Usage, from this directory:
+#   python queue_dataset.py enqueue ds_w2_d2 --db queue.db --model text-davinci-003
+#   python ../work_queue.py worker --db queue.db --queue ds_w2_d2 --handler queue_dataset:handle   (as many as wanted)
+#   python queue_dataset.py aggregate ds_w2_d2 --db queue.db
+# Workers on other machines take --url instead of --db, given a "python ../work_queue.py serve --db queue.db".
+
+import argparse, os, sys
+sys.path.append('../')
+import work_queue
+import synstat_dataset
+from synstat_ask import ask_query
+from dataset_pipeline import classify, aggregate, print_totals
+
+def get_queue_name(directory:str) -> str:
+    return os.path.basename(os.path.normpath(directory))
+
+# Returns the number of queries added
+def enqueue(queue, queue_name:str, directory:str, model:str) -> int:
+    manifest = synstat_dataset.load_manifest(directory)
+    num_added = 0
+    for shard in manifest["shards"]:
+        items = [(shard["sha256"][:16] + ":" + str(num), # changes if the shard does
+                  {"record": record, "model": model, "Nshot_type": manifest["settings"]["Nshot_type"]})
+                 for num, record in enumerate(synstat_dataset.iter_shard(directory, shard, verify=True))]
+        num_added += queue.enqueue(queue=queue_name, items=items)
+    return num_added
+
+# The work_queue handler: asks one query (and its sentence form, if any), returning the responses as ask() does
+def handle(payload:dict) -> dict:
+    record = payload["record"]
+    rv = {"statute": ask_query(record["prompt"], payload["model"], __file__, payload["Nshot_type"])}
+    if record["sentence_prompt"] is not None:
+        rv["sentence"] = ask_query(record["sentence_prompt"], payload["model"], __file__)
+    return rv
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Enqueue an exported synthetic-statute dataset, or aggregate its results')
+    parser.add_argument('command', choices=["enqueue", "aggregate"])
+    parser.add_argument('directory',
+                        help='dataset directory written by applies_probe_synstat.py --export')
+    parser.add_argument('--db', default=None,
+                        help='the SQLite database file of the queue')
+    parser.add_argument('--url', default=None,
+                        help='the URL of a queue served by work_queue.py serve, instead of --db')
+    parser.add_argument('--queue', default=None,
+                        help='name of the queue (default the name of the dataset directory)')
+    parser.add_argument('--model', default="text-davinci-003",
+                        help='name of the openai model to call')
+    args = parser.parse_args()
+
+    queue = work_queue.open_queue(args.db, args.url)
+    queue_name = args.queue if args.queue is not None else get_queue_name(args.directory)
+    if args.command == "enqueue":
+        print("Added", enqueue(queue, queue_name, args.directory, args.model), "queries to", queue_name)
+    counts = queue.counts(queue=queue_name)
+    print(queue_name, counts)
+    if args.command == "aggregate":
+        finished = queue.results(queue=queue_name)
+        totals, _ = aggregate(classify([payload["record"] for _, payload, _ in finished],
+                                       [result for _, _, result in finished]))
+        num_unfinished = counts["pending"] + counts["leased"] + counts["failed"]
+        if num_unfinished > 0:
+            print("num_unfinished=", num_unfinished, "(not yet in the results)")
+        print_totals(totals)
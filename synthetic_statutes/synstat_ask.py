@@ -0,0 +1,35 @@
+# How the synthetic applies probe asks GPT a query: the prompt itself (which ends in "Let's think
+# step by step."), then a second prompt asking for the Yes/No answer.  Shared by
+# applies_probe_synstat.py and the scripts that run its exported datasets (dataset_pipeline.py,
+# queue_dataset.py), so that they all send exactly the same prompts.
+
+import sys
+sys.path.append('../')
+import utils
+
+SECOND_PROMPT = "\nTherefore, the answer (Yes or No) is"  # cf. Kojima et al. 2022 appendix A.5
+
+# Asks GPT the query, and then for its answer; returns both responses.  source is the script asking,
+# for the log.  Nshot_type is that of the statute prompts (see applies_probe_synstat.py --Nshot_type);
+# None for sentence prompts.
+def ask_query(prompt:str, model:str, source:str, Nshot_type=None) -> tuple:
+    utils.add_comment("Synthetic applies probe in " + source)
+    response = utils.call_gpt3_withlogging(prompt, model, max_tokens=1000)
+
+    # for the N-shot prompting where there are 2 questions after each statute,
+    # GPT3 will generally try to answer the first question and then produce and
+    # answer a second question!  To address this, we need to construct a second
+    # prompt that removes this second question & answer.
+    construct_normal_second_prompt = True
+    if Nshot_type in ["N/2", "N/2_samepos"]:
+        if response.count("\n\n") > 1:
+            print("POSSIBLE PROBLEM: More than one double carriage return in response.\n")
+        if "\n\n" in response:
+            construct_normal_second_prompt = False # turns off normal construction
+            second_prompt = prompt + response.split("\n\n")[0] + SECOND_PROMPT
+
+    utils.add_comment("Synthetic applies probe in " + source + " SECOND PROMPT")
+    if construct_normal_second_prompt:
+        second_prompt = prompt + response + SECOND_PROMPT
+    second_response = utils.call_gpt3_withlogging(second_prompt, model, max_tokens=400)
+    return response, second_response
@@ -0,0 +1,94 @@
+# Writes and reads precomputed synthetic-statute query datasets, so several models can be run on
+# exactly the same prompts.  applies_probe_synstat.py --export DIR writes them.
+# A dataset is a directory of JSONL shards (shard-00000.jsonl, ...), one query per line, plus a
+# manifest.json recording the generation settings, the seeds, and each shard's record count and
+# sha256.  Shards can be streamed to separate workers with iter_records(worker=, num_workers=).
+
+import argparse, hashlib, json, os
+
+MANIFEST_FILENAME = "manifest.json"
+DEFAULT_SHARD_SIZE = 1000 # records per shard
+
+def get_shard_filename(shard_num:int) -> str:
+    return "shard-{:05d}.jsonl".format(shard_num)
+
+# Writes records into shards as they come in; call close() at the end to write the manifest.
+class dataset_writer:
+    def __init__(self, directory:str, settings:dict, seeds:dict, shard_size=DEFAULT_SHARD_SIZE):
+        assert shard_size > 0
+        self.directory = directory
+        self.manifest = {"settings": settings, "seeds": seeds, "num_records": 0, "shards": []}
+        self.shard_size = shard_size
+        self.lines = [] # for the shard being filled
+        os.makedirs(directory, exist_ok=True)
+
+    def add(self, record:dict):
+        self.lines.append(json.dumps(record, ensure_ascii=False) + "\n")
+        if len(self.lines) >= self.shard_size:
+            self.write_shard()
+
+    def write_shard(self):
+        if len(self.lines) == 0:
+            return
+        filename = get_shard_filename(len(self.manifest["shards"]))
+        data = "".join(self.lines).encode("utf-8")
+        path = os.path.join(self.directory, filename)
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+        self.manifest["shards"].append({"filename": filename, "num_records": len(self.lines),
+                                        "sha256": hashlib.sha256(data).hexdigest()})
+        self.manifest["num_records"] += len(self.lines)
+        self.lines = []
+
+    def close(self) -> dict:
+        self.write_shard()
+        path = os.path.join(self.directory, MANIFEST_FILENAME)
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(path + ".tmp", path)
+        return self.manifest
+
+def load_manifest(directory:str) -> dict:
+    with open(os.path.join(directory, MANIFEST_FILENAME), "r") as f:
+        return json.load(f)
+
+# The shards for one worker out of num_workers (assigned round robin)
+def get_shards(manifest:dict, worker=0, num_workers=1) -> list:
+    assert 0 <= worker < num_workers
+    return manifest["shards"][worker::num_workers]
+
+# Streams the records of one shard (an entry of the manifest's shards).  If verify, checks it against its sha256 first.
+def iter_shard(directory:str, shard:dict, verify=False):
+    path = os.path.join(directory, shard["filename"])
+    if verify:
+        with open(path, "rb") as f:
+            assert hashlib.sha256(f.read()).hexdigest() == shard["sha256"], "Corrupted shard " + path
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            yield json.loads(line)
+
+# Streams the records, one shard at a time.  If verify, checks each shard against its sha256 first.
+def iter_records(directory:str, worker=0, num_workers=1, verify=False):
+    manifest = load_manifest(directory)
+    for shard in get_shards(manifest, worker, num_workers):
+        yield from iter_shard(directory, shard, verify)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Summarize (and verify) a dataset written by applies_probe_synstat.py --export')
+    parser.add_argument('directory',
+                        help='directory holding manifest.json and the shards')
+    parser.add_argument('--verify', action="store_true",
+                        help='check every shard against the sha256 in the manifest')
+    args = parser.parse_args()
+
+    manifest = load_manifest(args.directory)
+    print("settings:", manifest["settings"])
+    print("seeds:", manifest["seeds"])
+    counts = {True: 0, False: 0}
+    num_records = 0
+    for record in iter_records(args.directory, verify=args.verify):
+        counts[record["groundtruth"]] += 1
+        num_records += 1
+    assert num_records == manifest["num_records"], "manifest and shards disagree on the number of records"
+    print(num_records, "records in", len(manifest["shards"]), "shards:", counts[True], "positive,", counts[False], "negative")
@@ -0,0 +1,103 @@
+# Unlimited supply of unique terms for synthetic statutes, for trees (or numbers of N-shot statutes)
+# too large for nonces.txt (400 words) or generate_systematic() (260 IDs).
+# A term_source can be passed anywhere a shuffled list of names is, e.g. generate_abstract(),
+# since terms are taken with pop().  Terms are generated from a seed, so the same seed always
+# gives the same terms in the same order.
+# Two kinds of terms:
+#   "pseudowords": pronounceable made-up words like "Brenolat", in the style of nonces.txt
+#   "ids": a letter followed by digits like "M47" or "X3081", in the style of generate_systematic()
+# Either way, get_article() gives the right article for every term generated.
+
+import random
+
+# Pseudowords are built from syllables of an onset, a vowel and (sometimes) a coda
+ONSETS = ["b", "br", "c", "cl", "cr", "d", "dr", "f", "fl", "fr", "g", "gl", "gr", "j", "k", "l", "m",
+          "n", "p", "pl", "pr", "qu", "r", "s", "sh", "sl", "st", "t", "th", "tr", "v", "w", "z"]
+VOWELS = ["a", "e", "i", "o", "u", "ai", "ea", "ee", "oo", "ou"]
+CODAS = ["", "", "", "b", "ck", "d", "f", "g", "l", "m", "n", "nd", "nt", "p", "r", "rk", "s", "st", "t", "x"]
+FIRST_VOWELS = ["a", "e", "i", "o"] # for pseudowords starting with a vowel
+
+# Pseudoword starts whose article is not what get_article() would say from spelling alone:
+# "a unit", "a euro", "a one-off", "an hour"; also "y", which can sound like either
+AMBIGUOUS_STARTS = ["u", "y", "eu", "ew", "one", "once", "h"]
+
+# Pseudowords and ids start this long, and get longer once most of that length is used up
+MIN_SYLLABLES = 2
+MIN_DIGITS = 2
+MAX_TRIES = 20 # consecutive collisions before moving to longer terms
+
+def is_ambiguous_start(word:str) -> bool:
+    word = word.lower()
+    for start in AMBIGUOUS_STARTS:
+        if word.startswith(start):
+            return True
+    return False
+
+class term_source:
+    def __init__(self, seed, kind="pseudowords"):
+        assert kind in ["pseudowords", "ids"], "not implemented"
+        self.kind = kind
+        self.rand_gen = random.Random(seed)
+        self.used = set() # lowercase, since terms are compared lowercased in the statutes
+        self.length = MIN_SYLLABLES if kind == "pseudowords" else MIN_DIGITS
+
+    def __len__(self): # never runs out
+        return 2 ** 62
+
+    def make_pseudoword(self) -> str:
+        pieces = []
+        if self.rand_gen.random() < 0.2:
+            pieces.append(self.rand_gen.choice(FIRST_VOWELS))
+        for i in range(self.length):
+            pieces.append(self.rand_gen.choice(ONSETS))
+            pieces.append(self.rand_gen.choice(VOWELS))
+            pieces.append(self.rand_gen.choice(CODAS))
+        word = "".join(pieces)
+        return word[0].upper() + word[1:]
+
+    def make_id(self) -> str:
+        letter = chr(ord('A') + self.rand_gen.randrange(26))
+        return letter + str(self.rand_gen.randrange(10 ** self.length)).zfill(self.length)
+
+    def pop(self) -> str:
+        tries = 0
+        while True:
+            if self.kind == "pseudowords":
+                term = self.make_pseudoword()
+                ok = not is_ambiguous_start(term)
+            else: # get_article() already handles a letter followed by a number
+                term = self.make_id()
+                ok = True
+            if ok and not term.lower() in self.used:
+                self.used.add(term.lower())
+                return term
+            tries += 1
+            if tries >= MAX_TRIES: # almost all terms of this length are taken
+                self.length += 1
+                tries = 0
+
+# Checks uniqueness and articles over many terms, and that generate_abstract() accepts a term_source
+if __name__ == "__main__":
+    import generate_synstat, time
+    for kind in ["pseudowords", "ids"]:
+        source = term_source(42, kind)
+        start = time.perf_counter()
+        terms = [source.pop() for _ in range(200000)]
+        seconds = time.perf_counter() - start
+        assert len(set([t.lower() for t in terms])) == len(terms)
+        again = term_source(42, kind)
+        assert [again.pop() for _ in range(100)] == terms[:100], "same seed should give same terms"
+        for term in terms:
+            if kind == "ids":
+                assert term[0].isupper() and term[1:].isdigit()
+            else:
+                assert term.isalpha() and term[0].isupper() and term[1:].islower()
+            article = generate_synstat.get_article(term)
+            if kind == "ids":
+                assert article == ("an" if term[0].lower() in "aefhilmnorsx" else "a")
+            else:
+                assert article == ("an" if term[0].lower() in "aeio" else "a")
+        print(kind, "e.g.", terms[:6], "; 200000 unique terms in {:.2f}s; final length {:d}".format(seconds, source.length))
+
+    abst = generate_synstat.generate_abstract(term_source(0), 6, 6) # 55987 parts
+    assert len(set(generate_synstat.extract_all_used_terms(abst))) == 55987
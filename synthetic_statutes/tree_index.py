@@ -0,0 +1,235 @@
+# Precomputed index over one synthetic statute tree, so that ancestor, distance and applies-to
+# queries take constant time rather than walking up parent chains.
+# Ancestor tests use entry/exit times of a depth-first walk; distances use the lowest common
+# ancestor, found with a sparse table of range minima over the Euler tour.
+# For candidate pools, mask() gives one row or column of the ground truth, built from the subtree
+# interval and the chain of ancestors, so never more than O(n) work.  Masks are numpy boolean arrays
+# if numpy is installed, or else ints used as bitsets; either way they combine with & and ~, and
+# select() turns them back into lists of parts (in preorder, like extract_all_used_parts).
+# applies_matrix() gives the ground truth for every pair at once, which takes O(n^2) memory, so it
+# is only for when all pairs are really wanted (e.g. benchmark_synstat.py).
+
+import generate_synstat
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# How applies_matrix() encodes the True/False/None returned by does_A_apply_to_anyB()
+APPLIES_CODE = {True: 1, False: 0, None: -1}
+CODE_APPLIES = {1: True, 0: False, -1: None}
+
+class tree_index:
+    def __init__(self, root):
+        # parts are numbered in preorder, i.e. the same order as extract_all_used_parts(root)
+        self.parts = generate_synstat.extract_all_used_parts(root)
+        self.position = {part: i for i, part in enumerate(self.parts)}
+        n = len(self.parts)
+
+        self.depth = [0] * n
+        self.is_leaf = [True] * n
+        self.exit = list(range(n)) # entry time is just the position; exit is the last position in its subtree
+        self.parent_pos = [-1] * n
+        for i, part in enumerate(self.parts):
+            if part.has_children():
+                self.is_leaf[i] = False
+                for child in part.children:
+                    c = self.position[child]
+                    self.parent_pos[c] = i
+                    self.depth[c] = self.depth[i] + 1
+        for i in range(n - 1, 0, -1): # children come after parents in preorder
+            p = self.parent_pos[i]
+            if self.exit[i] > self.exit[p]:
+                self.exit[p] = self.exit[i]
+
+        # Euler tour: each part is listed on entering it and again after returning from each child
+        self.euler = []
+        self.first = [0] * n # first time each part appears in the Euler tour
+        stack = [(0, 0)] # (position, index of next child to visit)
+        while len(stack) > 0:
+            i, next_child = stack.pop()
+            if next_child == 0:
+                self.first[i] = len(self.euler)
+            self.euler.append(i)
+            children = self.parts[i].children
+            if children is not None and next_child < len(children):
+                stack.append((i, next_child + 1))
+                stack.append((self.position[children[next_child]], 0))
+
+        # sparse[k][j] is the shallowest part among euler[j] ... euler[j + 2^k - 1]
+        self.sparse = [self.euler]
+        k = 1
+        while (1 << k) <= len(self.euler):
+            prev = self.sparse[-1]
+            half = 1 << (k - 1)
+            depth = self.depth
+            row = []
+            for j in range(len(self.euler) - (1 << k) + 1):
+                a, b = prev[j], prev[j + half]
+                row.append(a if depth[a] <= depth[b] else b)
+            self.sparse.append(row)
+            k += 1
+
+        self.matrix = None # computed when first needed
+
+    def get_level(self, part) -> int:
+        return self.depth[self.position[part]]
+
+    # True if a is b or one of b's ancestors (positions, not parts)
+    def is_ancestor_pos(self, a:int, b:int) -> bool:
+        return a <= b <= self.exit[a]
+
+    def is_ancestor(self, a, b) -> bool:
+        return self.is_ancestor_pos(self.position[a], self.position[b])
+
+    def lca_pos(self, a:int, b:int) -> int:
+        lo, hi = self.first[a], self.first[b]
+        if lo > hi:
+            lo, hi = hi, lo
+        k = (hi - lo + 1).bit_length() - 1
+        x, y = self.sparse[k][lo], self.sparse[k][hi - (1 << k) + 1]
+        return x if self.depth[x] <= self.depth[y] else y
+
+    def get_lca(self, a, b):
+        return self.parts[self.lca_pos(self.position[a], self.position[b])]
+
+    # Same as a.get_dist(b): distance in tree edges
+    def get_dist(self, a, b) -> int:
+        i, j = self.position[a], self.position[b]
+        return self.depth[i] + self.depth[j] - 2 * self.depth[self.lca_pos(i, j)]
+
+    # Same as generate_synstat.does_A_apply_to_anyB(A, B); see there for the reasoning
+    def does_A_apply_to_anyB(self, A, B):
+        a, b = self.position[A], self.position[B]
+        if a == b:
+            if self.is_leaf[a]:
+                return True
+            return None
+        if self.is_ancestor_pos(a, b):
+            return True
+        if self.is_ancestor_pos(b, a):
+            return None
+        return False
+
+
+    # The ground truth for every pair: matrix[a][b] is APPLIES_CODE[does_A_apply_to_anyB(parts[a], parts[b])].
+    # A numpy int8 array if numpy is installed, else a list of lists.
+    def applies_matrix(self):
+        if self.matrix is None:
+            n = len(self.parts)
+            if numpy is not None:
+                pos = numpy.arange(n)
+                exit = numpy.array(self.exit)
+                in_subtree = (pos[:, None] <= pos[None, :]) & (pos[None, :] <= exit[:, None]) # [a, b]: b under a
+                self.matrix = numpy.zeros((n, n), dtype=numpy.int8)
+                self.matrix[in_subtree] = 1 # a is b's ancestor, so applies
+                self.matrix[in_subtree.T] = -1 # a is under b, so unclear
+                self.matrix[pos, pos] = numpy.where(numpy.array(self.is_leaf), 1, -1)
+            else:
+                self.matrix = []
+                for a in range(n):
+                    row = [0] * n
+                    row[a:self.exit[a] + 1] = [1] * (self.exit[a] + 1 - a)
+                    p = self.parent_pos[a]
+                    while p >= 0:
+                        row[p] = -1
+                        p = self.parent_pos[p]
+                    row[a] = 1 if self.is_leaf[a] else -1
+                    self.matrix.append(row)
+        return self.matrix
+
+    def empty_mask(self):
+        if numpy is not None:
+            return numpy.zeros(len(self.parts), dtype=bool)
+        return 0
+
+    def positions_mask(self, positions):
+        rv = self.empty_mask()
+        for i in positions:
+            if numpy is not None:
+                rv[i] = True
+            else:
+                rv |= 1 << i
+        return rv
+
+    # Mask of the positions lo, ..., hi - 1
+    def range_mask(self, lo:int, hi:int):
+        if numpy is not None:
+            rv = self.empty_mask()
+            rv[lo:hi] = True
+            return rv
+        return (1 << hi) - (1 << lo)
+
+    def parts_mask(self, parts):
+        return self.positions_mask([self.position[part] for part in parts])
+
+    def level_mask(self, level:int):
+        return self.parts_mask([p for i, p in enumerate(self.parts) if self.depth[i] == level])
+
+    # Mask of the parts p with does_A_apply_to_anyB(A, p) == value (if A given)
+    # or does_A_apply_to_anyB(p, B) == value (if B given)
+    def mask(self, A=None, B=None, value=True):
+        assert (A is None) != (B is None), "give exactly one of A or B"
+        x = self.position[A if A is not None else B]
+        ancestors = []
+        p = self.parent_pos[x]
+        while p >= 0:
+            ancestors.append(p)
+            p = self.parent_pos[p]
+        if A is not None: # A applies to itself (if a leaf) and everything under it; unclear for its ancestors
+            true_mask = self.range_mask(x if self.is_leaf[x] else x + 1, self.exit[x] + 1)
+            none_mask = self.positions_mask(ancestors if self.is_leaf[x] else ancestors + [x])
+        else: # B's ancestors apply to it; unclear whether the parts under it do
+            true_mask = self.positions_mask(ancestors + [x] if self.is_leaf[x] else ancestors)
+            none_mask = self.empty_mask() if self.is_leaf[x] else self.range_mask(x, self.exit[x] + 1)
+        if value is True:
+            return true_mask
+        if value is None:
+            return none_mask
+        if numpy is not None:
+            return ~(true_mask | none_mask)
+        return ((1 << len(self.parts)) - 1) & ~(true_mask | none_mask)
+
+    # The parts in a mask, in preorder
+    def select(self, mask) -> list:
+        if numpy is not None:
+            return [self.parts[i] for i in numpy.flatnonzero(mask)]
+        rv = []
+        while mask:
+            low = mask & -mask
+            rv.append(self.parts[low.bit_length() - 1])
+            mask ^= low
+        return rv
+
+
+# Checks the index against the original functions on randomized trees
+if __name__ == "__main__":
+    import random
+    rand_gen = random.Random(42)
+    for trial in range(200):
+        names = ["T" + str(i) for i in range(200)]
+        root = generate_synstat.statute_part(names.pop())
+        parts = [root]
+        for i in range(rand_gen.randint(0, 60)):
+            child = generate_synstat.statute_part(names.pop())
+            rand_gen.choice(parts).add_child(child)
+            parts.append(child)
+        rand_gen.shuffle(parts)
+
+        index = tree_index(root)
+        for a in parts:
+            assert index.get_level(a) == a.get_level()
+            for b in parts:
+                assert index.get_dist(a, b) == a.get_dist(b)
+                assert index.does_A_apply_to_anyB(a, b) == generate_synstat.does_A_apply_to_anyB(a, b)
+                assert CODE_APPLIES[int(index.applies_matrix()[index.position[a]][index.position[b]])] == \
+                       generate_synstat.does_A_apply_to_anyB(a, b)
+            for value in [True, False, None]:
+                assert index.select(index.mask(A=a, value=value)) == \
+                       [b for b in index.parts if generate_synstat.does_A_apply_to_anyB(a, b) == value]
+                assert index.select(index.mask(B=a, value=value)) == \
+                       [b for b in index.parts if generate_synstat.does_A_apply_to_anyB(b, a) == value]
+        level_one = index.level_mask(1)
+        assert index.select(level_one & ~index.parts_mask(parts[:5])) == \
+               [p for p in index.parts if p.get_level() == 1 and p not in parts[:5]]
+    print("tree_index matches get_dist(), get_level() and does_A_apply_to_anyB() on 200 random trees", "(with numpy)" if numpy is not None else "(without numpy)")
@@ -0,0 +1,33 @@
+# Checks api_client.py against its local stub server: the shared session keeps a few connections
+# open for many requests, where plain requests.post opens one per request.
+
+import os, sys
+import pytest
+requests = pytest.importorskip("requests")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import api_client
+
+@pytest.fixture
+def server():
+    server = api_client.start_stub_server()
+    yield server
+    server.shutdown()
+
+def test_pooled_session_reuses_connections(server):
+    api_client.time_requests(api_client.make_session(4).post, server.url, 200, 4)
+    assert 1 <= server.connections <= 4
+
+def test_new_connection_per_request(server):
+    api_client.time_requests(requests.post, server.url, 20, 2)
+    assert server.connections == 20
+
+def test_pooled_session_survives_close(server):
+    session = api_client.make_session(2)
+    session.close() # as the openai library does to sessions it considers old
+    api_client.time_requests(session.post, server.url, 10, 1)
+    assert server.connections == 1
+
+def test_timeout_settings(monkeypatch):
+    monkeypatch.setenv("GPT_CONNECT_TIMEOUT", "3")
+    monkeypatch.setenv("GPT_READ_TIMEOUT", "30")
+    assert api_client.get_timeout() == (3.0, 30.0)
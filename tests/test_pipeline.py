@@ -0,0 +1,43 @@
+# Checks pipeline.py's cache keys: a stage reruns when a file it lists in files changes, and stages
+# downstream of a rerun that gives the same output stay cached.
+
+import os, sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import pipeline
+
+def load_data():
+    with open("data.txt", "r") as f:
+        return f.read()
+
+def load_directory():
+    return sorted([open(os.path.join("corpus", name)).read() for name in os.listdir("corpus")])
+
+def make_pipeline(runs:list) -> pipeline.pipeline:
+    def count_words(data):
+        runs.append("count")
+        return len(data.split())
+    experiment = pipeline.pipeline("test", verbose=False)
+    experiment.add("load", load_data, files=["data.txt"])
+    experiment.add("count", count_words, ["load"])
+    experiment.add("corpus", load_directory, files=["corpus"])
+    return experiment
+
+def test_changed_file_reruns_its_loader(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("corpus")
+    with open("corpus/a.txt", "w") as f:
+        f.write("alpha")
+    with open("data.txt", "w") as f:
+        f.write("one two")
+    runs = []
+    assert make_pipeline(runs).run()["count"] == 2
+    assert make_pipeline(runs).run()["count"] == 2 and runs == ["count"] # all cached
+    with open("data.txt", "w") as f:
+        f.write("one two three")
+    assert make_pipeline(runs).run()["load"] == "one two three"
+    assert runs == ["count", "count"]
+    os.utime("data.txt", ns=(1, 1)) # same contents, so the loader reruns but count stays cached
+    assert make_pipeline(runs).run()["count"] == 3 and runs == ["count", "count"]
+    with open("corpus/b.txt", "w") as f:
+        f.write("beta")
+    assert make_pipeline(runs).run()["corpus"] == ["alpha", "beta"]
@@ -0,0 +1,57 @@
+# Golden-output checks for statute_text.py on a small checked-in title (fixtures/usc99.xml), which has
+# comments, a processing instruction, entities, tails, nested and repealed/transferred sections.
+# The iterative extractor must match the original recursive one byte for byte, with either parser,
+# and both must give the checked-in output (fixtures/usc99_expected.json).
+
+import os, sys, json
+import pytest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import statute_text
+from statute_text import usc_ns_str, get_IRC_text, compact_statute, get_IRC_text_recursive, \
+    compact_statute_concatenating, parse_title
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+FIXTURE = os.path.join(FIXTURES, "usc99.xml")
+
+PARSERS = ["ElementTree", pytest.param("lxml", marks=pytest.mark.skipif(statute_text.lxml_etree is None,
+                                                                        reason="lxml is not installed"))]
+
+def get_sections(parser_name:str) -> list:
+    root = parse_title(FIXTURE, use_lxml=(parser_name == "lxml"))
+    return [s for s in root.iter('{' + usc_ns_str + '}section') if "identifier" in s.attrib]
+
+def load_expected() -> dict:
+    with open(os.path.join(FIXTURES, "usc99_expected.json"), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+@pytest.mark.parametrize("parser_name", PARSERS)
+def test_matches_recursive(parser_name):
+    for s in get_sections(parser_name):
+        assert get_IRC_text(s) == get_IRC_text_recursive(s), s.attrib["identifier"]
+        for sub in s.iter(): # also below the top level, where num and heading are kept
+            if "status" not in sub.attrib:
+                assert get_IRC_text(sub, False) == get_IRC_text_recursive(sub, False)
+
+@pytest.mark.parametrize("parser_name", PARSERS)
+def test_golden_output(parser_name):
+    texts = {s.attrib["identifier"]: compact_statute(get_IRC_text(s)) for s in get_sections(parser_name)}
+    assert texts == load_expected()
+    old_texts = {s.attrib["identifier"]: compact_statute_concatenating(get_IRC_text_recursive(s))
+                 for s in get_sections(parser_name)}
+    assert old_texts == texts
+
+def test_golden_output_contents():
+    expected = load_expected()
+    s1 = expected["/us/usc/t99/s1"]
+    assert not "Definitions" in s1 # top-level heading dropped
+    assert "trust, estate & corporation." in s1 and "<whatever the amount>" in s1 # entities decoded
+    assert not "comment" in s1 and not "page" in s1 # comment and processing instruction dropped
+    assert not "Repealed" in s1 and not "Stat." in s1 and not "Amendments" in s1 # repealed, sourceCredit, notes
+    s3 = expected["/us/usc/t99/s3"]
+    assert "10 percent,  and\n" in s3 and not "Transferred" in s3 # tail kept, transferred dropped
+    assert "Inner text.\ntail text after the inner section\n" in s3 # nested section and its tail
+
+def test_compact_statute():
+    text = "line one   \n\n   \nline two\n\n\nline three"
+    # "".isspace() is False, so empty lines are kept and only pairs of newlines are merged, as always
+    assert compact_statute(text) == compact_statute_concatenating(text) == "line one\nline two\n\nline three\n"
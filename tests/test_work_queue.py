@@ -0,0 +1,119 @@
+# Runs work_queue.py end to end on localhost: a queue served over HTTP, two workers sharing it through
+# remote_queue, a worker that dies holding leases, handlers that fail or are still waiting on batch
+# responses, and the results aggregated as synthetic_statutes/queue_dataset.py does.
+
+import os, sys, time, threading
+import pytest
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, REPO)
+import work_queue, batch_file
+
+@pytest.fixture
+def served(tmp_path):
+    queue = work_queue.work_queue(str(tmp_path / "queue.db"))
+    server = work_queue.make_server(queue, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield queue, "http://127.0.0.1:" + str(server.server_address[1])
+    server.shutdown()
+    thread.join()
+    queue.close()
+
+def get_attempts(queue, queue_name:str) -> dict:
+    with queue.lock:
+        return dict(queue.db.execute("SELECT item_key, attempts FROM items WHERE queue = ?", (queue_name,)).fetchall())
+
+# Runs one worker per handler, each in its own thread with its own remote_queue; returns the numbers done
+def run_workers(url:str, queue_name:str, handlers:list, **kwargs) -> list:
+    num_done = [0] * len(handlers)
+    def work(i):
+        num_done[i] = work_queue.run_worker(work_queue.remote_queue(url), queue_name, handlers[i],
+                                            worker="worker" + str(i), verbose=False, **kwargs)
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(len(handlers))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return num_done
+
+def double(payload:dict) -> int:
+    time.sleep(0.002) # so that both workers get a share
+    return payload["n"] * 2
+
+def test_two_workers_share_the_queue(served):
+    queue, url = served
+    items = [("item" + str(n), {"n": n}) for n in range(40)]
+    assert work_queue.remote_queue(url).enqueue(queue="q", items=items) == 40
+    assert work_queue.remote_queue(url).enqueue(queue="q", items=items) == 0 # already there
+    num_done = run_workers(url, "q", [double, double], batch_size=3)
+    assert sum(num_done) == 40 and min(num_done) > 0
+    assert [(key, result) for key, _, result in queue.results(queue="q")] == [(key, payload["n"] * 2) for key, payload in items]
+    assert queue.counts(queue="q") == {"pending": 0, "leased": 0, "done": 40, "failed": 0}
+
+def test_expired_lease_goes_to_another_worker(served):
+    queue, url = served
+    remote = work_queue.remote_queue(url)
+    remote.enqueue(queue="q", items=[("item" + str(n), {"n": n}) for n in range(5)])
+    crashed = remote.lease(queue="q", worker="crashed", max_items=2, lease_seconds=0.2) # and never heard from again
+    assert run_workers(url, "q", [double], lease_seconds=10) == [3]
+    time.sleep(0.3)
+    assert run_workers(url, "q", [double], lease_seconds=10) == [2]
+    assert not remote.complete(item_id=crashed[0][0], worker="crashed", result=-1) # too late
+    assert [result for _, _, result in queue.results(queue="q")] == [0, 2, 4, 6, 8]
+
+def test_failed_items_are_retried(served):
+    queue, url = served
+    remote = work_queue.remote_queue(url)
+    remote.enqueue(queue="q", items=[("item" + str(n), {"n": n}) for n in range(6)])
+    seen = set()
+    def flaky(payload):
+        if payload["n"] % 2 == 0 and not payload["n"] in seen:
+            seen.add(payload["n"])
+            raise RuntimeError("connection reset")
+        if payload["n"] == 5:
+            raise ValueError("bad payload")
+        return payload["n"]
+    assert run_workers(url, "q", [flaky], max_attempts=3) == [5]
+    assert queue.counts(queue="q") == {"pending": 0, "leased": 0, "done": 5, "failed": 1}
+    assert queue.failures(queue="q") == [("item5", "ValueError('bad payload')")]
+    assert get_attempts(queue, "q") == {"item0": 2, "item1": 1, "item2": 2, "item3": 1, "item4": 2, "item5": 3}
+
+def test_pending_items_are_released(served):
+    queue, url = served
+    work_queue.remote_queue(url).enqueue(queue="q", items=[("item" + str(n), {"n": n}) for n in range(10)])
+    def batch_mode(payload):
+        if payload["n"] % 3 == 0:
+            raise batch_file.ResponsePending()
+        return payload["n"]
+    assert sum(run_workers(url, "q", [batch_mode, batch_mode])) == 6 # and the workers stop
+    assert queue.counts(queue="q") == {"pending": 4, "leased": 0, "done": 6, "failed": 0}
+    assert set(get_attempts(queue, "q").values()) == {0, 1} # releasing used no attempt
+    assert run_workers(url, "q", [double], max_attempts=1) == [4] # once the responses are in
+    assert queue.counts(queue="q")["done"] == 10
+
+def test_queue_dataset_aggregate(served, tmp_path):
+    pytest.importorskip("openai") # dataset_pipeline.py imports utils.py
+    sys.path.insert(0, os.path.join(REPO, "synthetic_statutes"))
+    import synstat_dataset, queue_dataset, dataset_pipeline
+    queue, url = served
+    directory = str(tmp_path / "ds")
+    writer = synstat_dataset.dataset_writer(directory, {"Nshot_type": None}, {}, shard_size=4)
+    for n in range(10):
+        writer.add({"prompt": "statute " + str(n), "sentence_prompt": None if n < 5 else "sentences " + str(n),
+                    "groundtruth": n % 2 == 0})
+    writer.close()
+    remote = work_queue.remote_queue(url)
+    assert queue_dataset.enqueue(remote, "ds", directory, "text-davinci-003") == 10
+    # answers Yes to every statute query and No to every sentence query, as queue_dataset.handle returns them
+    def answer(payload):
+        rv = {"statute": ("...", " Yes.")}
+        if payload["record"]["sentence_prompt"] is not None:
+            rv["sentence"] = ("...", " No.")
+        return rv
+    run_workers(url, "ds", [answer, answer])
+    finished = remote.results(queue="ds")
+    totals, num_pending = dataset_pipeline.aggregate(dataset_pipeline.classify(
+        [payload["record"] for _, payload, _ in finished], [result for _, _, result in finished]))
+    assert num_pending == 0
+    assert totals["statute"] == {"True Positive": 5, "True Negative": 0, "False Positive": 5, "False Negative": 0, "unclear": 0}
+    assert totals["sentence"] == {"True Positive": 0, "True Negative": 3, "False Positive": 0, "False Negative": 2, "unclear": 0}
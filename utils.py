@@ -1,16 +1,236 @@
 # Created 30 Jan 2023
 # Provides helper functions for doing SARA tests against GPT3
 
-import os, openai, time
+import os, io, json, openai, time, threading, atexit, asyncio, functools, collections
+from concurrent import futures
 from datetime import datetime
+import rate_limit # shares the API rate limit with other scripts running at the same time
+import batch_file # offline batch mode, for large sweeps
+import api_client # the shared connection pool and timeouts for API calls
+import log_archive # optional compressed, indexed copy of the log
+import replay # answers calls from the logs instead, when replaying a run
+import cost_ledger # records the tokens and dollars spent, and enforces any budget
+from batch_file import ResponsePending # raised by the calls below in batch mode, for scripts to catch
 
 GPT3_LOGFILE = "gpt3_log.txt"
+log_lock = threading.Lock() # each record is written in one go, so calls from several threads don't interleave
+
+# If GPT_LOG_ARCHIVE is set, records are also added to that archive (see log_archive.py)
+archive = {"writer": None, "parser": None}
+
+def write_log(text:str):
+    if replay.is_enabled(): # the responses are already logged
+        return
+    with log_lock:
+        f = open(GPT3_LOGFILE, "a")
+        f.write(text)
+        f.flush()
+        f.close()
+        if os.getenv("GPT_LOG_ARCHIVE", "") != "":
+            if archive["writer"] is None:
+                archive["writer"] = log_archive.archive_writer(os.getenv("GPT_LOG_ARCHIVE"), live=True)
+                archive["parser"] = log_archive.log_parser()
+                atexit.register(archive["writer"].flush)
+            for line in text.splitlines():
+                record = archive["parser"].feed(line)
+                if record is not None:
+                    archive["writer"].add(record)
+
+# Optional request hedging, to keep one straggling request from stalling a whole run.  If a call
+# has not returned by the GPT_HEDGE_PERCENTILE-th percentile of recent latencies, a duplicate is
+# sent and whichever answers first is used.  The other is abandoned: its thread finishes in the
+# background and its answer is ignored.  Only for temperature-0 calls, where the duplicate should
+# give the same answer, and only for up to GPT_HEDGE_BUDGET (a fraction) of calls.  Until there
+# are GPT_HEDGE_MIN_SAMPLES latencies to go on, duplicates go out after GPT_HEDGE_DELAY seconds.
+# Off unless GPT_HEDGE_PERCENTILE is set; hedge rate and latencies are printed at exit.
+HEDGE_HISTORY = 200 # latencies used for the percentile
+hedge_executor = None
+hedge_lock = threading.Lock()
+hedge_metrics = {"calls": 0, "hedged": 0, "hedge_won": 0,
+                 "latencies": [], # until the answer we used
+                 "unhedged_latencies": []} # until the first request answered, i.e. without hedging
+
+def hedging_enabled() -> bool:
+    return os.getenv("GPT_HEDGE_PERCENTILE", "") != ""
+
+def percentile(values:list, p:float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def get_hedge_delay() -> float:
+    recent = hedge_metrics["unhedged_latencies"][-HEDGE_HISTORY:]
+    if len(recent) < int(os.getenv("GPT_HEDGE_MIN_SAMPLES", "20")):
+        return float(os.getenv("GPT_HEDGE_DELAY", "30"))
+    return percentile(recent, float(os.getenv("GPT_HEDGE_PERCENTILE")))
+
+def get_hedge_report() -> str:
+    with hedge_lock:
+        m = hedge_metrics
+        if m["calls"] == 0:
+            return "hedging: no temperature-0 calls"
+        rv = "hedging: {:d} calls, {:d} hedged ({:.1%}), {:d} answered first by the hedge".format(
+            m["calls"], m["hedged"], m["hedged"] / m["calls"], m["hedge_won"])
+        rv += "; latency p50={:.2f}s p99={:.2f}s".format(percentile(m["latencies"], 50), percentile(m["latencies"], 99))
+        if len(m["unhedged_latencies"]) > 0:
+            rv += " vs. p50={:.2f}s p99={:.2f}s for first requests alone".format(
+                percentile(m["unhedged_latencies"], 50), percentile(m["unhedged_latencies"], 99))
+            if len(m["unhedged_latencies"]) < m["calls"]:
+                rv += " (" + str(m["calls"] - len(m["unhedged_latencies"])) + " still unanswered or failed)"
+        return rv
+
+# Single-flight: when an identical temperature-0 request (same engine, prompt and parameters) is
+# already in flight, e.g. from another thread, the new caller waits for that request's answer
+# instead of sending a duplicate.  That only helps scripts making calls from several threads.
+# Each caller still logs its own call.
+# Beyond that, and off by default: with GPT_MEMO_SIZE set, the answers to the last that many
+# completed temperature-0 requests are kept in memory, and a script repeating one of them (even
+# deliberately) gets the earlier answer instead of a new call.  This saves calls in sequential
+# scripts that repeat prompts, at the cost of keeping those responses in memory.
+inflight_lock = threading.Lock()
+inflight = dict() # request key -> futures.Future for the answer
+memo = collections.OrderedDict() # request key -> answer, least recently used first
+single_flight_metrics = {"calls": 0, "saved": 0, "memo_hits": 0}
+
+def get_memo_size() -> int:
+    return int(os.getenv("GPT_MEMO_SIZE", "") or "0")
+
+# kind is "completion" or "chat"; body is the request body in the provider's format
+def get_request_key(kind:str, body:dict) -> str:
+    return json.dumps([kind, body], sort_keys=True)
+
+# Runs send() unless an identical request (by key) was answered earlier or is in flight, in which
+# case it shares that one's answer (or exception, which is not kept)
+def send_single_flight(key:str, send):
+    with inflight_lock:
+        single_flight_metrics["calls"] += 1
+        if key in memo:
+            single_flight_metrics["memo_hits"] += 1
+            memo.move_to_end(key)
+            return memo[key]
+        leader = inflight.get(key)
+        if leader is None:
+            future = inflight[key] = futures.Future()
+        else:
+            single_flight_metrics["saved"] += 1
+    if leader is not None:
+        return leader.result()
+    try:
+        result = send()
+        future.set_result(result)
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with inflight_lock:
+            del inflight[key]
+    with inflight_lock:
+        if get_memo_size() > 0:
+            memo[key] = result
+            if len(memo) > get_memo_size():
+                memo.popitem(last=False)
+    return result
+
+def get_single_flight_report() -> str:
+    with inflight_lock:
+        return "single-flight: {:d} temperature-0 calls, {:d} saved by sharing an identical request in flight, " \
+               "{:d} answered from earlier identical requests".format(
+            single_flight_metrics["calls"], single_flight_metrics["saved"], single_flight_metrics["memo_hits"])
+
+def print_call_reports():
+    if hedging_enabled():
+        print(get_hedge_report())
+    if single_flight_metrics["saved"] > 0 or single_flight_metrics["memo_hits"] > 0:
+        print(get_single_flight_report())
+    if batch_file.is_enabled():
+        print(batch_file.get_batch_report())
+    if replay.is_enabled():
+        print(replay.get_replay_report())
+    if cost_ledger.run_metrics["calls"] > 0 or cost_ledger.run_metrics["estimated_calls"] > 0:
+        print(cost_ledger.get_ledger_report())
+atexit.register(print_call_reports)
+
+# Sends a request, sharing it with identical ones in flight and hedging it if enabled.
+# Only temperature-0 requests are shared or hedged, since only those should give the same answer
+# (temperature is None for requests sampled at the provider's defaults).
+def send_request(key:str, send, temperature:float):
+    if temperature != 0:
+        return send()
+    return send_single_flight(key, lambda: send_with_hedging(send, temperature))
+
+LOGGED_PARAMS = ["temperature", "max_tokens", "top_p", "frequency_penalty", "presence_penalty"]
+
+# Gets the response to the request described by body: when replaying from the logs, in batch
+# mode from the results of an earlier batch (either raising ResponsePending if it has none),
+# otherwise by sending it.  In a dry run, adds it to the cost estimate and raises ResponsePending.
+# logged_prompt and logged_params are as written in the log, if not the body's prompt and parameters.
+def get_response(kind:str, body:dict, send, temperature:float, logged_prompt=None, logged_params=None):
+    key = get_request_key(kind, body)
+    if logged_prompt is None:
+        logged_prompt = body["prompt"] if kind == "completion" else str(body["messages"])
+    if logged_params is None:
+        logged_params = {name: body[name] for name in LOGGED_PARAMS}
+    if replay.is_enabled():
+        return replay.get_response(key, kind, body, logged_prompt, logged_params)
+    if batch_file.is_enabled():
+        return batch_file.get_response(key, kind, body)
+    if cost_ledger.is_dry_run():
+        cost_ledger.add_estimate(body, logged_params["max_tokens"])
+        raise ResponsePending("dry run")
+    return send_request(key, lambda: send_and_record(body, send, logged_params["max_tokens"]), temperature)
+
+# Runs send() within the budget, recording the usage in the ledger (for every request sent, hedges included)
+def send_and_record(body:dict, send, max_tokens:int):
+    cost_ledger.check(body, max_tokens)
+    response = send()
+    cost_ledger.record(body["model"], response)
+    return response
+
+# Runs send(), which makes one API request and returns the response, hedging it if enabled.
+# Exceptions are passed on for the caller's retry loop (unless a hedge succeeds).
+def send_with_hedging(send, temperature:float):
+    global hedge_executor
+    if not hedging_enabled() or temperature != 0:
+        return send()
+    if hedge_executor is None:
+        hedge_executor = futures.ThreadPoolExecutor(max_workers=8)
+
+    start = time.time()
+    def record_first(f):
+        if f.exception() is None:
+            with hedge_lock:
+                hedge_metrics["unhedged_latencies"].append(time.time() - start)
+    first = hedge_executor.submit(send)
+    first.add_done_callback(record_first)
+    requests = [first]
+    done, pending = futures.wait(requests, timeout=get_hedge_delay())
+    if len(done) == 0:
+        with hedge_lock:
+            within_budget = hedge_metrics["hedged"] < float(os.getenv("GPT_HEDGE_BUDGET", "0.05")) * (hedge_metrics["calls"] + 1)
+            if within_budget:
+                hedge_metrics["hedged"] += 1
+        if within_budget:
+            requests.append(hedge_executor.submit(send))
+
+    pending = requests
+    while True:
+        done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+        answered = [f for f in requests if f in done and f.exception() is None]
+        if len(answered) > 0 or len(pending) == 0:
+            break
+    for f in pending:
+        f.cancel() # only stops it if it has not started; otherwise it is left to finish
+    with hedge_lock:
+        hedge_metrics["calls"] += 1
+        if len(answered) > 0:
+            hedge_metrics["latencies"].append(time.time() - start)
+            if answered[0] is not first:
+                hedge_metrics["hedge_won"] += 1
+    if len(answered) == 0:
+        raise first.exception()
+    return answered[0].result()
 
 def add_comment(comment:str):
-    f = open(GPT3_LOGFILE, "a")
-    f.write(datetime.now().strftime("%A %d-%B-%Y %H:%M:%S") + "  COMMENT:" + comment + "\n")
-    f.flush()
-    f.close()
+    write_log(datetime.now().strftime("%A %d-%B-%Y %H:%M:%S") + "  COMMENT:" + comment + "\n")
 
 def call_gpt3_withlogging(prompt:str,
                           engine:str,
@@ -19,9 +239,9 @@ def call_gpt3_withlogging(prompt:str,
                           top_p=1.0,
                           frequency_penalty=0.0,
                           presence_penalty=0.0) -> str:
-    openai.api_key = os.getenv("GPT3_API_KEY")
+    api_client.setup()
 
-    f = open(GPT3_LOGFILE, "a")
+    f = io.StringIO() # written to the log all at once at the end
     f.write("************************\n")
 
     f.write(datetime.now().strftime("%A %d-%B-%Y %H:%M:%S") + "\n")
@@ -32,49 +252,72 @@ def call_gpt3_withlogging(prompt:str,
     f.write(prompt + "\n")
     f.write("------- (prompt above/response below)\n")
 
+    logged_params = {"temperature": temperature, "max_tokens": max_tokens, "top_p": top_p,
+                     "frequency_penalty": frequency_penalty, "presence_penalty": presence_penalty}
     if engine in ["gpt-4", "gpt-4-0314"]:
-        response = openai.ChatCompletion.create(
-            model=engine,
-            messages=[
-                {"role": "user", "content": prompt}
-            ])
-        response_text = response['choices'][0]['message']['content']
+        kind = "chat"
+        messages = [
+            {"role": "user", "content": prompt}
+        ]
+        # Only the model and messages are sent, so gpt-4 samples at the provider's defaults (and the
+        # default max_tokens of 256 does not cut off its longer answers).  Those answers can differ from
+        # call to call, so sampled_temperature is None: they are never shared, memoized or hedged.
+        body = {"model": engine, "messages": messages}
+        sampled_temperature = None
+        def send():
+            rate_limit.acquire(rate_limit.estimate_tokens(prompt, max_tokens))
+            return openai.ChatCompletion.create(
+                model=engine,
+                messages=messages,
+                request_timeout=api_client.get_timeout())
     else:
-        worked = False
-        while not worked:
-            try:
-                response = openai.Completion.create(
-                    engine=engine,
-                    prompt=prompt,
-                    temperature=temperature,
-                    max_tokens=max_tokens,
-                    top_p=top_p,
-                    frequency_penalty=frequency_penalty,
-                    presence_penalty=presence_penalty
-                )
+        kind = "completion"
+        sampled_temperature = temperature
+        body = {"model": engine, "prompt": prompt, "temperature": temperature, "max_tokens": max_tokens,
+                "top_p": top_p, "frequency_penalty": frequency_penalty, "presence_penalty": presence_penalty}
+        def send():
+            rate_limit.acquire(rate_limit.estimate_tokens(prompt, max_tokens))
+            return openai.Completion.create(
+                engine=engine,
+                prompt=prompt,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                top_p=top_p,
+                frequency_penalty=frequency_penalty,
+                presence_penalty=presence_penalty,
+                request_timeout=api_client.get_timeout()
+            )
+
+    worked = False
+    while not worked:
+        try:
+            response = get_response(kind, body, send, sampled_temperature, prompt, logged_params)
+            if kind == "chat":
+                response_text = response['choices'][0]['message']['content']
+            else:
                 response_text = response['choices'][0]['text']
-                worked = True
-            except openai.error.ServiceUnavailableError:
-                print("ServiceUnavailableError error, retrying in 2s.", end="")
-                time.sleep(2)
-            except openai.error.RateLimitError:
-                print("RateLimitError error, retrying in 2s.", end="")
-                time.sleep(2)
-            except openai.error.APIConnectionError:
-                print("APIConnectionError error, retrying in 2s.", end="")
-                time.sleep(2)
-            except openai.error.APIError:
-                print("APIError error, retrying in 2s.", end="")
-                time.sleep(2)
-            except openai.error.Timeout:
-                print("Timeout error, retrying in 2s.", end="")
-                time.sleep(2)
-        assert worked
+            worked = True
+        except openai.error.ServiceUnavailableError:
+            print("ServiceUnavailableError error, retrying in 2s.", end="")
+            time.sleep(2)
+        except openai.error.RateLimitError:
+            print("RateLimitError error, retrying in 2s.", end="")
+            rate_limit.report_rate_limited()
+            time.sleep(2)
+        except openai.error.APIConnectionError:
+            print("APIConnectionError error, retrying in 2s.", end="")
+            time.sleep(2)
+        except openai.error.APIError:
+            print("APIError error, retrying in 2s.", end="")
+            time.sleep(2)
+        except openai.error.Timeout:
+            print("Timeout error, retrying in 2s.", end="")
+            time.sleep(2)
+    assert worked
 
     f.write(response_text + "\n")
     f.write("************************\n")
-    f.flush()
-    f.close()
+    write_log(f.getvalue())
 
     return response_text
 
@@ -88,9 +331,9 @@ def call_gpt_raw(messages:list,
                   top_p=1.0,
                   frequency_penalty=0.0,
                   presence_penalty=0.0) -> str:
-    openai.api_key = os.getenv("GPT3_API_KEY")
+    api_client.setup()
 
-    f = open(GPT3_LOGFILE, "a") # technically also used for GPT4, etc. logging
+    f = io.StringIO() # written to the log (technically also used for GPT4, etc.) all at once at the end
     f.write("************************\n")
 
     f.write(datetime.now().strftime("%A %d-%B-%Y %H:%M:%S") + "\n")
@@ -104,15 +347,21 @@ def call_gpt_raw(messages:list,
     worked = False
     while not worked:
         try:
-            response = openai.ChatCompletion.create(
-                model=engine,
-                messages=messages,
-                temperature=temperature,
-                max_tokens=max_tokens,
-                top_p=top_p,
-                frequency_penalty=frequency_penalty,
-                presence_penalty=presence_penalty
-            )
+            def send():
+                rate_limit.acquire(rate_limit.estimate_tokens(str(messages), max_tokens))
+                return openai.ChatCompletion.create(
+                    model=engine,
+                    messages=messages,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    top_p=top_p,
+                    frequency_penalty=frequency_penalty,
+                    presence_penalty=presence_penalty,
+                    request_timeout=api_client.get_timeout()
+                )
+            body = {"model": engine, "messages": messages, "temperature": temperature, "max_tokens": max_tokens,
+                    "top_p": top_p, "frequency_penalty": frequency_penalty, "presence_penalty": presence_penalty}
+            response = get_response("chat", body, send, temperature)
             response_text = response['choices'][0]['message']['content']
             worked = True
         except openai.error.ServiceUnavailableError:
@@ -120,6 +369,7 @@ def call_gpt_raw(messages:list,
             time.sleep(5)
         except openai.error.RateLimitError:
             print("RateLimitError error, retrying in 5s.")
+            rate_limit.report_rate_limited()
             time.sleep(5)
         except openai.error.APIConnectionError:
             print("APIConnectionError error, retrying in 5s.")
@@ -140,11 +390,15 @@ def call_gpt_raw(messages:list,
 
     f.write(response_text + "\n")
     f.write("************************\n")
-    f.flush()
-    f.close()
+    write_log(f.getvalue())
 
     return response_text
 
+# For asyncio code: runs one of the calls above (e.g. call_gpt_raw) in a worker thread, so the
+# event loop is not blocked; all threads share api_client's connection pool.
+async def call_async(call, *args, **kwargs) -> str:
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(call, *args, **kwargs))
+
 
 def get_cases(test_or_train:str, exclude_dollars=False, only_tax_cases=False) -> list:
     rv = []
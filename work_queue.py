@@ -0,0 +1,314 @@
+# Durable work queue, so a large sweep (e.g. a 10,000-query synthetic-statute dataset) can be run
+# by any number of worker processes, on any number of machines, and survive workers dying.
+#
+# The queue is a SQLite database.  An experiment enqueues query descriptors (JSON payloads, each
+# with a key unique in its queue, so enqueueing again is harmless).  Workers lease a few items at a
+# time, call the model, and write back the results.  A lease expires after lease_seconds unless the
+# worker renews it (workers renew while they work), so an item leased by a worker that died goes
+# back to the queue.  An item whose handler raised is retried, up to max_attempts in all.  An item
+# whose handler raised ResponsePending (batch mode or a dry run, see batch_file.py and cost_ledger.py)
+# goes back to the queue without using an attempt, for a later run once the responses are in.
+# The results are then read back, all in one place, by whoever aggregates them.
+#
+# Workers on the same machine can share the database file.  For other machines, serve it over HTTP
+# (localhost only unless --host is given; there is no authentication) and point workers at the URL:
+#   python work_queue.py serve --db queue.db --port 8765
+#   python work_queue.py worker --url http://HOST:8765 --queue NAME --handler module:function
+#   python work_queue.py status --db queue.db
+# A handler is a function taking an item's payload and returning its (JSON-able) result; it is
+# imported from the worker's directory.  The default, call_model, makes one call per item.
+# See synthetic_statutes/queue_dataset.py for running an exported dataset this way.
+
+import os, sys, json, time, sqlite3, socket, threading, importlib
+import urllib.request
+import batch_file
+
+DEFAULT_LEASE_SECONDS = 600 # long completions can take minutes
+DEFAULT_MAX_ATTEMPTS = 3
+STATES = ["pending", "leased", "done", "failed"]
+
+class work_queue:
+    def __init__(self, filename:str):
+        self.lock = threading.Lock() # the connection is shared by the threads of e.g. the HTTP server
+        self.db = sqlite3.connect(filename, timeout=60, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL") # so readers (e.g. status) do not block workers
+        self.db.execute("CREATE TABLE IF NOT EXISTS items (id INTEGER PRIMARY KEY, queue TEXT, item_key TEXT, "
+                        "payload TEXT, state TEXT, worker TEXT, lease_expires REAL, attempts INTEGER, "
+                        "result TEXT, error TEXT, updated REAL, UNIQUE (queue, item_key))")
+        self.db.execute("CREATE INDEX IF NOT EXISTS items_state ON items (queue, state, lease_expires)")
+
+    # Runs func(db) in one transaction that holds the write lock, so two workers never lease the same item
+    def transaction(self, func):
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                rv = func(self.db)
+            except:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+            return rv
+
+    # items is a list of (key, payload); returns the number actually added (i.e., not already there)
+    def enqueue(self, queue:str, items:list) -> int:
+        now = time.time()
+        def insert(db):
+            before = db.total_changes
+            db.executemany("INSERT OR IGNORE INTO items (queue, item_key, payload, state, attempts, updated) "
+                           "VALUES (?, ?, ?, 'pending', 0, ?)",
+                           [(queue, key, json.dumps(payload, ensure_ascii=False), now) for key, payload in items])
+            return db.total_changes - before
+        return self.transaction(insert)
+
+    # Leases up to max_items pending items (or leased ones whose lease has expired), oldest first,
+    # only from those with ids above after_id.  Returns a list of (id, key, payload).
+    def lease(self, queue:str, worker:str, max_items=1, lease_seconds=DEFAULT_LEASE_SECONDS, after_id=0) -> list:
+        now = time.time()
+        def take(db):
+            rows = db.execute("SELECT id, item_key, payload FROM items WHERE queue = ? AND id > ? AND "
+                              "(state = 'pending' OR (state = 'leased' AND lease_expires < ?)) ORDER BY id LIMIT ?",
+                              (queue, after_id, now, max_items)).fetchall()
+            db.executemany("UPDATE items SET state = 'leased', worker = ?, lease_expires = ?, updated = ? WHERE id = ?",
+                           [(worker, now + lease_seconds, now, row[0]) for row in rows])
+            return [(row[0], row[1], json.loads(row[2])) for row in rows]
+        return self.transaction(take)
+
+    # Extends the worker's leases; returns the ids it still holds (a lease that expired may have gone to another worker)
+    def renew(self, ids:list, worker:str, lease_seconds=DEFAULT_LEASE_SECONDS) -> list:
+        now = time.time()
+        def extend(db):
+            held = []
+            for item_id in ids:
+                cursor = db.execute("UPDATE items SET lease_expires = ?, updated = ? WHERE id = ? AND state = 'leased' "
+                                    "AND worker = ?", (now + lease_seconds, now, item_id, worker))
+                if cursor.rowcount > 0:
+                    held.append(item_id)
+            return held
+        return self.transaction(extend)
+
+    # Stores the result, if the worker still holds the lease; returns whether it did
+    def complete(self, item_id:int, worker:str, result) -> bool:
+        def store(db):
+            return db.execute("UPDATE items SET state = 'done', result = ?, error = NULL, attempts = attempts + 1, "
+                              "updated = ? WHERE id = ? AND state = 'leased' AND worker = ?",
+                              (json.dumps(result, ensure_ascii=False), time.time(), item_id, worker)).rowcount > 0
+        return self.transaction(store)
+
+    # Records a failed attempt: the item goes back to pending, or to failed after max_attempts
+    def fail(self, item_id:int, worker:str, error:str, max_attempts=DEFAULT_MAX_ATTEMPTS) -> bool:
+        def store(db):
+            return db.execute("UPDATE items SET state = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END, "
+                              "error = ?, attempts = attempts + 1, worker = NULL, updated = ? "
+                              "WHERE id = ? AND state = 'leased' AND worker = ?",
+                              (max_attempts, error, time.time(), item_id, worker)).rowcount > 0
+        return self.transaction(store)
+
+    # Gives up the lease without using an attempt: the item goes back to pending
+    def release(self, item_id:int, worker:str) -> bool:
+        def store(db):
+            return db.execute("UPDATE items SET state = 'pending', worker = NULL, updated = ? "
+                              "WHERE id = ? AND state = 'leased' AND worker = ?",
+                              (time.time(), item_id, worker)).rowcount > 0
+        return self.transaction(store)
+
+    # Puts failed items back to pending, e.g. after fixing whatever made them fail
+    def retry_failed(self, queue:str) -> int:
+        return self.transaction(lambda db: db.execute("UPDATE items SET state = 'pending', attempts = 0 "
+                                                      "WHERE queue = ? AND state = 'failed'", (queue,)).rowcount)
+
+    # Returns a dict of state -> number of items (expired leases count as pending)
+    def counts(self, queue:str) -> dict:
+        rv = {state: 0 for state in STATES}
+        with self.lock:
+            for state, expired, num in self.db.execute(
+                    "SELECT state, state = 'leased' AND lease_expires < ?, COUNT(*) FROM items WHERE queue = ? "
+                    "GROUP BY 1, 2", (time.time(), queue)).fetchall():
+                rv["pending" if expired else state] += num
+        return rv
+
+    def queues(self) -> list:
+        with self.lock:
+            return [row[0] for row in self.db.execute("SELECT DISTINCT queue FROM items ORDER BY queue").fetchall()]
+
+    # Returns a list of (key, payload, result) for the finished items, in the order enqueued
+    def results(self, queue:str) -> list:
+        with self.lock:
+            rows = self.db.execute("SELECT item_key, payload, result FROM items WHERE queue = ? AND state = 'done' "
+                                   "ORDER BY id", (queue,)).fetchall()
+        return [(key, json.loads(payload), json.loads(result)) for key, payload, result in rows]
+
+    # Returns a list of (key, error) for the items that used up their attempts
+    def failures(self, queue:str) -> list:
+        with self.lock:
+            return self.db.execute("SELECT item_key, error FROM items WHERE queue = ? AND state = 'failed' ORDER BY id",
+                                   (queue,)).fetchall()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+# The methods that can be called over HTTP, each with its arguments as a JSON object
+REMOTE_METHODS = ["enqueue", "lease", "renew", "complete", "fail", "release", "retry_failed", "counts", "queues", "results", "failures"]
+
+# Same methods as work_queue, for a queue served by serve() on another machine
+class remote_queue:
+    def __init__(self, url:str, timeout=60):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def call(self, method:str, **kwargs):
+        request = urllib.request.Request(self.url + "/" + method, data=json.dumps(kwargs).encode("utf-8"),
+                                         headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    def __getattr__(self, method:str):
+        assert method in REMOTE_METHODS, "No such queue method " + method
+        return lambda **kwargs: self.call(method, **kwargs)
+
+    def close(self):
+        pass
+
+def make_server(queue:work_queue, host="127.0.0.1", port=8765):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class queue_handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            method = self.path.strip("/")
+            kwargs = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            if not method in REMOTE_METHODS:
+                self.send_error(404)
+                return
+            if method == "enqueue":
+                kwargs["items"] = [tuple(item) for item in kwargs["items"]]
+            try:
+                body = json.dumps(getattr(queue, method)(**kwargs), ensure_ascii=False).encode("utf-8")
+            except Exception as e:
+                self.send_error(500, repr(e))
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, format, *args):
+            pass
+
+    return ThreadingHTTPServer((host, port), queue_handler)
+
+def open_queue(db=None, url=None):
+    assert (db is None) != (url is None), "Give either a database file or a URL"
+    return work_queue(db) if db is not None else remote_queue(url)
+
+def get_worker_name() -> str:
+    return socket.gethostname() + ":" + str(os.getpid())
+
+# The default handler: one call to the model, with payload {"prompt": ..., "model": ..., "max_tokens": ...}
+# for a completion, or {"messages": [...], "model": ..., "max_tokens": ...} for a chat.
+def call_model(payload:dict) -> str:
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    import utils
+    if "messages" in payload:
+        return utils.call_gpt_raw(payload["messages"], payload["model"], max_tokens=payload.get("max_tokens", 1000))
+    return utils.call_gpt3_withlogging(payload["prompt"], payload["model"], max_tokens=payload.get("max_tokens", 1000))
+
+# Imports a handler given as "module:function", from the current directory
+def load_handler(name:str):
+    module_name, function_name = name.split(":")
+    sys.path.insert(0, os.getcwd())
+    return getattr(importlib.import_module(module_name), function_name)
+
+# Leases and handles items until the queue has none left to lease (or max_items have been handled).
+# While an item is being handled, a background thread keeps its lease renewed.  Returns the number done.
+# Items are leased in passes over the queue, in id order.  Items still waiting on a response
+# (ResponsePending) are released, and the worker stops at the end of a pass that released any,
+# rather than leasing them again straight away.
+def run_worker(queue, queue_name:str, handler, worker=None, lease_seconds=DEFAULT_LEASE_SECONDS,
+               max_attempts=DEFAULT_MAX_ATTEMPTS, batch_size=1, max_items=0, verbose=True) -> int:
+    worker = worker if worker is not None else get_worker_name()
+    num_done = 0
+    num_released = 0
+    after_id = 0 # last id leased in this pass
+    while max_items <= 0 or num_done < max_items:
+        leased = queue.lease(queue=queue_name, worker=worker, max_items=batch_size, lease_seconds=lease_seconds,
+                             after_id=after_id)
+        if len(leased) == 0:
+            if after_id == 0 or num_released > 0:
+                break
+            after_id = 0 # start another pass, e.g. for items that failed and are to be retried
+            continue
+        after_id = leased[-1][0]
+        held = [item_id for item_id, _, _ in leased]
+        stop = threading.Event()
+        def renew_leases():
+            while not stop.wait(lease_seconds / 3):
+                queue.renew(ids=held, worker=worker, lease_seconds=lease_seconds)
+        renewer = threading.Thread(target=renew_leases, daemon=True)
+        renewer.start()
+        try:
+            for item_id, key, payload in leased:
+                try:
+                    result = handler(payload)
+                except batch_file.ResponsePending:
+                    queue.release(item_id=item_id, worker=worker)
+                    num_released += 1
+                except Exception as e:
+                    if verbose:
+                        print(worker, "FAILED", key, repr(e))
+                    queue.fail(item_id=item_id, worker=worker, error=repr(e), max_attempts=max_attempts)
+                else:
+                    if queue.complete(item_id=item_id, worker=worker, result=result):
+                        num_done += 1
+                    elif verbose:
+                        print(worker, "lost the lease on", key, "so its result was dropped")
+                held.remove(item_id)
+        finally:
+            stop.set()
+            renewer.join()
+    if verbose and num_released > 0:
+        print(worker, "left", num_released, "items pending, still waiting on responses")
+    return num_done
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Serve, work on, or summarize a durable work queue')
+    parser.add_argument('command', choices=["serve", "worker", "status", "retry"])
+    parser.add_argument('--db', default=None,
+                        help='the SQLite database file of the queue')
+    parser.add_argument('--url', default=None,
+                        help='for worker and status, the URL of a queue served by "serve", instead of --db')
+    parser.add_argument('--host', default="127.0.0.1",
+                        help='for serve, the address to listen on (default only this machine)')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--queue', default=None,
+                        help='name of the queue to work on (status shows all if not given)')
+    parser.add_argument('--handler', default="work_queue:call_model",
+                        help='for worker, the function handling each payload, as module:function')
+    parser.add_argument('--lease', type=float, default=DEFAULT_LEASE_SECONDS,
+                        help='seconds a lease lasts unless renewed')
+    parser.add_argument('--max_attempts', type=int, default=DEFAULT_MAX_ATTEMPTS)
+    parser.add_argument('--batch_size', type=int, default=1,
+                        help='items leased at a time')
+    parser.add_argument('--max_items', type=int, default=0,
+                        help='stop the worker after this many items (0 for no limit)')
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        assert args.db is not None, "serve needs --db"
+        server = make_server(work_queue(args.db), args.host, args.port)
+        print("Serving", args.db, "at http://" + args.host + ":" + str(server.server_address[1]))
+        server.serve_forever()
+    queue = open_queue(args.db, args.url)
+    if args.command == "worker":
+        assert args.queue is not None, "worker needs --queue"
+        num_done = run_worker(queue, args.queue, load_handler(args.handler), lease_seconds=args.lease,
+                              max_attempts=args.max_attempts, batch_size=args.batch_size, max_items=args.max_items)
+        print(get_worker_name(), "did", num_done, "items")
+    elif args.command == "retry":
+        assert args.queue is not None, "retry needs --queue"
+        print("Put", queue.retry_failed(queue=args.queue), "failed items back in", args.queue)
+    else:
+        for name in ([args.queue] if args.queue is not None else queue.queues()):
+            print(name, queue.counts(queue=name))
+            for key, error in queue.failures(queue=name)[:10]:
+                print("  failed", key, error)